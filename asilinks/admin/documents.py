@@ -1,7 +1,5 @@
-import os
 import datetime as dt
 
-from django.core.files.base import ContentFile
 from mongoengine import fields, document
 
 from asilinks.fields import LocalStorageFileField
@@ -24,16 +22,11 @@ class DeliverableStore(document.Document):
         from requesting.documents import Request, Message
         instance = cls(container=request)
 
-        for message in request.com_channel:
-            if (message.type in (Message.TYPE_DOC, Message.TYPE_IMAGE)
-                    and message.last_delivery):
-                filename = os.path.split(message.attachment.file.name)[-1]
-                content = ContentFile(message.attachment.file.read())
-                f = FileStored()
-
-                f.file.save(filename, content, save=False)
-                message.attachment.file.close()
-                instance.attachments.append(f)
+        for message in request.messages(Message.CHANNEL_COM).filter(
+                type__in=(Message.TYPE_DOC, Message.TYPE_IMAGE), last_delivery=True):
+            f = FileStored()
+            f.file.copy_from(message.attachment)
+            instance.attachments.append(f)
 
         if instance.attachments:
             return instance.save()
@@ -39,6 +39,10 @@ CLIENT_MESSAGES = {
         'title': 'Buscando socio...',
         'body': 'En el requerimiento "{request.name}" no tenemos socios registrados.',
     },
+    'paypal_email_required': {
+        'title': 'Tienes un pago de referido pendiente.',
+        'body': 'Registra tu correo de Paypal para recibirlo.',
+    },
 }
 
 PARTNER_MESSAGES = {
@@ -114,4 +118,8 @@ PARTNER_MESSAGES = {
         'title': 'Solicitud de extensión de tiempo rechazada.',
         'body': 'La extensión de tiempo que solicitaste fue rechazada.',
     },
+    'paypal_email_required': {
+        'title': 'Tienes un pago pendiente.',
+        'body': 'Registra tu correo de Paypal para recibirlo.',
+    },
 }
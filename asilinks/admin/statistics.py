@@ -4,12 +4,11 @@ Statistics module
 # Python imports
 import datetime as dt
 import pandas as pd
-from mongoengine.queryset.visitor import Q
 # Document Models imports
 from authentication.documents import Account
 from requesting.documents import Request
 from main.documents import Partner, Client, Category
-from payments.documents import Transaction
+from payments.documents import Transaction, LedgerBalance
 
 
 def get_requests_dataframe(requests):
@@ -238,41 +237,35 @@ def get_total_profit():
     """
     Returns Asilinks total profit
     """
-    return Transaction.objects \
-        .filter(Q(operation=Transaction.OP_ASILINKS_FEE) |
-                Q(operation=Transaction.OP_SPONSOR_FEE,
-                  receiver=Account.default_sponsor_account())) \
-        .sum('amount')
+    return LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, )) + \
+        LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, ),
+            Account.default_sponsor_account())
 
 
 def get_month_total_profit(first_day):
     """
     Returns Asilinks month total profit
     """
-    return Transaction.objects \
-        .filter(Q(date__gte=first_day) &
-                (Q(operation=Transaction.OP_ASILINKS_FEE) |
-                 Q(operation=Transaction.OP_SPONSOR_FEE,
-                   receiver=Account.default_sponsor_account()))) \
-        .sum('amount')
+    # Los balances son mensuales, first_day es el inicio del mes.
+    return LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ), since=first_day) + \
+        LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, ),
+            Account.default_sponsor_account(), since=first_day)
 
 
 def get_total_partner_profit():
     """
     Returns total partner profit
     """
-    return Transaction.objects \
-        .filter(operation=Transaction.OP_PARTNER_SETTLEMENT) \
-        .sum('amount')
+    return LedgerBalance.balance((Transaction.OP_PARTNER_SETTLEMENT, ))
 
 
 def get_total_sponsor_profit():
     """
     Returns total sponsor profit
     """
-    return Transaction.objects \
-        .filter(operation=Transaction.OP_SPONSOR_FEE,
-                receiver__ne=Account.default_sponsor_account()).sum('amount')
+    return LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, )) - \
+        LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, ),
+            Account.default_sponsor_account())
 
 
 def get_total_withheld_payments():
@@ -280,8 +273,7 @@ def get_total_withheld_payments():
     Returns total withheld payments
     (unclosed requirements)
     """
-    return Transaction.objects \
-        .filter(operation=Transaction.OP_REQUEST_PAYMENT).sum('amount')
+    return LedgerBalance.balance((Transaction.OP_REQUEST_PAYMENT, ))
 
 
 def get_requirement_mean_cost(requests):
@@ -559,10 +551,12 @@ def get_average_profit_by_category(done_requests, category_names):
     Returns the average profit by category
     """
     all_done_requests_profit = list()
+    # Compara por id, sin desreferenciar el receptor de cada transaccion.
+    default_sponsor_id = Account.default_sponsor_account().pk
     for request in done_requests:
         categories = list(set([field.category for field in request.know_fields]))
         for transaction in request.transactions:
-            if (transaction.operation == Transaction.OP_ASILINKS_FEE) or ((transaction.operation == Transaction.OP_SPONSOR_FEE) and (transaction.receiver == Account.default_sponsor_account())):
+            if (transaction.operation == Transaction.OP_ASILINKS_FEE) or ((transaction.operation == Transaction.OP_SPONSOR_FEE) and (transaction.to_mongo().get('receiver') == default_sponsor_id)):
                 request_transaction = float(transaction.amount)
         for category in categories:
             all_done_requests_profit.append([category, request_transaction])
@@ -1,3 +1,54 @@
-from django.test import TestCase
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from rest_framework.test import APISimpleTestCase
+
+from asilinks.storage_backends import PrivateMediaStorage, copy_file
 
 # Create your tests here.
+
+class StorageCopyTests(APISimpleTestCase):
+
+    def test_filesystem_copy_and_move(self):
+        """
+        Ensure local files are copied or renamed on disk.
+        """
+        with tempfile.TemporaryDirectory() as source_dir, \
+                tempfile.TemporaryDirectory() as target_dir:
+            source = FileSystemStorage(location=source_dir)
+            target = FileSystemStorage(location=target_dir)
+            name = source.save('drafts/doc.txt', ContentFile(b'contenido'))
+
+            copied = copy_file(source, name, target, 'store/doc.txt')
+            self.assertTrue(source.exists(name))
+
+            moved = copy_file(source, name, target, 'store/doc.txt', move=True)
+            self.assertFalse(source.exists(name))
+            self.assertNotEqual(copied, moved)
+
+            with target.open(moved) as f:
+                self.assertEqual(f.read(), b'contenido')
+
+    def test_s3_server_side_copy(self):
+        """
+        Ensure S3 objects are copied by the bucket without being read.
+        """
+        storage = PrivateMediaStorage()
+
+        with mock.patch.object(PrivateMediaStorage, 'bucket',
+                new_callable=mock.PropertyMock) as bucket, \
+                mock.patch.object(PrivateMediaStorage, 'exists', return_value=False), \
+                mock.patch.object(PrivateMediaStorage, '_open') as open_:
+            name = copy_file(storage, 'attachments/doc.pdf', storage,
+                'store/doc.pdf', move=True)
+
+        obj = bucket.return_value.Object
+        obj.assert_any_call('private/store/doc.pdf')
+        obj.return_value.copy.assert_called_once_with({
+            'Bucket': storage.bucket_name, 'Key': 'private/attachments/doc.pdf'},
+            ExtraArgs={'ACL': 'private'})
+        obj.return_value.delete.assert_called_once_with()
+        open_.assert_not_called()
+        self.assertEqual(name, 'store/doc.pdf')
@@ -0,0 +1,107 @@
+from collections import OrderedDict, defaultdict
+
+from pymongo import UpdateOne
+
+
+class BulkUpdate(object):
+    """
+    Collects modify-like updates over several documents, mainly pushes and
+    pulls on reference lists, and flushes them with a single unordered
+    bulk_write per collection.
+
+        with BulkUpdate() as bulk:
+            bulk.update(client, pull__requests_todo=request,
+                push__requests_in_progress=request)
+            for partner in partners:
+                bulk.update(partner, pull__requests_todo=request)
+    """
+
+    OPERATORS = {
+        'push': '$push',
+        'pull': '$pull',
+        'add_to_set': '$addToSet',
+        'set': '$set',
+        'inc': '$inc',
+    }
+
+    def __init__(self):
+        self._updates = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self._updates)
+
+    def update(self, document, query=None, **kwargs):
+        self.update_id(type(document), document.pk, query=query, **kwargs)
+
+    def update_id(self, document_class, pk, query=None, **kwargs):
+        """
+        Queues the updates for the document with the given primary key,
+        using the `operator__field=value` syntax of `modify`. Updates with
+        an extra raw `query` condition are kept in their own operation.
+        """
+        query = query or {}
+        entry = (document_class, pk, repr(sorted(query.items())))
+
+        if entry not in self._updates:
+            self._updates[entry] = (dict(query, _id=pk), OrderedDict())
+        updates = self._updates[entry][1]
+
+        for key, value in kwargs.items():
+            operator, name = key.split('__', 1)
+
+            if operator not in self.OPERATORS:
+                raise ValueError('Unsupported bulk operator: {}'.format(operator))
+
+            field = document_class._fields[name]
+            db_field = field.db_field
+
+            for other, fields in updates.items():
+                if other != operator and db_field in fields:
+                    raise ValueError('Conflicting updates on field: {}'.format(name))
+
+            if operator == 'set':
+                updates.setdefault(operator, OrderedDict())[db_field] = field.to_mongo(value)
+            elif operator == 'inc':
+                fields = updates.setdefault(operator, OrderedDict())
+                fields[db_field] = fields.get(db_field, 0) + value
+            else:
+                updates.setdefault(operator, OrderedDict()).setdefault(
+                    db_field, []).append(field.field.to_mongo(value))
+
+    def operations(self):
+        """
+        Returns the pending pymongo operations grouped by document class.
+        """
+        grouped = defaultdict(list)
+
+        for (document_class, _, _), (query, updates) in self._updates.items():
+            document = dict()
+
+            for operator, fields in updates.items():
+                if operator in ('set', 'inc'):
+                    document[self.OPERATORS[operator]] = dict(fields)
+                elif operator == 'pull':
+                    document['$pull'] = {name: {'$in': values}
+                        for name, values in fields.items()}
+                else:
+                    document[self.OPERATORS[operator]] = {name: {'$each': values}
+                        for name, values in fields.items()}
+
+            grouped[document_class].append(UpdateOne(query, document))
+
+        return grouped
+
+    def flush(self):
+        results = {document_class: document_class._get_collection().bulk_write(
+            operations, ordered=False)
+            for document_class, operations in self.operations().items()}
+
+        self._updates.clear()
+        return results
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_process_init, worker_ready
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'asilinks.settings')
@@ -17,6 +18,20 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@worker_process_init.connect
+def warm_system_accounts(**kwargs):
+    # Precarga las cuentas del sistema en cada proceso del worker.
+    from authentication.documents import Account
+    Account.warm_system_accounts()
+
+
+@worker_ready.connect
+def run_backfills(sender, **kwargs):
+    # Completa los datos derivados de registros previos al arrancar el worker.
+    sender.app.send_task('reconcile_open_opportunities')
+    sender.app.send_task('backfill_deadlines')
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
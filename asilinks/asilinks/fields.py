@@ -69,9 +69,27 @@ class TimeDeltaField(BaseField):
         return value // dt.timedelta(hours=1)
 
 
+class StorageFieldFile(FieldFile):
+
+    def copy_from(self, other, move=False):
+        """
+        Stores a copy of the file of another field, copying it within the
+        storage instead of reading its content.
+        """
+        from asilinks.storage_backends import copy_file
+
+        name = self.field.generate_filename(self.instance,
+            os.path.basename(other.name))
+        self.name = copy_file(other.storage, other.name, self.storage,
+            name, move=move)
+        self._committed = True
+
+        setattr(self.instance, self.field.name, self.name)
+
+
 class LocalStorageFileField(BaseField):
 
-    proxy_class = FieldFile
+    proxy_class = StorageFieldFile
 
     def __init__(self, size=None, name=None, upload_to='', storage=None, **kwargs):
         self.size = size
@@ -0,0 +1,35 @@
+import datetime as dt
+
+from rest_framework.pagination import CursorPagination
+
+
+class OptionalCursorPagination(CursorPagination):
+    """
+    Cursor pagination over mongoengine querysets, enabled only when the
+    client sends the cursor or the page size, so the endpoints keep their
+    plain list response otherwise. The view provides the ordering through
+    `get_list_ordering`.
+    """
+
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        params = request.query_params
+
+        if self.cursor_query_param not in params and \
+                self.page_size_query_param not in params:
+            return None
+
+        return super().get_page_size(request)
+
+    def get_ordering(self, request, queryset, view):
+        return (view.get_list_ordering(),)
+
+    def _get_position_from_instance(self, instance, ordering):
+        value = getattr(instance, ordering[0].lstrip('-'))
+
+        if isinstance(value, dt.datetime):
+            return value.isoformat()
+        return str(value)
@@ -0,0 +1,118 @@
+from collections import defaultdict
+
+from bson.dbref import DBRef
+from mongoengine.base import BaseDocument
+from mongoengine.fields import (ListField, ReferenceField,
+    EmbeddedDocumentField)
+
+
+def prefetch_references(documents, *paths):
+    """
+    Resolves the references of the given paths for every document with a
+    single `$in` query per level, like Django's prefetch_related. Paths use
+    the `field__subfield` syntax and may go through embedded documents:
+
+        prefetch_references(requests, 'know_fields', 'client__account',
+            'round_partners__partner__account')
+
+    The resolved documents are stored in the instances without marking
+    them as changed. Returns the documents as a list.
+    """
+    documents = list(documents)
+
+    for path in paths:
+        _prefetch(documents, path.split('__'))
+
+    return documents
+
+
+def _reference_id(value):
+    if isinstance(value, BaseDocument):
+        return value.pk
+    if isinstance(value, DBRef):
+        return value.id
+    return value
+
+
+def _prefetch(documents, names):
+    if not documents or not names:
+        return
+
+    name, rest = names[0], names[1:]
+    pending = defaultdict(set)
+    slots = list()
+    embedded = list()
+
+    for document in documents:
+        field = document._fields.get(name)
+        value = document._data.get(name)
+
+        if field is None or not value:
+            continue
+
+        many = isinstance(field, ListField)
+        inner = field.field if many else field
+        values = list(value) if many else [value]
+
+        if isinstance(inner, ReferenceField):
+            document_type = inner.document_type
+            pending[document_type].update(_reference_id(item) for item in values
+                if not isinstance(item, document_type))
+            slots.append((document, name, document_type, many))
+
+        elif isinstance(inner, EmbeddedDocumentField):
+            embedded.extend(values)
+
+    fetched = {document_type: document_type.objects.in_bulk(list(ids))
+        for document_type, ids in pending.items() if ids}
+
+    targets = list(embedded)
+    for document, name, document_type, many in slots:
+        found = fetched.get(document_type, {})
+
+        def resolve(item):
+            if isinstance(item, document_type):
+                return item
+            return found.get(_reference_id(item), item)
+
+        value = document._data.get(name)
+        if many:
+            value = [resolve(item) for item in value]
+        else:
+            value = resolve(value)
+
+        document._data[name] = value
+        targets.extend(item for item in (value if many else [value])
+            if isinstance(item, document_type))
+
+    _prefetch(targets, rest)
+
+
+class PrefetchMixin():
+    '''
+    Utility class to prefetch the references of the serialized lists and
+    instances by action, with one query per collection instead of one per
+    row. For example:
+    action_prefetch_related = {
+        ('list', ): ('know_fields', 'client__account'),
+    }
+    '''
+    action_prefetch_related = None
+
+    def get_prefetch_related(self):
+        for actions, paths in (self.action_prefetch_related or {}).items():
+            if self.action in actions:
+                return paths
+
+        return ()
+
+    def get_serializer(self, *args, **kwargs):
+        paths = self.get_prefetch_related()
+
+        if args and paths:
+            if kwargs.get('many'):
+                args = (prefetch_references(args[0], *paths), *args[1:])
+            elif args[0] is not None:
+                prefetch_references([args[0]], *paths)
+
+        return super().get_serializer(*args, **kwargs)
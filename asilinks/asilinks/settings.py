@@ -370,23 +370,27 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'check_partners_availability',
         'schedule': dt.timedelta(hours=2),
     },
-
-    # requesting/tasks.py
-    'refresh_round_partners': {
-        'task': 'refresh_round_partners',
-        'schedule': dt.timedelta(hours=6),
+    'rebuild_partner_scores': {
+        'task': 'rebuild_partner_scores',
+        'schedule': dt.timedelta(hours=24),
+    },
+    'rebuild_candidate_index': {
+        'task': 'rebuild_candidate_index',
+        'schedule': dt.timedelta(hours=24),
     },
-    'unsatisfied_requests': {
-        'task': 'unsatisfied_requests',
-        'schedule': dt.timedelta(hours=12),
+    'reconcile_open_opportunities': {
+        'task': 'reconcile_open_opportunities',
+        'schedule': dt.timedelta(hours=24),
     },
-    'failure_deadline_requests': {
-        'task': 'failure_deadline_requests',
-        'schedule': dt.timedelta(hours=12),
+
+    # requesting/tasks.py
+    'dispatch_deadlines': {
+        'task': 'dispatch_deadlines',
+        'schedule': dt.timedelta(minutes=1),
     },
-    'close_pending_requests': {
-        'task': 'close_pending_requests',
-        'schedule': dt.timedelta(hours=12),
+    'settle_pending_requests': {
+        'task': 'settle_pending_requests',
+        'schedule': dt.timedelta(minutes=10),
     },
     'clean_requests': {
         'task': 'clean_requests',
@@ -396,6 +400,24 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'requests_without_partners',
         'schedule': dt.timedelta(minutes=30),
     },
+
+    # payments/tasks.py
+    'rebuild_ledger_balances': {
+        'task': 'rebuild_ledger_balances',
+        'schedule': dt.timedelta(hours=24),
+    },
+    'record_pending_transactions': {
+        'task': 'record_pending_transactions',
+        'schedule': dt.timedelta(minutes=10),
+    },
+    'send_pending_payouts': {
+        'task': 'send_pending_payouts',
+        'schedule': dt.timedelta(minutes=10),
+    },
+    'reconcile_payouts': {
+        'task': 'reconcile_payouts',
+        'schedule': dt.timedelta(minutes=30),
+    },
 }
 
 # Notebook Settings
@@ -412,7 +434,30 @@ NOTEBOOK_ARGUMENTS = [
 DEFAULT_EMAIL_SPONSOR = 'sponsor@asilinks.com'
 DEFAULT_EMAIL_COMMISSIONS = 'fee.system@asilinks.com'
 PAYPAL_ACCOUNT = 'fee.paypal@asilinks.com'
+# Vigencia en cada proceso de la cache de las cuentas del sistema.
+SYSTEM_ACCOUNTS_CACHE_TIMEOUT = 300 # seconds
 DISABLE_VOID_KNOW_FIELDS = False
+PARTNER_SCORES_PATH = os.environ.get('PARTNER_SCORES_PATH',
+    os.path.join(BASE_DIR, 'partner_scores.npz'))
+# Intervalo minimo entre escrituras a disco de las puntuaciones cambiadas.
+PARTNER_SCORES_SAVE_INTERVAL = 60 # seconds
+# Penalizacion por oportunidades abiertas y tope por socio (0 sin tope).
+PARTNER_LOAD_PENALTY = float(os.environ.get('PARTNER_LOAD_PENALTY', 0.25))
+PARTNER_OPPORTUNITIES_CAP = int(os.environ.get('PARTNER_OPPORTUNITIES_CAP', 20))
+# Broker de eventos de los requerimientos y espera maxima del long-poll.
+REQUEST_EVENTS_BROKER = os.environ.get('REQUEST_EVENTS_BROKER',
+    'requesting.events.MongoEventBroker')
+REQUEST_EVENTS_TIMEOUT = 10 # seconds
+# Esperas simultaneas del long-poll por proceso, el resto responde al instante.
+REQUEST_EVENTS_MAX_LISTENERS = int(os.environ.get('REQUEST_EVENTS_MAX_LISTENERS', 4))
+REQUEST_DETAIL_CACHE_TIMEOUT = 600 # seconds
+# Maximo de ofertas por consulta de cotizaciones.
+PAYMENT_QUOTES_MAX = 100
+# Cola de payouts: items por lote, espera antes de reenviar un lote
+# abandonado con el mismo id e intentos antes de marcarlo fallido.
+PAYOUT_BATCH_SIZE = 500
+PAYOUT_SENDING_TIMEOUT = dt.timedelta(minutes=30)
+PAYOUT_MAX_ATTEMPTS = 5
 
 TESTS_THRESHOLD = {
     'BASE': 24,
@@ -1,20 +1,79 @@
+import os
+import shutil
 
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage
 from storages.backends.s3boto3 import S3Boto3Storage
 
 
-class PublicMediaStorage(S3Boto3Storage):
+class CopyS3Boto3Storage(S3Boto3Storage):
+    """
+    S3 storage able to copy objects inside the bucket without downloading
+    them: S3 copies the object server side.
+    """
+
+    def copy(self, source_name, name, source_storage=None):
+        source_storage = source_storage or self
+        name = self.get_available_name(name)
+
+        extra = {'ACL': self.default_acl} if self.default_acl else {}
+        self.bucket.Object(self._encode_name(self._normalize_name(
+            self._clean_name(name)))).copy({
+                'Bucket': source_storage.bucket_name,
+                'Key': source_storage._encode_name(source_storage._normalize_name(
+                    source_storage._clean_name(source_name))),
+            }, ExtraArgs=extra)
+
+        return self._clean_name(name)
+
+
+class PublicMediaStorage(CopyS3Boto3Storage):
     location = settings.AWS_PUBLIC_MEDIA_LOCATION
     file_overwrite = False
 
 
-class PublicOverrideMediaStorage(S3Boto3Storage):
+class PublicOverrideMediaStorage(CopyS3Boto3Storage):
     location = settings.AWS_PUBLIC_MEDIA_LOCATION
     file_overwrite = True
 
 
-class PrivateMediaStorage(S3Boto3Storage):
+class PrivateMediaStorage(CopyS3Boto3Storage):
     location = settings.AWS_PRIVATE_MEDIA_LOCATION
     default_acl = 'private'
     file_overwrite = False
     custom_domain = False
+
+
+def copy_file(source_storage, source_name, storage, name, move=False):
+    """
+    Copies, or moves, a stored file to `name` in the given storage and
+    returns the name it was saved with. S3 buckets copy server side and
+    the local filesystem copies or renames the file; other storages
+    stream the content by chunks.
+    """
+    if isinstance(storage, CopyS3Boto3Storage) and \
+            isinstance(source_storage, S3Boto3Storage):
+        name = storage.copy(source_name, name, source_storage)
+
+        if move:
+            source_storage.delete(source_name)
+        return name
+
+    if isinstance(storage, FileSystemStorage) and \
+            isinstance(source_storage, FileSystemStorage):
+        name = storage.get_available_name(name)
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if move:
+            shutil.move(source_storage.path(source_name), path)
+        else:
+            shutil.copyfile(source_storage.path(source_name), path)
+        return name
+
+    with source_storage.open(source_name) as content:
+        name = storage.save(name, content)
+
+    if move:
+        source_storage.delete(source_name)
+    return name
@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+
+from mongoengine.context_managers import query_counter
+
+
+class QueryCountMixin():
+    '''
+    Utility class for test cases to check the number of database queries
+    made inside a block. For example:
+    with self.assertMaxQueries(2):
+        self.client.get(url)
+    '''
+
+    @contextmanager
+    def assertMaxQueries(self, maximum):
+        with query_counter() as counter:
+            yield counter
+            count = int(counter)
+
+        self.assertLessEqual(count, maximum,
+            msg='{} queries made, expected at most {}.'.format(count, maximum))
@@ -53,6 +53,8 @@ urlpatterns = [
 
         url(r'^resources/academic_options/$', main_views.AcademicOptionsUserView.as_view()),
         url(r'^resources/payment_constants/$', main_views.PaymentConstantsView.as_view()),
+        url(r'^resources/payment_quotes/$', pay_views.PaymentQuotesView.as_view(),
+            name='payment-quotes'),
 
         # Admin app url
         url(r'^', include('admin.urls')),
@@ -1,4 +1,6 @@
+import copy
 import datetime as dt
+import time
 import pandas as pd
 from pytz import utc
 
@@ -12,6 +14,11 @@ from asilinks.storage_backends import PublicOverrideMediaStorage
 from authentication.models import AbstractUser
 
 
+# Cache por proceso de las cuentas del sistema, por correo: el documento
+# en crudo y el momento en que vence.
+_system_accounts = dict()
+
+
 class LegalDocs(document.EmbeddedDocument):
     juridical_person = fields.BooleanField(default=False)
 
@@ -108,17 +115,73 @@ class Account(AbstractUser):
     def has_partner_profile(self):
         return bool(self.partner_profile)
 
+    def save(self, *args, **kwargs):
+        # Si se guarda una cuenta del sistema, se recarga en el proximo uso.
+        # Los demas procesos la recargan al vencer su cache.
+        if any(raw['_id'] == self.pk for raw, _ in list(_system_accounts.values())):
+            Account.invalidate_system_accounts()
+
+        return super().save(*args, **kwargs)
+
+    @classmethod
+    def system_emails(cls):
+        return (settings.DEFAULT_EMAIL_COMMISSIONS, settings.DEFAULT_EMAIL_SPONSOR,
+            settings.PAYPAL_ACCOUNT)
+
+    @classmethod
+    def system_account(cls, email):
+        """
+        Returns a copy of the system account with the given email from the
+        process cache, loading it on first use and once the cache expires.
+        """
+        raw, expires = _system_accounts.get(email, (None, 0))
+
+        if raw is None or expires <= time.monotonic():
+            raw = cls.objects(email=email).as_pymongo().first()
+
+            if raw is None:
+                raise cls.DoesNotExist('system account {} not found'.format(email))
+            cls._cache_system_account(raw)
+
+        return cls._from_son(copy.deepcopy(raw))
+
+    @classmethod
+    def _cache_system_account(cls, raw):
+        _system_accounts[raw['email']] = (raw,
+            time.monotonic() + settings.SYSTEM_ACCOUNTS_CACHE_TIMEOUT)
+
+    @classmethod
+    def warm_system_accounts(cls):
+        """
+        Loads every system account with a single query. The missing ones
+        are left to fail on first use.
+        """
+        for raw in cls.objects(email__in=cls.system_emails()).as_pymongo():
+            cls._cache_system_account(raw)
+
+    @classmethod
+    def invalidate_system_accounts(cls, *emails):
+        for email in emails or list(_system_accounts):
+            _system_accounts.pop(email, None)
+
     @classmethod
     def default_fee_account(cls):
-        return cls.objects.get(email=settings.DEFAULT_EMAIL_COMMISSIONS)
+        return cls.system_account(settings.DEFAULT_EMAIL_COMMISSIONS)
 
     @classmethod
     def default_sponsor_account(cls):
-        return cls.objects.get(email=settings.DEFAULT_EMAIL_SPONSOR)
+        return cls.system_account(settings.DEFAULT_EMAIL_SPONSOR)
 
     @classmethod
     def paypal_fee_account(cls):
-        return cls.objects.get(email=settings.PAYPAL_ACCOUNT)
+        return cls.system_account(settings.PAYPAL_ACCOUNT)
+
+    def get_sponsor(self):
+        """
+        Returns the sponsor of the account, or the default sponsor account
+        that gets the fees of the accounts without one.
+        """
+        return self.sponsor or self.default_sponsor_account()
 
     def match_last_passwords(self, new_pass):
         """
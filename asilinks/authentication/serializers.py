@@ -27,6 +27,7 @@ from authentication.utils import email_token_generator
 from main.documents import Partner, Client, Competence, TestReview
 from main.serializers import CompetenceSerializer
 from payments.documents import Transaction
+from payments.tasks import send_pending_payouts
 from requesting.documents import Message
 from admin.documents import OpenSuggest
 
@@ -143,6 +144,7 @@ class AccountSerializer(ValidateRecaptchaMixin, DocumentSerializer):
         return instance
 
     def update(self, instance, validated_data):
+        previous_paypal_email = instance.paypal_email
         instance.paypal_email = validated_data.get('paypal_email', instance.email)
         instance.first_name = validated_data.get('first_name', instance.first_name)
         instance.last_name = validated_data.get('last_name', instance.last_name)
@@ -151,6 +153,11 @@ class AccountSerializer(ValidateRecaptchaMixin, DocumentSerializer):
         instance.gender = validated_data.get('gender', instance.gender)
         instance.save()
 
+        # Los pagos que fallaron por falta de correo vuelven a la cola.
+        if instance.paypal_email and instance.paypal_email != previous_paypal_email \
+                and Transaction.requeue_payouts(instance):
+            send_pending_payouts.delay()
+
         if 'avatar' in validated_data:
             name = 'asi-{}.{}'.format(instance.id, validated_data['avatar'].name.split('.')[-1])
             instance.avatar.save(name, validated_data.get('avatar'))
@@ -161,7 +168,8 @@ class AccountSerializer(ValidateRecaptchaMixin, DocumentSerializer):
 
         instance.client_profile.update(residence=instance.residence)
         if instance.has_partner_profile():
-            instance.partner_profile.update(residence=instance.residence)
+            instance.partner_profile.modify(residence=instance.residence)
+            instance.partner_profile.refresh_candidates()
 
         return instance
 
@@ -1,4 +1,7 @@
 
+from django.conf import settings
+from django.test import override_settings
+from mongoengine.context_managers import query_counter
 from rest_framework.test import APISimpleTestCase
 from rest_framework.reverse import reverse
 from rest_framework import status
@@ -330,3 +333,53 @@ class SelfResourcesTests(APISimpleTestCase):
         # intentando registrarlo nuevamente.
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SystemAccountsTests(APISimpleTestCase):
+
+    def tearDown(self):
+        Account.invalidate_system_accounts()
+        super().tearDown()
+
+    def test_cached_system_accounts(self):
+        """
+        Ensure system accounts are loaded once and reloaded after a save.
+        """
+        Account.invalidate_system_accounts()
+        Account.warm_system_accounts()
+
+        with query_counter() as queries:
+            sponsor = Account.default_sponsor_account()
+            Account.default_sponsor_account()
+            self.assertEqual(queries, 0)
+
+        self.assertEqual(sponsor.email, settings.DEFAULT_EMAIL_SPONSOR)
+
+        sponsor.save()
+        self.assertIsNot(Account.default_sponsor_account(), sponsor)
+        self.assertEqual(Account.default_sponsor_account().pk, sponsor.pk)
+
+    def test_system_accounts_are_copies(self):
+        """
+        Ensure callers can't change the cached system accounts.
+        """
+        sponsor = Account.default_sponsor_account()
+        sponsor.paypal_email = 'otro@asilinks.com'
+
+        self.assertNotEqual(Account.default_sponsor_account().paypal_email,
+            'otro@asilinks.com')
+
+    @override_settings(SYSTEM_ACCOUNTS_CACHE_TIMEOUT=0)
+    def test_system_accounts_expire(self):
+        """
+        Ensure changes made by other processes are read once the cache expires.
+        """
+        sponsor = Account.default_sponsor_account()
+        paypal_email = sponsor.paypal_email
+
+        try:
+            Account.objects(pk=sponsor.pk).update_one(set__paypal_email='otro@asilinks.com')
+            self.assertEqual(Account.default_sponsor_account().paypal_email,
+                'otro@asilinks.com')
+        finally:
+            Account.objects(pk=sponsor.pk).update_one(set__paypal_email=paypal_email)
@@ -42,16 +42,29 @@ class Device(document.Document):
 
 class FCMDeviceQuerySet(queryset.QuerySet):
     def send_message(self, title=None, body=None, icon=None, data=None, sound=None, badge=None, api_key=None, **kwargs):
+        """
+        Sends the message to the active devices of the queryset, reading
+        their tokens with a single query and sending one multicast per
+        chunk of MAX_RECIPIENTS tokens. Devices whose token failed are
+        deactivated with a single update.
+        """
         title, body = format_content(title, body, context=kwargs.pop('context', {}))
 
-        if self:
+        reg_ids = [reg_id for reg_id in self(active=True).distinct('registration_id')
+            if reg_id]
+        summary = {'success': 0, 'failure': 0, 'canonical_ids': 0, 'results': []}
 
-            reg_ids = list(self(active=True).values_list('registration_id'))
-            if len(reg_ids) == 0:
-                return [{'failure': len(self), 'success': 0}]
+        if not reg_ids:
+            return summary
+
+        chunk_size = SETTINGS["MAX_RECIPIENTS"]
+        failed = []
+
+        for start in range(0, len(reg_ids), chunk_size):
+            chunk = reg_ids[start:start + chunk_size]
 
             result = fcm_send_bulk_message(
-                registration_ids=reg_ids,
+                registration_ids=chunk,
                 title=title,
                 body=body,
                 icon=icon,
@@ -62,16 +75,21 @@ class FCMDeviceQuerySet(queryset.QuerySet):
                 **kwargs
             )
 
-            results = result['results']
-            for (index, item) in enumerate(results):
-                
-                if 'error' in item:
-                    reg_id = reg_ids[index]
-                    self(registration_id=reg_id).update(active=False)
+            for key in ('success', 'failure', 'canonical_ids'):
+                summary[key] += result.get(key, 0)
+            summary['results'].extend(result['results'])
+
+            failed.extend(reg_id for reg_id, item in zip(chunk, result['results'])
+                if 'error' in item)
+
+        if failed:
+            devices = self(registration_id__in=failed)
+            devices.update(active=False)
+
+            if SETTINGS["DELETE_INACTIVE_DEVICES"]:
+                devices.delete()
 
-                    if SETTINGS["DELETE_INACTIVE_DEVICES"]:
-                        self(registration_id=reg_id).delete()
-            return result
+        return summary
 
 
 class FCMDevice(Device):
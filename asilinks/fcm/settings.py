@@ -8,6 +8,8 @@ FCM_DJANGO_SETTINGS.setdefault("FCM_SERVER", "https://fcm.googleapis.com/fcm/sen
 FCM_DJANGO_SETTINGS.setdefault("FCM_SERVER_KEY", None)
 FCM_DJANGO_SETTINGS.setdefault("ONE_DEVICE_PER_USER", False)
 FCM_DJANGO_SETTINGS.setdefault("DELETE_INACTIVE_DEVICES", False)
+# Tokens por llamada multicast
+FCM_DJANGO_SETTINGS.setdefault("MAX_RECIPIENTS", 500)
 
 # User model
 FCM_DJANGO_SETTINGS.setdefault("USER_MODEL", settings.AUTH_USER_MODEL)
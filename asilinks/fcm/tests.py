@@ -1,3 +1,39 @@
-from django.test import TestCase
+from unittest import mock
+
+from bson.objectid import ObjectId
+from rest_framework.test import APISimpleTestCase
+
+from .documents import FCMDevice
 
 # Create your tests here.
+
+class MulticastTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owners = [ObjectId(), ObjectId()]
+        FCMDevice.objects.insert([FCMDevice(owner=self.owners[i % 2], active=True,
+            registration_id='test-token-{}'.format(i), type='android')
+            for i in range(1200)])
+
+    def tearDown(self):
+        FCMDevice.objects(owner__in=self.owners).delete()
+        super().tearDown()
+
+    def test_chunked_multicast(self):
+        """
+        Ensure tokens are sent in chunks of 500 and failures are deactivated.
+        """
+        def send(registration_ids, **kwargs):
+            return {'success': 0, 'failure': 0, 'canonical_ids': 0,
+                'results': [{'error': 'NotRegistered'} if token.endswith('7')
+                    else {'message_id': token} for token in registration_ids]}
+
+        with mock.patch('fcm.documents.fcm_send_bulk_message', side_effect=send) as bulk:
+            result = FCMDevice.objects(owner__in=self.owners).send_message(
+                title='titulo', body='cuerpo')
+
+        self.assertEqual([len(call[1]['registration_ids']) for call in bulk.call_args_list],
+            [500, 500, 200])
+        self.assertEqual(len(result['results']), 1200)
+        self.assertEqual(FCMDevice.objects(owner__in=self.owners, active=False).count(), 120)
@@ -1,19 +1,23 @@
 import datetime as dt
+from collections import defaultdict
 from functools import reduce
 
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from mongoengine import fields, document, CASCADE, NULLIFY, PULL
+from bson.objectid import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from asilinks.storage_backends import PublicOverrideMediaStorage, PrivateMediaStorage
 from asilinks.fields import LocalStorageFileField
 from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
-from authentication.documents import Account
+from authentication.documents import Account, Location
 
 
 __all__ = ['Client', 'Partner', 'AcademicOptions', 'PartnerStatisticalSummary',
     'Academic', 'Test', 'Category', 'KnowField', 'Competence', 'FavoritePartner',
-    'PartnerSkill']
+    'PartnerSkill', 'CandidateIndex']
 
 
 class KnowField(document.Document):
@@ -99,6 +103,7 @@ class Partner(document.Document):
     requests_todo = fields.ListField(fields.ReferenceField('Request'))
     requests_in_progress = fields.ListField(fields.ReferenceField('Request'))
     requests_rejected = fields.ListField(fields.ReferenceField('Request'))
+    open_opportunities = fields.IntField(min_value=0, default=0)
     requests_done = fields.ListField(fields.ReferenceField('Request'))
     requests_canceled = fields.ListField(fields.ReferenceField('Request'))
 
@@ -150,6 +155,76 @@ class Partner(document.Document):
             summary['offered_percent'] = 0
 
         self.modify(statistical_summary=summary)
+        self.refresh_score()
+
+    def refresh_score(self):
+        from .scoring import partner_scores
+        partner_scores.update(self)
+
+    def refresh_candidates(self):
+        CandidateIndex.index_partner(self)
+
+    @classmethod
+    def send_multicast(cls, partners, *args, **kwargs):
+        """
+        Sends one multicast message to the devices of all the given
+        partners, as documents or ids, reading their accounts in one query.
+        """
+        from fcm.documents import FCMDevice
+
+        ids = [getattr(partner, 'pk', partner) for partner in partners]
+        accounts = [raw['account'] for raw in cls.objects(id__in=ids)
+            .only('account').as_pymongo() if raw.get('account')]
+
+        return FCMDevice.objects(owner__in=accounts).send_message(*args, **kwargs)
+
+    @classmethod
+    def push_opportunity(cls, bulk, partner_id, request_id):
+        """
+        Queues the request in requests_todo, incrementing the open
+        opportunities counter in the same operation only if it was not there.
+        """
+        bulk.update_id(cls, partner_id, query={'requests_todo': {'$ne': request_id}},
+            push__requests_todo=request_id, inc__open_opportunities=1)
+
+    @classmethod
+    def pull_opportunity(cls, bulk, partner_id, request_id):
+        """
+        Queues the removal of the request from requests_todo, decrementing
+        the open opportunities counter in the same operation only if it was
+        there. A counter not backfilled yet, or already in 0, is not
+        decremented, so it never goes negative.
+        """
+        bulk.update_id(cls, partner_id, query={'requests_todo': request_id,
+                'open_opportunities': {'$gt': 0}},
+            pull__requests_todo=request_id, inc__open_opportunities=-1)
+        bulk.update_id(cls, partner_id, query={'requests_todo': request_id,
+                'open_opportunities': {'$not': {'$gt': 0}}},
+            pull__requests_todo=request_id)
+
+    @classmethod
+    def reconcile_open_opportunities(cls):
+        """
+        Resets the open opportunities counters that drifted from the size
+        of requests_todo, and backfills the missing ones. Each counter is set
+        only if neither it nor requests_todo changed since they were read.
+        """
+        pipeline = [
+            {'$project': {'count': {'$size': {'$ifNull': ['$requests_todo', []]}},
+                'open_opportunities': 1}},
+            {'$match': {'$expr': {'$ne': ['$count',
+                {'$ifNull': ['$open_opportunities', -1]}]}}},
+        ]
+
+        operations = [UpdateOne({'_id': raw['_id'], 'requests_todo': {'$size': raw['count']},
+                'open_opportunities': raw['open_opportunities']
+                    if 'open_opportunities' in raw else {'$exists': False}},
+            {'$set': {'open_opportunities': raw['count']}})
+            for raw in cls.objects.aggregate(*pipeline)]
+
+        if operations:
+            cls._get_collection().bulk_write(operations, ordered=False)
+        return len(operations)
 
     @property
     def has_levelup_chance(self):
@@ -167,6 +242,7 @@ class Partner(document.Document):
             return
         elif level_weights[self.level] > level_weights[new_level]:
             self.modify(level=new_level)
+            self.refresh_score()
             self.account.send_message(context={'partner': self}, **PARTNER_MESSAGES['level_down'])
         else:
             tests = self.tests_review.filter(
@@ -177,12 +253,108 @@ class Partner(document.Document):
                 self.account.send_message(context={'partner': self}, **PARTNER_MESSAGES['test_available'])
             elif tests.filter(approve=True):
                 self.modify(level=new_level)
+                self.refresh_score()
                 self.account.send_message(context={'partner': self}, **PARTNER_MESSAGES['level_back'])
 
 
 Partner.register_delete_rule(Account, 'partner_profile', NULLIFY)
 
 
+class CandidateIndex(document.Document):
+    """
+    Materialized index of enabled partners ids by know field and country
+    of residence, used to find round partners candidates with a single read.
+    Each change of a partner stamps the entries it touches, so a rebuild
+    does not overwrite or remove entries changed after it started.
+    """
+    know_field = fields.ReferenceField('KnowField', reverse_delete_rule=CASCADE)
+    alpha2 = fields.StringField(max_length=2, null=True)
+    partners = fields.ListField(fields.ObjectIdField())
+    updated = fields.DateTimeField()
+    rebuild_id = fields.ObjectIdField()
+
+    meta = {'indexes': [
+        {'fields': ['know_field', 'alpha2'], 'unique': True},
+        'partners',
+    ]}
+
+    @classmethod
+    def index_partner(cls, partner):
+        """
+        Replaces the entries of the partner according to its current
+        know fields, residence and enabled flag.
+        """
+        now = dt.datetime.now()
+        operations = [UpdateMany({'partners': partner.id},
+            {'$pull': {'partners': partner.id}, '$set': {'updated': now}})]
+
+        if partner.enabled:
+            alpha2 = partner.residence.alpha2_code if partner.residence else None
+            operations.extend([UpdateOne(
+                {'know_field': know_field, 'alpha2': alpha2},
+                {'$addToSet': {'partners': partner.id}, '$set': {'updated': now}},
+                upsert=True)
+                for know_field in partner.to_mongo().get('know_fields', [])])
+
+        cls._get_collection().bulk_write(operations, ordered=True)
+
+    @classmethod
+    def discard_partners(cls, ids):
+        cls.objects(partners__in=ids).update(pull_all__partners=ids,
+            set__updated=dt.datetime.now())
+
+    @classmethod
+    def lookup(cls, know_fields, alpha2=None):
+        """
+        Returns the set of enabled partners ids with any of the know fields,
+        residing in the given country when it is set.
+        """
+        filters = {'know_field__in': know_fields}
+
+        if alpha2:
+            filters['alpha2'] = alpha2
+
+        return {partner_id for partners in cls.objects(**filters).scalar('partners')
+            for partner_id in partners}
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Rewrites the index from the enabled partners. The entries changed
+        by a partner after the rebuild started are left as they are, and
+        the entries not written by the rebuild are deleted on the server.
+        """
+        started = dt.datetime.now()
+        rebuild_id = ObjectId()
+        unchanged = {'$or': [{'updated': {'$lt': started}},
+            {'updated': {'$exists': False}}]}
+
+        locations = dict(Location.objects.scalar('id', 'alpha2_code'))
+        entries = defaultdict(set)
+
+        for raw in Partner.objects.filter(enabled=True).only(
+                'residence', 'know_fields').as_pymongo():
+            alpha2 = locations.get(raw.get('residence'))
+            for know_field in raw.get('know_fields', []):
+                entries[(know_field, alpha2)].add(raw['_id'])
+
+        collection = cls._get_collection()
+        if entries:
+            try:
+                collection.bulk_write([UpdateOne(
+                    dict(unchanged, know_field=know_field, alpha2=alpha2),
+                    {'$set': {'partners': list(ids), 'rebuild_id': rebuild_id}},
+                    upsert=True) for (know_field, alpha2), ids in entries.items()],
+                    ordered=False)
+            except BulkWriteError as error:
+                # Las entradas que cambiaron durante la reconstruccion no
+                # coinciden con el filtro y su upsert choca con la existente.
+                if any(item['code'] != 11000 for item in error.details['writeErrors']):
+                    raise
+
+        collection.delete_many(dict(unchanged, rebuild_id={'$ne': rebuild_id}))
+
+
 class FavoritePartner(document.EmbeddedDocument):
     partner = fields.ReferenceField('Partner')
     know_field = fields.ReferenceField('KnowField')
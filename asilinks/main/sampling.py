@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def get_random_state(seed=None):
+    """
+    Returns a RandomState for the given seed. An existing RandomState is
+    returned as is, so callers can share one generator.
+    """
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def weighted_sample(weights, n, random_state=None):
+    """
+    Weighted random sample without replacement using the Efraimidis-Spirakis
+    keys method: each item gets the key u ** (1 / w) and the n greatest keys
+    are selected. Items with zero weight are never selected.
+    Returns the positions of the selected items.
+    """
+    weights = np.asarray(weights, dtype=float)
+    n = min(n, np.count_nonzero(weights > 0))
+
+    if n <= 0:
+        return np.empty(0, dtype=int)
+
+    random_state = get_random_state(random_state)
+
+    # Se usa log(u) / w en lugar de u ** (1 / w) para evitar underflow.
+    with np.errstate(divide='ignore'):
+        keys = np.log(random_state.random_sample(len(weights))) / weights
+    keys[weights <= 0] = -np.inf
+
+    chosen = np.argpartition(-keys, n - 1)[:n]
+    return chosen[np.argsort(-keys[chosen])]
+
+
+def stratified_sample(strata, weights, samples, levels, random_state=None,
+        factors=None):
+    """
+    Draws up to `samples` items of each of the given levels, weighted and
+    without replacement. Levels where every weight is zero are sampled
+    uniformly. Optional `factors` scale the weights after that fallback.
+    Returns the positions of the selected items.
+    """
+    strata = np.asarray(strata)
+    weights = np.asarray(weights, dtype=float)
+    random_state = get_random_state(random_state)
+
+    selected = []
+    for level in levels:
+        positions = np.flatnonzero(strata == level)
+        part = weights[positions]
+
+        # En condiciones iniciales cero, inicializa los pesos en 1.
+        if part.sum() == 0:
+            part = np.ones(len(part))
+
+        if factors is not None:
+            part = part * factors[positions]
+
+        selected.append(positions[weighted_sample(part, samples, random_state)])
+
+    return np.concatenate(selected) if selected else np.empty(0, dtype=int)
@@ -0,0 +1,305 @@
+import atexit
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from django.conf import settings
+
+from .documents import Partner
+from .sampling import stratified_sample
+
+
+class CapacityModel(object):
+    """
+    Spreads the opportunities across the partners pool: the weight of each
+    partner is divided by 1 + penalty * open opportunities, and partners
+    that reached the cap are not eligible.
+    """
+
+    def __init__(self, penalty=None, cap=None):
+        self._penalty = penalty
+        self._cap = cap
+
+    @property
+    def penalty(self):
+        return settings.PARTNER_LOAD_PENALTY if self._penalty is None else self._penalty
+
+    @property
+    def cap(self):
+        return settings.PARTNER_OPPORTUNITIES_CAP if self._cap is None else self._cap
+
+    def available(self, load):
+        if not self.cap:
+            return np.ones(len(load), dtype=bool)
+        return np.maximum(load, 0) < self.cap
+
+    def factors(self, load):
+        # Un contador desfasado no puede aumentar el peso del socio.
+        return 1 / (1 + self.penalty * np.maximum(load, 0))
+
+
+class PartnerScoreEngine(object):
+    """
+    Keeps the partners statistical summary as NumPy arrays, in memory and
+    persisted on disk, so round partner selection does not rebuild a
+    DataFrame on every request. Updated rows are kept in memory and saved
+    in batches: the writer holds a lock file shared by every process and
+    replaces the stored file atomically, so readers never see a partial
+    file and concurrent updates are not lost.
+    """
+
+    FEATURES = (
+        'done_count',
+        'done_time_average',
+        'canceled_count',
+        'offered_percent',
+        'done_score_average',
+        'academics_count',
+        'experience_years',
+        'accept_time_average',
+        'price_average',
+    )
+
+    WEIGHTS = np.array([0.1, 0.15, 0.15, 0.1, 0.2, 0.05, 0.05, 0.1, 0.1])
+
+    # Campos que se normalizan de forma inversa (menor es mejor).
+    INVERSE = np.array([False, True, True, False, False,
+        False, False, False, False])
+
+    SAMPLE_LEVELS = (Partner.LEVEL_BRONZE, Partner.LEVEL_SILVER, Partner.LEVEL_GOLD)
+
+    def __init__(self, path=None, capacity=None, save_interval=None):
+        self.path = path
+        self.capacity = capacity or CapacityModel()
+        self._save_interval = save_interval
+        self._lock = threading.RLock()
+        self._file_locked = 0
+        self._mtime = None
+        self._pending = {}
+        self._saved = time.monotonic()
+        self._reset()
+
+    def _reset(self):
+        self.ids = np.empty(0, dtype='U24')
+        self.levels = np.empty(0, dtype='U10')
+        self.features = np.empty((0, len(self.FEATURES)))
+        self.index = {}
+
+    def get_path(self):
+        return self.path or settings.PARTNER_SCORES_PATH
+
+    @property
+    def save_interval(self):
+        return (settings.PARTNER_SCORES_SAVE_INTERVAL
+            if self._save_interval is None else self._save_interval)
+
+    @property
+    def dirty(self):
+        return bool(self._pending)
+
+    def load(self):
+        """
+        Reloads the matrix from disk when the stored file is newer than
+        the one in memory, keeping the rows updated and not saved yet.
+        """
+        path = self.get_path()
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+
+        if self._mtime is not None and mtime <= self._mtime:
+            return False
+
+        with self._lock, np.load(path) as stored:
+            self.ids = stored['ids']
+            self.levels = stored['levels']
+            self.features = stored['features']
+            self.index = {key: row for row, key in enumerate(self.ids)}
+            self._mtime = mtime
+            self._upsert(self._pending.items())
+
+        return True
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the thread lock and the lock file of the stored matrix, so a
+        single writer of any process reads, changes and saves it at a time.
+        """
+        with self._lock:
+            if self._file_locked:
+                self._file_locked += 1
+                try:
+                    yield
+                finally:
+                    self._file_locked -= 1
+                return
+
+            with open('{}.lock'.format(self.get_path()), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._file_locked = 1
+                try:
+                    yield
+                finally:
+                    self._file_locked = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        path = self.get_path()
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        with self.locked():
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, ids=self.ids, levels=self.levels,
+                    features=self.features)
+            os.replace(tmp_path, path)
+            self._mtime = os.stat(path).st_mtime_ns
+            self._pending = {}
+            self._saved = time.monotonic()
+
+    def to_row(self, partner):
+        summary = partner.statistical_summary
+
+        if summary is None:
+            return np.full(len(self.FEATURES), np.nan)
+
+        return np.array([np.nan if getattr(summary, key) is None
+            else getattr(summary, key) for key in self.FEATURES], dtype=float)
+
+    def to_items(self, partners):
+        return [(str(partner.id), (partner.level, self.to_row(partner)))
+            for partner in partners]
+
+    def update(self, *partners):
+        """
+        Inserts or replaces the rows of the given partners in memory and
+        marks them to be saved. The stored matrix is written at most once
+        per save interval; `flush` writes it right away.
+        """
+        items = self.to_items(partners)
+
+        with self._lock:
+            self.load()
+            self._pending.update(items)
+            self._upsert(items)
+
+            if time.monotonic() - self._saved >= self.save_interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Saves the rows updated since the last save. The stored matrix is
+        reloaded under the lock file first, so the rows written by other
+        processes are kept.
+        """
+        with self._lock:
+            if not self._pending:
+                return False
+
+            with self.locked():
+                self.load()
+                self.save()
+
+        return True
+
+    def _upsert(self, items):
+        new_ids, new_levels, new_rows = [], [], []
+
+        for key, (level, values) in items:
+            row = self.index.get(key)
+
+            if row is None:
+                new_ids.append(key)
+                new_levels.append(level)
+                new_rows.append(values)
+            else:
+                self.levels[row] = level
+                self.features[row] = values
+
+        if new_ids:
+            offset = len(self.ids)
+            self.ids = np.concatenate([self.ids, np.array(new_ids, dtype='U24')])
+            self.levels = np.concatenate([self.levels, np.array(new_levels, dtype='U10')])
+            self.features = np.vstack([self.features, np.array(new_rows)])
+            self.index.update({key: offset + i for i, key in enumerate(new_ids)})
+
+    def ensure(self, ids):
+        """
+        Loads from database, in a single query, the rows that are not
+        present in the matrix yet. They are kept in memory only, the next
+        rebuild stores them.
+        """
+        with self._lock:
+            self.load()
+            missing = [key for key in ids if key not in self.index]
+
+            if missing:
+                self._upsert(self.to_items(Partner.objects.filter(id__in=missing)
+                    .only('id', 'level', 'statistical_summary')))
+
+    def rebuild(self):
+        with self.locked():
+            self._reset()
+            self._upsert(self.to_items(
+                Partner.objects.only('id', 'level', 'statistical_summary')))
+            self.save()
+
+    def rows(self, ids):
+        return np.array([self.index[key] for key in ids if key in self.index],
+            dtype=int)
+
+    def scores(self, rows):
+        """
+        Normalizes the features of the given rows against themselves and
+        returns the weighted sum for each one.
+        """
+        part = self.features[rows]
+
+        if not len(part):
+            return np.empty(0)
+
+        with np.errstate(invalid='ignore', divide='ignore', all='ignore'):
+            low = np.nanmin(part, axis=0)
+            high = np.nanmax(part, axis=0)
+            span = high - low
+
+            normalized = np.where(self.INVERSE, high - part, part - low) / span
+
+        # Las columnas sin variacion o sin datos no aportan al peso.
+        normalized[~np.isfinite(normalized)] = 0
+        return normalized.dot(self.WEIGHTS)
+
+    def select(self, ids, samples=4, random_state=None, loads=None):
+        """
+        Returns the ids of a weighted random sample of partners of each
+        level, without replacement. When `loads` maps the ids to their open
+        opportunities, the capacity model is applied to the weights.
+        """
+        ids = [str(key) for key in ids]
+        self.ensure(ids)
+
+        rows = self.rows(ids)
+        factors = None
+
+        if loads is not None:
+            load = np.array([loads.get(key, 0) for key in self.ids[rows]], dtype=float)
+            available = self.capacity.available(load)
+            rows = rows[available]
+            factors = self.capacity.factors(load[available])
+
+        chosen = stratified_sample(self.levels[rows], self.scores(rows),
+            samples, self.SAMPLE_LEVELS, random_state=random_state,
+            factors=factors)
+
+        return list(self.ids[rows[chosen]])
+
+
+partner_scores = PartnerScoreEngine()
+# Guarda al salir del proceso las puntuaciones pendientes.
+atexit.register(partner_scores.flush)
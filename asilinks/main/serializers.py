@@ -9,7 +9,6 @@ from rest_framework.reverse import reverse
 from rest_framework.exceptions import ValidationError
 from rest_framework import serializers, fields
 
-from mongoengine.queryset.visitor import Q
 from rest_framework_mongoengine.serializers import (
     DocumentSerializer, EmbeddedDocumentSerializer)
 
@@ -19,7 +18,7 @@ from .documents import (Client, Partner, AcademicOptions, Academic,
     Test, Category, KnowField, Competence, FavoritePartner, DraftRequest,
     PartnerSkill, ExtraDescription, TestReview)
 from authentication.documents import Account
-from payments. documents import Transaction
+from payments. documents import Transaction, LedgerBalance
 from requesting.documents import Request, Message
 
 from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
@@ -61,12 +60,10 @@ class SelfClientSerializer(DocumentSerializer):
         }
 
     def get_earned_money(self, instance):
-        return round(Transaction.objects.filter(
-            Q(receiver=instance.account,
-              operation=Transaction.OP_SPONSOR_FEE) |
-            Q(owner=instance.account,
-              operation=Transaction.OP_PARTNER_SETTLEMENT)
-            ).sum('amount'), 2)
+        # Los pagos en cola o fallidos aun no llegan a la cuenta.
+        return round(LedgerBalance.balance((Transaction.OP_SPONSOR_FEE,
+            Transaction.OP_PARTNER_SETTLEMENT), instance.account)
+            - Transaction.unpaid_payouts(instance.account), 2)
 
 class CompletedPaymentsSerializer(DocumentSerializer):
     item_ref = fields.ReadOnlyField(source='item.name', default='')
@@ -85,7 +82,7 @@ class PendingPaymentsSerializer(DocumentSerializer):
         fields = ('amount', 'date', 'item_ref', )
 
     def get_amount(self, instance):
-        return instance.calculate_bill()['to_pay']
+        return instance.get_bill()['to_pay']
 
 
 class SelfClientStatisticsSerializer(DocumentSerializer):
@@ -145,13 +142,14 @@ class SelfClientStatisticsSerializer(DocumentSerializer):
         return {
             'completed_payments': CompletedPaymentsSerializer(
                 completed_payments, many=True).data,
-            'completed_payments_sum': completed_payments.sum('amount'),
+            'completed_payments_sum': LedgerBalance.balance(
+                Transaction.DEBIT_OPS, instance.account),
             'pending_payments': PendingPaymentsSerializer(
                 instance.requests_in_progress, many=True).data,
-            'pending_payments_sum': sum([req.calculate_bill()['to_pay'] \
+            'pending_payments_sum': sum([req.get_bill()['to_pay'] \
                 for req in instance.requests_in_progress]),
-            'referral_earnings_sum': Transaction.objects.filter(receiver=instance.account,
-                operation=Transaction.OP_SPONSOR_FEE).sum('amount'),
+            'referral_earnings_sum': LedgerBalance.balance(
+                (Transaction.OP_SPONSOR_FEE, ), instance.account),
         }
 
 
@@ -206,13 +204,14 @@ class SelfPartnerStatisticsSerializer(DocumentSerializer):
         return {
             'completed_payments': CompletedPaymentsSerializer(
                 completed_payments, many=True).data,
-            'completed_payments_sum': completed_payments.sum('amount'),
+            'completed_payments_sum': LedgerBalance.balance(
+                (Transaction.OP_PARTNER_SETTLEMENT, ), instance.account),
             'pending_payments': PendingPaymentsSerializer(
                 instance.requests_in_progress, many=True).data,
-            'pending_payments_sum': sum([req.calculate_bill()['to_pay'] \
+            'pending_payments_sum': sum([req.get_bill()['to_pay'] \
                 for req in instance.requests_in_progress]),
-            'referral_earnings_sum': Transaction.objects.filter(receiver=instance.account,
-                operation=Transaction.OP_SPONSOR_FEE).sum('amount'),
+            'referral_earnings_sum': LedgerBalance.balance(
+                (Transaction.OP_SPONSOR_FEE, ), instance.account),
         }
 
 
@@ -289,6 +288,10 @@ class SelfPartnerSerializer(DocumentSerializer):
 
     def update(self, instance, validated_data):
         instance.modify(**validated_data)
+
+        if 'know_fields' in validated_data:
+            instance.refresh_candidates()
+
         return instance
 
 
@@ -447,6 +450,7 @@ class LevelUpPartnerSerializer(DocumentSerializer):
                 **PARTNER_MESSAGES['level_up'])
         instance.tests_review.append(test)
         instance.save()
+        instance.refresh_score()
 
         return instance
 
@@ -6,8 +6,9 @@ import logging
 from celery import shared_task
 
 from main.documents import (Partner, KnowField,
-    Category, PartnerStatisticalSummary)
+    Category, PartnerStatisticalSummary, CandidateIndex)
 from requesting.tasks import calc_partners_weights
+from main.scoring import partner_scores
 
 from authentication.documents import Account
 
@@ -65,6 +66,7 @@ def partners_levelup_selection():
     df['close_distance'] = euclidean_distance.idxmin(axis=1)
     df.query('level != close_distance').apply(axis=1,
         func=lambda x: x.name.change_level(x.close_distance))
+    partner_scores.flush()
 
 
 def partners_levelup_manual(level, n=5):
@@ -140,7 +142,33 @@ def eject_partner():
         ((df['total'] < 1000) & (df['total'] >= 50) & (df['canceled_rate'] > 0.05)) |
         ((df['total'] >= 1000) & (df['canceled_rate'] > 0.01))
     ]
-    Partner.objects(id__in=list(unsubscribe_df['id'])).modify(enabled=False)
+    ids = list(unsubscribe_df['id'])
+    Partner.objects(id__in=ids).update(enabled=False)
+    CandidateIndex.discard_partners(ids)
+
+@shared_task(name='rebuild_partner_scores')
+def rebuild_partner_scores():
+    """
+    Rebuilds the persisted partner score matrix from database.
+    """
+    partner_scores.rebuild()
+
+
+@shared_task(name='rebuild_candidate_index')
+def rebuild_candidate_index():
+    """
+    Rebuilds the partners candidate index by know field and country.
+    """
+    CandidateIndex.rebuild()
+
+
+@shared_task(name='reconcile_open_opportunities')
+def reconcile_open_opportunities():
+    """
+    Realigns the partners open opportunities counters with requests_todo.
+    """
+    return Partner.reconcile_open_opportunities()
+
 
 @shared_task(name='check_partners_availability')
 def check_partners_availability():
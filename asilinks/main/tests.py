@@ -1,12 +1,29 @@
 
+import os
+import logging
+import datetime as dt
+import tempfile
+import timeit
+import unittest
+
+import numpy as np
+import pandas as pd
+from bson.objectid import ObjectId
+
 from rest_framework.test import APISimpleTestCase
 from rest_framework.reverse import reverse
 from rest_framework import status
 
-from .documents import Client, Partner
+from asilinks.bulk import BulkUpdate
+from .documents import Client, Partner, PartnerStatisticalSummary, CandidateIndex, KnowField
+from .sampling import weighted_sample, stratified_sample
+from .scoring import PartnerScoreEngine, CapacityModel
 from requesting.documents import Request
+from requesting.tasks import calc_partners_weights
 from authentication.documents import Account
 
+logger = logging.getLogger(__name__)
+
 # Create your tests here.
 
 class ProfileConsistencyTests(APISimpleTestCase):
@@ -29,3 +46,280 @@ class ProfileConsistencyTests(APISimpleTestCase):
         for account in Account.objects.all():
             with self.subTest(account=account):
                 self.assertIsInstance(account.client_profile, Client)
+
+
+class CandidateIndexTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.know_fields = [KnowField(category='indice', sub_category=str(i)).save()
+            for i in range(3)]
+        self.partners = [Partner.objects.create(level=Partner.LEVEL_BRONZE,
+                enabled=enabled, know_fields=know_fields)
+            for enabled, know_fields in ((True, self.know_fields[:2]),
+                (True, self.know_fields[1:2]), (False, self.know_fields[:1]))]
+
+    def tearDown(self):
+        for partner in self.partners:
+            partner.delete()
+        for know_field in self.know_fields:
+            CandidateIndex.objects(know_field=know_field).delete()
+            know_field.delete()
+        super().tearDown()
+
+    def test_candidate_index(self):
+        """
+        Ensure the rebuild indexes the enabled partners by their know fields.
+        """
+        CandidateIndex.rebuild()
+        enabled, other, disabled = [partner.id for partner in self.partners]
+
+        self.assertEqual(CandidateIndex.lookup([self.know_fields[0].id]), {enabled})
+        self.assertEqual(CandidateIndex.lookup([self.know_fields[1].id]), {enabled, other})
+        self.assertEqual(CandidateIndex.lookup([self.know_fields[2].id]), set())
+
+    def test_rebuild_keeps_concurrent_changes(self):
+        """
+        Ensure the rebuild deletes stale entries but keeps the ones changed
+        after it started.
+        """
+        stale = CandidateIndex(know_field=self.know_fields[2], alpha2='VE',
+            partners=[ObjectId()], updated=dt.datetime(2019, 1, 1)).save()
+        added = ObjectId()
+        changed = CandidateIndex(know_field=self.know_fields[1], alpha2=None,
+            partners=[added], updated=dt.datetime.now() + dt.timedelta(hours=1)).save()
+
+        CandidateIndex.rebuild()
+
+        self.assertFalse(CandidateIndex.objects(id=stale.id).count())
+        self.assertEqual(CandidateIndex.objects.get(id=changed.id).partners, [added])
+
+
+class OpenOpportunitiesTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.partner = Partner.objects.create(level=Partner.LEVEL_BRONZE, enabled=False)
+        self.requests = [ObjectId(), ObjectId()]
+
+    def tearDown(self):
+        self.partner.delete()
+        super().tearDown()
+
+    def test_counter_never_negative(self):
+        """
+        Ensure a counter that was not backfilled is not decremented below 0
+        and the reconcile backfills it.
+        """
+        Partner._get_collection().update_one({'_id': self.partner.id},
+            {'$set': {'requests_todo': self.requests}, '$unset': {'open_opportunities': ''}})
+
+        with BulkUpdate() as bulk:
+            Partner.pull_opportunity(bulk, self.partner.id, self.requests[0])
+
+        raw = Partner.objects(id=self.partner.id).as_pymongo().first()
+        self.assertEqual(raw['requests_todo'], self.requests[1:])
+        self.assertNotIn('open_opportunities', raw)
+
+        Partner.reconcile_open_opportunities()
+        self.assertEqual(Partner.objects.get(id=self.partner.id).open_opportunities, 1)
+
+        for _ in range(2):
+            with BulkUpdate() as bulk:
+                Partner.pull_opportunity(bulk, self.partner.id, self.requests[1])
+
+        self.assertEqual(Partner.objects.get(id=self.partner.id).open_opportunities, 0)
+
+
+class PartnerScoreEngineTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.RandomState(7)
+        levels = (Partner.LEVEL_BRONZE, Partner.LEVEL_SILVER, Partner.LEVEL_GOLD)
+
+        self.partners = [Partner(id=ObjectId(), level=levels[i % 3],
+            statistical_summary=PartnerStatisticalSummary(
+                **{key: float(rng.randint(0, 50)) for key in PartnerScoreEngine.FEATURES}))
+            for i in range(30)]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = PartnerScoreEngine(path=os.path.join(self.tmp.name, 'scores.npz'),
+            save_interval=3600)
+        self.engine.update(*self.partners)
+        self.engine.flush()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def test_scores_match_dataframe_weights(self):
+        """
+        Ensure the precomputed matrix scores as calc_partners_weights.
+        """
+        ids = [str(p.id) for p in self.partners]
+        expected = calc_partners_weights(self.partners)['feat']
+        scores = self.engine.scores(self.engine.rows(ids))
+
+        np.testing.assert_allclose(scores, expected.values)
+
+    def test_select_by_level(self):
+        """
+        Ensure the sample has at most `samples` partners per level.
+        """
+        ids = [str(p.id) for p in self.partners]
+        selected = self.engine.select(ids, samples=4,
+            random_state=np.random.RandomState(0))
+
+        self.assertEqual(len(selected), 12)
+        self.assertEqual(len(set(selected)), 12)
+        self.assertTrue(set(selected) <= set(ids))
+
+    def test_select_respects_capacity(self):
+        """
+        Ensure partners at the opportunities cap are not selected and
+        loaded partners lose weight.
+        """
+        ids = [str(p.id) for p in self.partners]
+        loads = {key: 5 if i % 2 else 0 for i, key in enumerate(ids)}
+        self.engine.capacity = CapacityModel(penalty=0.5, cap=5)
+
+        for seed in range(20):
+            selected = self.engine.select(ids, samples=4, loads=loads,
+                random_state=np.random.RandomState(seed))
+            self.assertTrue(all(loads[key] < 5 for key in selected))
+
+        model = CapacityModel(penalty=0.5, cap=0)
+        np.testing.assert_allclose(model.factors(np.array([0., 2.])), [1, 0.5])
+        self.assertTrue(model.available(np.array([100.])).all())
+        np.testing.assert_allclose(model.factors(np.array([-3.])), [1])
+
+    def test_reload_from_disk(self):
+        """
+        Ensure a new engine loads the persisted matrix.
+        """
+        engine = PartnerScoreEngine(path=self.engine.path)
+
+        self.assertTrue(engine.load())
+        self.assertEqual(set(engine.index), set(self.engine.index))
+
+    def test_concurrent_writers_keep_rows(self):
+        """
+        Ensure engines sharing the stored matrix don't overwrite each other.
+        """
+        other = PartnerScoreEngine(path=self.engine.path, save_interval=3600)
+        other.load()
+        added = [Partner(id=ObjectId(), level=Partner.LEVEL_GOLD) for _ in range(2)]
+
+        # Cada motor escribe un socio nuevo partiendo de su copia en memoria.
+        self.engine.update(added[0])
+        other.update(added[1])
+        self.engine.flush()
+        other.flush()
+
+        reader = PartnerScoreEngine(path=self.engine.path)
+        reader.load()
+        self.assertTrue({str(p.id) for p in added} <= set(reader.index))
+        self.assertEqual(len(reader.ids), len(self.partners) + 2)
+
+    def test_updates_are_saved_in_batches(self):
+        """
+        Ensure updates stay in memory until the engine is flushed, and
+        a reload keeps the rows not saved yet.
+        """
+        mtime = os.stat(self.engine.path).st_mtime_ns
+        added = [Partner(id=ObjectId(), level=Partner.LEVEL_SILVER) for _ in range(3)]
+
+        for partner in added:
+            self.engine.update(partner)
+
+        self.assertTrue(self.engine.dirty)
+        self.assertEqual(os.stat(self.engine.path).st_mtime_ns, mtime)
+
+        # Otro proceso guarda mientras estas filas siguen pendientes.
+        other = PartnerScoreEngine(path=self.engine.path)
+        other.load()
+        other.update(self.partners[0])
+        other.flush()
+        self.engine.load()
+        self.assertTrue({str(p.id) for p in added} <= set(self.engine.index))
+
+        self.assertTrue(self.engine.flush())
+        self.assertFalse(self.engine.flush())
+
+        reader = PartnerScoreEngine(path=self.engine.path)
+        reader.load()
+        self.assertEqual(len(reader.ids), len(self.partners) + 3)
+
+
+class SamplerTests(APISimpleTestCase):
+    levels = (Partner.LEVEL_BRONZE, Partner.LEVEL_SILVER, Partner.LEVEL_GOLD)
+
+    def make_pool(self, size, seed=0):
+        rng = np.random.RandomState(seed)
+        return np.array(self.levels)[rng.randint(0, 3, size)], rng.random_sample(size)
+
+    def test_seeded_sample_is_deterministic(self):
+        """
+        Ensure the same seed selects the same partners.
+        """
+        strata, weights = self.make_pool(1000)
+
+        first = stratified_sample(strata, weights, 4, self.levels, random_state=42)
+        second = stratified_sample(strata, weights, 4, self.levels, random_state=42)
+
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(len(set(first)), 12)
+
+    def test_zero_weights_are_not_selected(self):
+        """
+        Ensure partners with zero weight are excluded unless all are zero.
+        """
+        weights = np.array([0, 0.5, 0, 0.2, 0])
+
+        self.assertEqual(set(weighted_sample(weights, 4, random_state=1)), {1, 3})
+        self.assertEqual(len(stratified_sample(['bronze'] * 5, np.zeros(5), 4,
+            ('bronze', ), random_state=1)), 4)
+
+    def test_sample_follows_weights(self):
+        """
+        Ensure heavier partners are selected more often.
+        """
+        weights = np.array([1, 1, 1, 1, 16], dtype=float)
+        rng = np.random.RandomState(3)
+
+        hits = sum(4 in weighted_sample(weights, 1, rng) for _ in range(2000))
+        self.assertAlmostEqual(hits / 2000, 0.8, delta=0.04)
+
+    @unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'benchmarks disabled')
+    def test_benchmark_against_dataframe_sample(self):
+        """
+        Compares the sampler against the previous DataFrame implementation.
+        """
+        def dataframe_sample(df, samples):
+            selected = []
+            for level in self.levels:
+                part = df[df.level == level]
+                n = min(part.shape[0], samples)
+
+                if part['feat'].sum() == 0:
+                    part['feat'] = 1
+
+                if n > 0:
+                    selected.append(part.sample(n=n, weights='feat'))
+
+            return pd.concat(selected).index
+
+        for size in (1000, 10000, 100000):
+            with self.subTest(size=size):
+                strata, weights = self.make_pool(size)
+                df = pd.DataFrame({'level': strata, 'feat': weights})
+
+                legacy = min(timeit.repeat(lambda: dataframe_sample(df, 4),
+                    number=10, repeat=3))
+                current = min(timeit.repeat(lambda: stratified_sample(
+                    strata, weights, 4, self.levels), number=10, repeat=3))
+
+                logger.info('%d partners: dataframe %.2fms, sampler %.2fms',
+                    size, legacy * 100, current * 100)
+                self.assertLess(current, legacy)
@@ -14,6 +14,8 @@ from rest_framework.decorators import action
 from rest_framework_mongoengine import viewsets, generics
 from mongoengine.errors import DoesNotExist
 
+from asilinks.prefetch import PrefetchMixin, prefetch_references
+
 from .documents import (Client, Partner, AcademicOptions, Academic,
     Test, Category, KnowField, Competence, FavoritePartner, PartnerSkill)
 from .permissions import HavePartnerProfile
@@ -24,14 +26,21 @@ from requesting.serializers import DetailRequestSerializer
 from authentication.documents import Account
 
 
-class ClientViewSet(viewsets.ReadOnlyModelViewSet):
+class ClientViewSet(PrefetchMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Client.objects.all()
     serializer_class = ClientSerializer
+    action_prefetch_related = {
+        ('list', ): ('account', 'residence'),
+    }
 
 
-class PartnerViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+class PartnerViewSet(PrefetchMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     queryset = Partner.objects.all()
     serializer_class = PartnerSerializer
+    action_prefetch_related = {
+        ('retrieve', ): ('account', 'residence', 'know_fields',
+            'requests_done__client__account'),
+    }
 
 
 class AcademicOptionsViewSet(viewsets.ModelViewSet):
@@ -146,6 +155,7 @@ class SelfPartnerViewSet(mixins.RetrieveModelMixin,
         elif request.method == 'PUT':
             know_fields = KnowField.objects.filter(id__in=request.data)
             instance.modify(know_fields=know_fields)
+            instance.refresh_candidates()
 
             serializer = KnowFieldSerializer(know_fields, many=True)
             return Response(serializer.data, 
@@ -199,7 +209,9 @@ class SelfClientViewSet(mixins.RetrieveModelMixin,
     @action(methods=['get'], detail=True,
         permission_classes=[IsAuthenticated])
     def favorite_partners(self, request, *args, **kwargs):
-        unique_favorites = list({fav.partner for fav in self.get_object().favorite_partners})
+        favorites = prefetch_references(self.get_object().favorite_partners,
+            'partner__account', 'partner__residence')
+        unique_favorites = list({fav.partner for fav in favorites})
 
         serializer = FavPartnerSerializer(unique_favorites, many=True)
         return Response(serializer.data)
@@ -3,7 +3,9 @@ from decimal import Decimal, ROUND_HALF_UP
 
 from django.conf import settings
 from django.utils.translation import ugettext as _
-from mongoengine import fields, document, CASCADE, NULLIFY, PULL
+from mongoengine import fields, document, CASCADE, NULLIFY, PULL, Q
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from authentication.documents import Account
 from .interfaces import INTERFACES, get_interface
@@ -61,6 +63,25 @@ class Transaction(document.Document):
 
     INTERFACE_CHOICES = tuple(INTERFACES.keys())
 
+    PAYOUT_PENDING = 'pending'
+    PAYOUT_SENDING = 'sending'
+    PAYOUT_SENT = 'sent'
+    PAYOUT_DONE = 'done'
+    PAYOUT_FAILED = 'failed'
+    # Paypal pudo recibir el lote pero no se conoce su id, se concilia a mano.
+    PAYOUT_UNCONFIRMED = 'unconfirmed'
+
+    PAYOUT_UNPAID = (PAYOUT_PENDING, PAYOUT_SENDING, PAYOUT_FAILED)
+
+    PAYOUT_CHOICES = (
+        (PAYOUT_PENDING, _('pendiente')),
+        (PAYOUT_SENDING, _('enviando')),
+        (PAYOUT_SENT, _('enviado')),
+        (PAYOUT_DONE, _('pagado')),
+        (PAYOUT_FAILED, _('fallido')),
+        (PAYOUT_UNCONFIRMED, _('sin confirmar')),
+    )
+
     owner = fields.ReferenceField('Account', reverse_delete_rule=NULLIFY)
     receiver = fields.ReferenceField('Account', reverse_delete_rule=NULLIFY)
     date = fields.DateTimeField()
@@ -71,7 +92,26 @@ class Transaction(document.Document):
     external_reference = fields.StringField(max_length=50)
     item = fields.GenericReferenceField()
 
-    meta = { 'ordering': ['-date'] }
+    # Pagos diferidos a la cola de payouts.
+    payout_status = fields.StringField(choices=PAYOUT_CHOICES, null=True)
+    payout_batch = fields.StringField(null=True)
+    payout_attempts = fields.IntField(default=0)
+    # El lote se reenvio tras quedar abandonado, paypal pudo recibirlo antes.
+    payout_resent = fields.BooleanField(default=False)
+    date_payout = fields.DateTimeField()
+    # Marca de la suma en los balances, las anteriores a los balances no la tienen.
+    ledger_recorded = fields.BooleanField(default=False)
+
+    meta = {
+        'ordering': ['-date'],
+        'indexes': [
+            ('payout_status', 'interface', 'date'),
+            ('payout_status', 'owner'),
+            ('payout_status', 'receiver'),
+            'payout_batch',
+            ('ledger_recorded', 'date'),
+        ],
+    }
 
     def __str__(self):
         sign = '+' if self.type == Transaction.TYPE_CREDIT else '-'
@@ -94,30 +134,36 @@ class Transaction(document.Document):
         }
         payment_interface = get_interface(data['interface'])
 
+        # Con defer_payout el pago queda en cola para enviarse por lotes.
+        def payout(receiver):
+            if kwargs.get('defer_payout'):
+                data['payout_status'] = cls.PAYOUT_PENDING
+            else:
+                data['external_reference'] = payment_interface.make_payout(
+                    receiver=receiver, amount=amount)
+
         if operation in cls.CREDIT_OPS:
             data['type'] = cls.TYPE_CREDIT
 
             if operation == cls.OP_PARTNER_SETTLEMENT:
-                data['external_reference'] = payment_interface.make_payout(
-                    receiver=owner, amount=amount)
+                payout(owner)
 
             elif operation == cls.OP_SPONSOR_FEE:
                 data['receiver'] = owner.sponsor
-                if owner.sponsor != Account.default_sponsor_account():
-                    data['external_reference'] = payment_interface.make_payout(
-                        receiver=data['receiver'], amount=amount)
+                if getattr(owner.sponsor, 'pk', None) != Account.default_sponsor_account().pk:
+                    payout(data['receiver'])
 
             elif operation == cls.OP_REFUND:
                 data['external_reference'] = kwargs['external_reference']
 
-            return cls.objects.create(**data)
+            return LedgerBalance.record(cls.objects.create(**data))
 
         elif operation in cls.DEBIT_OPS:
             data['type'] = cls.TYPE_DEBIT
 
             data['external_reference'] = payment_interface.make_payment(
                 amount=amount, **kwargs)
-            return cls.objects.create(**data)
+            return LedgerBalance.record(cls.objects.create(**data))
 
         else:
             raise ValueError('The operation is not registered.')
@@ -130,7 +176,48 @@ class Transaction(document.Document):
 
         return [cls(owner=client.account, date=dt.datetime.now(), 
             type=cls.TYPE_DEBIT, operation=cls.OP_DEBTS_TO_PAY, item=req,
-            amount=req.calculate_bill()['to_pay']) for req in reqs_delivered]
+            amount=req.get_bill()['to_pay']) for req in reqs_delivered]
+
+    @classmethod
+    def payee_of(cls, raw):
+        """
+        Id of the account that receives the money of a raw transaction:
+        the receiver of the sponsor fees and the owner otherwise.
+        """
+        if raw.get('operation') == cls.OP_SPONSOR_FEE:
+            return raw.get('receiver')
+        return raw.get('owner')
+
+    @classmethod
+    def payouts_of(cls, account, statuses):
+        """
+        Queryset of the payouts of the account in the given statuses.
+        """
+        account = getattr(account, 'pk', account)
+
+        return cls.objects(payout_status__in=statuses).filter(
+            Q(operation=cls.OP_PARTNER_SETTLEMENT, owner=account)
+            | Q(operation=cls.OP_SPONSOR_FEE, receiver=account))
+
+    @classmethod
+    def unpaid_payouts(cls, account):
+        """
+        Sum of the payouts of the account that were not sent yet or failed.
+        """
+        return sum((Decimal(str(raw['amount'])) for raw in cls.payouts_of(account,
+            cls.PAYOUT_UNPAID).only('amount').as_pymongo()), Decimal('0'))
+
+    @classmethod
+    def requeue_payouts(cls, account):
+        """
+        Puts back in the queue the failed payouts of the account, e.g. when
+        it registers its paypal email. Returns the number of payouts. The
+        unconfirmed ones are never queued again, paypal may have paid them.
+        """
+        return cls.payouts_of(account, (cls.PAYOUT_FAILED, )).update(
+            set__payout_status=cls.PAYOUT_PENDING, set__payout_attempts=0,
+            set__payout_resent=False, unset__payout_batch=True,
+            unset__date_payout=True)
 
     def refund(self, amount=None):
         if amount is None:
@@ -161,6 +248,170 @@ class Transaction(document.Document):
             return self.amount - paypal, paypal
 
 
+class LedgerBalance(document.Document):
+    """
+    Monthly sums of the transactions by account and operation, kept in
+    cents so the increments are exact. The account is the receiver of the
+    sponsor fees and the owner otherwise; the rows without account hold
+    the totals of the whole platform.
+    """
+    account = fields.ObjectIdField(null=True)
+    operation = fields.IntField(choices=Transaction.OP_CHOICES)
+    month = fields.DateTimeField()
+    cents = fields.LongField(default=0)
+    count = fields.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ('account', 'operation', 'month'), 'unique': True},
+        ],
+    }
+
+    @staticmethod
+    def month_of(date):
+        return dt.datetime(date.year, date.month, 1)
+
+    @staticmethod
+    def to_cents(amount):
+        return int((Decimal(amount) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+    @classmethod
+    def record(cls, transaction):
+        """
+        Adds the transaction to the balances of its account and of the
+        platform with an atomic upsert each. The transaction is marked
+        first with a conditional write, so it is added only once.
+        Returns the transaction.
+        """
+        result = Transaction._get_collection().update_one(
+            {'_id': transaction.pk, 'ledger_recorded': {'$ne': True}},
+            {'$set': {'ledger_recorded': True}})
+        transaction.ledger_recorded = True
+
+        if not result.modified_count:
+            return transaction
+
+        raw = transaction.to_mongo()
+        month = cls.month_of(transaction.date)
+        update = {'$inc': {'cents': cls.to_cents(transaction.amount), 'count': 1}}
+
+        for account in {Transaction.payee_of(raw), None}:
+            query = {'account': account, 'operation': transaction.operation, 'month': month}
+
+            try:
+                cls._get_collection().update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                # Otro proceso creo la fila al mismo tiempo.
+                cls._get_collection().update_one(query, update)
+
+        return transaction
+
+    @classmethod
+    def record_pending(cls, age=dt.timedelta(minutes=1)):
+        """
+        Records the transactions stored but not recorded by a process that
+        failed in between, and the ones of the current month stored before
+        the mark existed; the previous months are summed by the rebuild.
+        Returns the number of pending transactions.
+        """
+        now = dt.datetime.now()
+        pending = list(Transaction.objects(date__lt=now - age).filter(
+            Q(ledger_recorded=False)
+            | Q(ledger_recorded__exists=False, date__gte=cls.month_of(now)))
+            .no_dereference())
+
+        for transaction in pending:
+            cls.record(transaction)
+
+        return len(pending)
+
+    @classmethod
+    def balance(cls, operations, account=None, since=None):
+        """
+        Sum of the given operations for the account, or for the whole
+        platform when it is None, optionally since the month of `since`.
+        """
+        match = {'account': getattr(account, 'pk', account),
+            'operation': {'$in': list(operations)}}
+
+        if since is not None:
+            match['month'] = {'$gte': cls.month_of(since)}
+
+        result = list(cls._get_collection().aggregate([
+            {'$match': match},
+            {'$group': {'_id': None, 'cents': {'$sum': '$cents'}}},
+        ]))
+
+        return Decimal(result[0]['cents'] if result else 0).scaleb(-2)
+
+    @classmethod
+    def rebuild(cls, before=None):
+        """
+        Corrects the balances of the months before the month of `before`,
+        the current one by default, with the differences to the sums of the
+        stored transactions. Each row is corrected only if it did not change
+        since it was read, so concurrent increments are not lost. The
+        current month is left to the increments, since its transactions can
+        be written during the scan. Returns the number of corrected rows.
+        """
+        cutoff = cls.month_of(before or dt.datetime.now())
+        collection = cls._get_collection()
+
+        # Las transacciones que se suman aqui ya no se registran despues.
+        Transaction._get_collection().update_many(
+            {'ledger_recorded': {'$ne': True}, 'date': {'$lt': cutoff}},
+            {'$set': {'ledger_recorded': True}})
+
+        totals = dict()
+        for raw in Transaction.objects(date__lt=cutoff).only('owner', 'receiver',
+                'operation', 'date', 'amount').as_pymongo():
+            if raw.get('amount') is None:
+                continue
+
+            month = cls.month_of(raw['date'])
+            cents = cls.to_cents(str(raw['amount']))
+
+            for account in {Transaction.payee_of(raw), None}:
+                key = (account, raw['operation'], month)
+                row = totals.setdefault(key, [0, 0])
+                row[0] += cents
+                row[1] += 1
+
+        current = {(raw.get('account'), raw.get('operation'), raw.get('month')): raw
+            for raw in collection.find({'month': {'$lt': cutoff}})}
+
+        operations = list()
+        for key in set(totals) | set(current):
+            cents, count = totals.get(key, (0, 0))
+            row = current.get(key)
+
+            if row is None:
+                account, operation, month = key
+                operations.append(UpdateOne(
+                    {'account': account, 'operation': operation, 'month': month},
+                    {'$inc': {'cents': cents, 'count': count}}, upsert=True))
+                continue
+
+            unchanged = {'_id': row['_id'], 'cents': row.get('cents', 0),
+                'count': row.get('count', 0)}
+
+            if not count:
+                operations.append(DeleteOne(unchanged))
+            elif (cents, count) != (unchanged['cents'], unchanged['count']):
+                operations.append(UpdateOne(unchanged, {'$inc': {
+                    'cents': cents - unchanged['cents'],
+                    'count': count - unchanged['count']}}))
+
+        if operations:
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except BulkWriteError:
+                # Una fila creada al mismo tiempo se corrige en la proxima vez.
+                pass
+
+        return len(operations)
+
+
 class Bill(document.Document):
 
     FEATURE_REQUEST = 1
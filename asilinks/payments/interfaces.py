@@ -30,6 +30,14 @@ class BasePaymentInterface(metaclass=ABCMeta):
     def make_payout(self, *args, **kwargs):
         pass
 
+    @abstractmethod
+    def make_batch_payout(self, *args, **kwargs):
+        pass
+
+    @abstractmethod
+    def get_batch_payout(self, *args, **kwargs):
+        pass
+
 
 class BypassInterface(BasePaymentInterface):
 
@@ -51,9 +59,24 @@ class BypassInterface(BasePaymentInterface):
     def make_payout(self, *args, **kwargs):
         return 'bypass'
 
+    def make_batch_payout(self, *args, **kwargs):
+        return 'bypass'
+
+    def get_batch_payout(self, payout_batch_id, item_ids, **kwargs):
+        return {item_id: 'SUCCESS' for item_id in item_ids}
+
 
 class PaypalInterface(BasePaymentInterface):
 
+    # Estados finales de los items de un lote de payouts.
+    PAYOUT_ITEM_SUCCESS = ('SUCCESS', )
+    PAYOUT_ITEM_FAILED = ('FAILED', 'RETURNED', 'BLOCKED', 'REFUNDED',
+        'REVERSED', 'DENIED')
+
+    def __init__(self):
+        options = getattr(settings, 'PAYPAL_API_OPTIONS', None)
+        self.api = paypalrestsdk.Api(options) if options else None
+
     def calculate_payment_fee(self, amount, *args, **kwargs):
         fee_constants = settings.PAYMENT_CONSTANTS['paypal_fees']
 
@@ -147,6 +170,57 @@ class PaypalInterface(BasePaymentInterface):
 
         return payout.batch_header.payout_batch_id
 
+    def make_batch_payout(self, sender_batch_id, items, **kwargs):
+        """
+        Sends a single payouts batch with one item per (sender_item_id,
+        receiver email, amount). PayPal rejects a reused sender_batch_id,
+        so retrying a batch can not pay twice.
+        """
+        payout = paypalrestsdk.Payout({
+            "sender_batch_header": {
+                "sender_batch_id": sender_batch_id,
+                "email_subject": "You have a payment from Asilinks Platform."
+            },
+            "items": [
+                {
+                    "recipient_type": "EMAIL",
+                    "amount": {
+                        "value": str(amount),
+                        "currency": "USD"
+                    },
+                    "receiver": receiver,
+                    "note": "Thank you, for use Asilinks.",
+                    "sender_item_id": sender_item_id
+                } for sender_item_id, receiver, amount in items
+            ]
+        }, api=self.api)
+
+        if not payout.create():
+            if self.is_duplicate_batch(payout.error):
+                raise DuplicateBatchPayout(payout.error)
+            raise PayoutError(payout.error)
+
+        return payout.batch_header.payout_batch_id
+
+    @staticmethod
+    def is_duplicate_batch(error):
+        # Paypal responde un error generico que nombra el campo en los detalles.
+        error = error or dict()
+        return (error.get('name') == 'USER_BUSINESS_ERROR'
+            and any(str(detail.get('field', '')).upper() == 'SENDER_BATCH_ID'
+                for detail in error.get('details') or []))
+
+    def get_batch_payout(self, payout_batch_id, item_ids, **kwargs):
+        """
+        Returns the transaction status of each item of the batch, by
+        sender_item_id.
+        """
+        payout = paypalrestsdk.Payout.find(payout_batch_id, api=self.api)
+
+        return {item['payout_item']['sender_item_id']: item['transaction_status']
+            for item in payout.to_dict().get('items', [])
+            if item['payout_item'].get('sender_item_id') in item_ids}
+
 
 class ContextInterfaceError(BaseException):
     def __init__(self, error):
@@ -172,6 +246,10 @@ class PayoutError(BaseException):
         self.error = error
 
 
+class DuplicateBatchPayout(PayoutError):
+    pass
+
+
 INTERFACES = {
     'bypass': BypassInterface,
     'paypal': PaypalInterface,
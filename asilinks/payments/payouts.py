@@ -0,0 +1,181 @@
+import datetime as dt
+import logging
+from collections import defaultdict
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+
+from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
+from authentication.documents import Account
+from .documents import Transaction
+from .interfaces import get_interface, DuplicateBatchPayout, PayoutError, PaypalInterface
+
+logger = logging.getLogger(__name__)
+
+def claim_batch(interface, limit):
+    """
+    Takes the pending payouts of the interface under a new batch id, or
+    an abandoned batch that was being sent, keeping its id so the payment
+    interface can reject the duplicate. Returns the batch id or None.
+    """
+    now = dt.datetime.now()
+    collection = Transaction._get_collection()
+
+    stale = collection.find_one_and_update(
+        {'interface': interface, 'payout_status': Transaction.PAYOUT_SENDING,
+            'date_payout': {'$lt': now - settings.PAYOUT_SENDING_TIMEOUT}},
+        {'$set': {'date_payout': now}}, projection=('payout_batch', ))
+
+    if stale is not None:
+        collection.update_many({'payout_batch': stale['payout_batch']},
+            {'$set': {'date_payout': now, 'payout_resent': True}})
+        return stale['payout_batch']
+
+    ids = [raw['_id'] for raw in collection.find(
+        {'interface': interface, 'payout_status': Transaction.PAYOUT_PENDING},
+        projection=('_id', )).sort('date', 1).limit(limit)]
+
+    if not ids:
+        return None
+
+    batch_id = str(ObjectId())
+    collection.update_many(
+        {'_id': {'$in': ids}, 'payout_status': Transaction.PAYOUT_PENDING},
+        {'$set': {'payout_status': Transaction.PAYOUT_SENDING,
+            'payout_batch': batch_id, 'date_payout': now}})
+
+    return batch_id
+
+
+def notify_paypal_email_required(transactions, payees):
+    """
+    Logs and notifies the payees of the transactions that their payouts
+    wait for their paypal email.
+    """
+    operations = {payees[transaction.id]: transaction.operation
+        for transaction in transactions}
+
+    for account in Account.objects(id__in=list(operations)):
+        logger.warning('payout sin correo de paypal para la cuenta {}'.format(account.pk))
+
+        if operations[account.pk] == Transaction.OP_PARTNER_SETTLEMENT:
+            account.send_message(data={'profile': 'partner'},
+                **PARTNER_MESSAGES['paypal_email_required'])
+        else:
+            account.send_message(data={'profile': 'client'},
+                **CLIENT_MESSAGES['paypal_email_required'])
+
+
+def send_batch(interface, limit=None):
+    """
+    Sends the next batch of pending payouts of the interface as a single
+    payouts request. Returns the number of sent transactions.
+    """
+    batch_id = claim_batch(interface, limit or settings.PAYOUT_BATCH_SIZE)
+
+    if batch_id is None:
+        return 0
+
+    transactions = list(Transaction.objects(payout_batch=batch_id,
+        payout_status=Transaction.PAYOUT_SENDING).only('id', 'owner', 'receiver',
+            'operation', 'amount', 'payout_attempts', 'payout_resent', 'date').order_by('date')
+        .no_dereference())
+    payees = {transaction.id: Transaction.payee_of(transaction.to_mongo())
+        for transaction in transactions}
+    emails = {raw['_id']: raw.get('paypal_email') for raw in Account.objects(
+        id__in=list(set(payees.values()))).only('paypal_email').as_pymongo()}
+
+    items, missing = list(), list()
+    for transaction in transactions:
+        email = emails.get(payees[transaction.id])
+
+        if email:
+            items.append((str(transaction.id), email, transaction.amount))
+        else:
+            missing.append(transaction)
+
+    collection = Transaction._get_collection()
+
+    # Sin correo de paypal no hay a quien pagar, el pago vuelve a la cola
+    # cuando la cuenta registra su correo.
+    if missing:
+        collection.update_many({'_id': {'$in': [t.id for t in missing]}},
+            {'$set': {'payout_status': Transaction.PAYOUT_FAILED}})
+        notify_paypal_email_required(missing, payees)
+
+    if not items:
+        return 0
+
+    payment_interface = get_interface(interface)
+
+    try:
+        payout_batch_id = payment_interface.make_batch_payout(batch_id, items)
+
+    except DuplicateBatchPayout:
+        # Paypal ya recibio el lote en un envio anterior cuya respuesta se
+        # perdio; sin su id no se puede consultar, se concilia a mano y
+        # nunca vuelve a la cola.
+        logger.error('paypal ya recibio el lote {}, requiere conciliacion'.format(batch_id))
+        collection.update_many({'payout_batch': batch_id,
+                'payout_status': Transaction.PAYOUT_SENDING},
+            {'$set': {'payout_status': Transaction.PAYOUT_UNCONFIRMED}})
+        return len(items)
+
+    except PayoutError:
+        # El lote se reintenta con el mismo id al vencer el envio. Si se
+        # agotan los intentos de un lote reenviado, paypal pudo recibir
+        # un envio anterior y no se marca fallido para no pagar dos veces.
+        update = {'$inc': {'payout_attempts': 1}}
+        if transactions[0].payout_attempts + 1 >= settings.PAYOUT_MAX_ATTEMPTS:
+            update['$set'] = {'payout_status': Transaction.PAYOUT_UNCONFIRMED
+                if transactions[0].payout_resent else Transaction.PAYOUT_FAILED}
+
+        collection.update_many({'payout_batch': batch_id,
+            'payout_status': Transaction.PAYOUT_SENDING}, update)
+        raise
+
+    collection.update_many({'payout_batch': batch_id,
+            'payout_status': Transaction.PAYOUT_SENDING},
+        {'$set': {'payout_status': Transaction.PAYOUT_SENT,
+            'external_reference': payout_batch_id}})
+
+    return len(items)
+
+
+def reconcile_batches():
+    """
+    Reads the result of the sent batches and marks each transaction as
+    paid or failed. Items still in process are left as sent.
+    Returns the number of updated transactions.
+    """
+    batches = defaultdict(list)
+
+    for raw in Transaction.objects(payout_status=Transaction.PAYOUT_SENT).only(
+            'id', 'interface', 'external_reference').as_pymongo():
+        batches[(raw.get('interface'), raw.get('external_reference'))].append(str(raw['_id']))
+
+    operations = list()
+    for (interface, payout_batch_id), item_ids in batches.items():
+        try:
+            statuses = get_interface(interface).get_batch_payout(payout_batch_id, item_ids)
+        except Exception:
+            logger.exception('no se pudo consultar el lote {}'.format(payout_batch_id))
+            continue
+
+        for item_id, item_status in statuses.items():
+            if item_status in PaypalInterface.PAYOUT_ITEM_SUCCESS:
+                status = Transaction.PAYOUT_DONE
+            elif item_status in PaypalInterface.PAYOUT_ITEM_FAILED:
+                status = Transaction.PAYOUT_FAILED
+            else:
+                continue
+
+            operations.append(UpdateOne(
+                {'_id': ObjectId(item_id), 'payout_status': Transaction.PAYOUT_SENT},
+                {'$set': {'payout_status': status}}))
+
+    if operations:
+        Transaction._get_collection().bulk_write(operations, ordered=False)
+
+    return len(operations)
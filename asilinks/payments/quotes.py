@@ -0,0 +1,157 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+
+from .interfaces import get_interface
+
+
+Quote = namedtuple('Quote', ('price', 'partner_level', 'sponsor_level', 'interface'))
+
+
+class QuoteEngine(object):
+    """
+    Computes the fee breakdowns of many offers in one pass. It is also the
+    source of the rates by level and of the bills of Request.calculate_bill
+    in every status. The percents of every pair of levels and the payment
+    interfaces are built once per engine, and repeated quotes are computed
+    only once.
+
+        engine = QuoteEngine()
+        engine.quote_many([Quote(Decimal('250'), 'gold', 'a', 'paypal'), ...])
+    """
+
+    CENT = Decimal('.01')
+
+    RATE_PARTNER = {'gold': 2, 'silver': 1, 'bronze': 0}
+    RATE_SPONSOR = {'a': 0, 'b': 1, 'c': 2}
+
+    def __init__(self, constants=None):
+        constants = constants or settings.PAYMENT_CONSTANTS
+        request_fees = constants['request_fees']
+
+        self.total_fee = request_fees['total_fee']
+        self.first_client_payment = constants['first_client_payment']
+
+        # Porcentaje de asilinks por cada par de niveles (socio, patrocinante).
+        self.asilinks_percents = {
+            (partner, sponsor): (request_fees['max_asilinks_fee']
+                - rate_partner * request_fees['asilinks_fee_rate']
+                + rate_sponsor * request_fees['sponsor_fee_rate'])
+            for partner, rate_partner in self.RATE_PARTNER.items()
+            for sponsor, rate_sponsor in self.RATE_SPONSOR.items()
+        }
+        self.interfaces = dict()
+
+    def get_interface(self, key):
+        if key not in self.interfaces:
+            self.interfaces[key] = get_interface(key)
+        return self.interfaces[key]
+
+    def quantize(self, amount):
+        return amount.quantize(self.CENT, rounding=ROUND_HALF_UP)
+
+    def quote(self, price, partner_level, sponsor_level, interface):
+        """
+        Returns the bill of an offer of the given price, with the keys of
+        Request.calculate_bill in status todo.
+        """
+        return self.bill(price, self.asilinks_percents[(partner_level, sponsor_level)],
+            interface)
+
+    def split(self, price, asilinks_percent, payment_interface):
+        """
+        Returns the parts of the partner, asilinks and the sponsor, the fee
+        amount and the payout fees of a bill.
+        """
+        sponsor_percent = self.total_fee - asilinks_percent
+
+        payout_fee = (payment_interface.calculate_payout_fee(price)
+            + payment_interface.calculate_payout_fee(price * sponsor_percent))
+
+        asilinks_pay = self.quantize(price * asilinks_percent)
+        fee_amount = self.quantize(price * self.total_fee)
+
+        parts = {
+            'partner': price,
+            'asilinks': asilinks_pay,
+            'sponsor': fee_amount - asilinks_pay,
+            'sponsor_percent': sponsor_percent,
+        }
+        return parts, fee_amount, payout_fee
+
+    def bill(self, price, asilinks_percent, interface):
+        """
+        Returns the bill of a request not paid yet, the first payment is
+        the one to pay.
+        """
+        payment_interface = self.get_interface(interface)
+        result, fee_amount, payout_fee = self.split(price, asilinks_percent,
+            payment_interface)
+        subtotal = price + fee_amount + payout_fee
+
+        first_payment = self.quantize(subtotal * self.first_client_payment)
+        second_payment = subtotal - first_payment
+        first_fee = payment_interface.calculate_payment_fee(first_payment)
+        paypal_pay = first_fee + \
+            payment_interface.calculate_payment_fee(second_payment) + payout_fee
+
+        result.update({
+            'paypal': paypal_pay,
+            'total': price + fee_amount + paypal_pay,
+            'to_pay': first_fee + first_payment,
+        })
+        return result
+
+    def bill_in_progress(self, price, asilinks_percent, interface,
+            first_payment, first_fee):
+        """
+        Returns the bill of a request with the first payment done, the rest
+        is the one to pay.
+        """
+        payment_interface = self.get_interface(interface)
+        result, fee_amount, payout_fee = self.split(price, asilinks_percent,
+            payment_interface)
+
+        second_payment = price + fee_amount + payout_fee - first_payment
+        second_fee = payment_interface.calculate_payment_fee(second_payment)
+        paypal_pay = first_fee + payout_fee + second_fee
+
+        result.update({
+            'paypal': paypal_pay,
+            'total': price + fee_amount + paypal_pay,
+            'to_pay': second_fee + second_payment,
+        })
+        return result
+
+    def bill_closed(self, price, asilinks_percent, interface, payments):
+        """
+        Returns the bill of a request from the (amount, fee) pairs of the
+        payments done, nothing is left to pay.
+        """
+        result, fee_amount, payout_fee = self.split(price, asilinks_percent,
+            self.get_interface(interface))
+        amounts, paypal_fees = zip(*payments)
+
+        result.update({
+            'paypal': sum(paypal_fees) + payout_fee,
+            'total': sum(amounts) + sum(paypal_fees),
+            'to_pay': Decimal('0'),
+        })
+        return result
+
+    def quote_many(self, quotes):
+        """
+        Returns the bills of the given Quote tuples, in the same order.
+        """
+        computed = dict()
+        result = list()
+
+        for item in quotes:
+            item = Quote(*item)
+
+            if item not in computed:
+                computed[item] = self.quote(*item)
+            result.append(dict(computed[item]))
+
+        return result
@@ -1,4 +1,7 @@
 
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
 from rest_framework import serializers, fields
 from rest_framework.reverse import reverse
 
@@ -6,6 +9,7 @@ from rest_framework_mongoengine.serializers import (
     DocumentSerializer, EmbeddedDocumentSerializer)
 
 from .documents import Transaction
+from .quotes import QuoteEngine
 from requesting.documents import Request
 
 class TransactionSerializer(DocumentSerializer):
@@ -28,3 +32,27 @@ class TransactionSerializer(DocumentSerializer):
                 request_id=instance.item.id)
 
         return None
+
+
+class QuoteSerializer(serializers.Serializer):
+    price = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=0)
+    partner_level = serializers.ChoiceField(choices=tuple(QuoteEngine.RATE_PARTNER))
+    sponsor_level = serializers.ChoiceField(choices=tuple(QuoteEngine.RATE_SPONSOR),
+        required=False)
+    interface = serializers.ChoiceField(default='bypass',
+        choices=Transaction.INTERFACE_CHOICES)
+
+
+class PaymentQuotesSerializer(serializers.Serializer):
+    quotes = QuoteSerializer(many=True)
+
+    def validate_quotes(self, value):
+        if not value:
+            raise serializers.ValidationError(_('Debe indicar al menos una oferta.'))
+
+        if len(value) > settings.PAYMENT_QUOTES_MAX:
+            raise serializers.ValidationError(
+                _('No puede cotizar más de {} ofertas a la vez.').format(
+                    settings.PAYMENT_QUOTES_MAX))
+
+        return value
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+from celery import shared_task
+from celery.utils.log import get_task_logger
+
+from .documents import LedgerBalance, Transaction
+from .interfaces import PayoutError
+from .payouts import send_batch, reconcile_batches
+
+logger = get_task_logger(__name__)
+
+
+@shared_task(name='rebuild_ledger_balances')
+def rebuild_ledger_balances():
+    """
+    Reconciles the ledger balances of the closed months with the stored
+    transactions.
+    """
+    return LedgerBalance.rebuild()
+
+
+@shared_task(name='record_pending_transactions')
+def record_pending_transactions():
+    """
+    Adds to the ledger balances the transactions left out by a failure.
+    """
+    return LedgerBalance.record_pending()
+
+
+@shared_task(name='send_pending_payouts')
+def send_pending_payouts():
+    """
+    Sends the queued payouts in batches, one payouts request per batch.
+    """
+    sent = 0
+
+    for interface in Transaction.INTERFACE_CHOICES:
+        while True:
+            try:
+                count = send_batch(interface)
+            except PayoutError as err:
+                # El lote queda en envio y se reintenta al vencer.
+                logger.error('fallo el lote de payouts {}: {}'.format(interface, err.error))
+                break
+
+            if not count:
+                break
+            sent += count
+
+    return sent
+
+
+@shared_task(name='reconcile_payouts')
+def reconcile_payouts():
+    """
+    Updates the sent payouts with their result.
+    """
+    return reconcile_batches()
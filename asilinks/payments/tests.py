@@ -1,3 +1,439 @@
-from django.test import TestCase
+import os
+import json
+import logging
+import random
+import timeit
+import unittest
+from unittest import mock
+import threading
+import datetime as dt
+from decimal import Decimal
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from django.test import override_settings
+from rest_framework.test import APISimpleTestCase
+
+from authentication.documents import Account
+from main.documents import Client, Partner
+from requesting.documents import Request, RoundPartner
+from .documents import Transaction, LedgerBalance
+from .interfaces import INTERFACES, PayoutError
+from .payouts import send_batch
+from .quotes import Quote, QuoteEngine
+from .tasks import send_pending_payouts, reconcile_payouts
+
+logger = logging.getLogger(__name__)
 
 # Create your tests here.
+
+@override_settings(DEBUG=True)
+class QuoteEngineTests(APISimpleTestCase):
+
+    def make_quotes(self, size, seed=7, interfaces=('paypal', )):
+        rand = random.Random(seed)
+
+        return [Quote(Decimal(rand.randint(100, 500000)) / 100,
+                rand.choice(tuple(QuoteEngine.RATE_PARTNER)),
+                rand.choice(tuple(QuoteEngine.RATE_SPONSOR)), rand.choice(interfaces))
+            for _ in range(size)]
+
+    def calculate_bill(self, quote):
+        sponsor = Account(sponsor_level=quote.sponsor_level)
+        request = Request(status=Request.STATUS_TODO,
+            client=Client(account=Account(sponsor=sponsor)))
+        round_partner = RoundPartner(partner=Partner(level=quote.partner_level),
+            price=quote.price)
+
+        return request.calculate_bill(round_partner, quote.interface)
+
+    def test_quotes_match_calculate_bill(self):
+        """
+        Ensure every quote is equal to the bill of the same round partner.
+        """
+        quotes = self.make_quotes(300, interfaces=tuple(INTERFACES))
+        bills = QuoteEngine().quote_many(quotes)
+
+        for quote, bill in zip(quotes, bills):
+            with self.subTest(quote=quote):
+                self.assertEqual(bill, self.calculate_bill(quote))
+
+    def test_bills_follow_the_payments(self):
+        """
+        Ensure the bills of a request in progress and closed keep the total
+        of its quote, and its payments add up to that total.
+        """
+        engine = QuoteEngine()
+
+        for quote in self.make_quotes(50, interfaces=tuple(INTERFACES)):
+            with self.subTest(quote=quote):
+                percent = engine.asilinks_percents[(quote.partner_level, quote.sponsor_level)]
+                payment_interface = engine.get_interface(quote.interface)
+                _, fee_amount, payout_fee = engine.split(quote.price, percent,
+                    payment_interface)
+                subtotal = quote.price + fee_amount + payout_fee
+
+                first = engine.quantize(subtotal * engine.first_client_payment)
+                second = subtotal - first
+                payments = [(amount, payment_interface.calculate_payment_fee(amount))
+                    for amount in (first, second)]
+
+                todo = engine.bill(quote.price, percent, quote.interface)
+                in_progress = engine.bill_in_progress(quote.price, percent,
+                    quote.interface, *payments[0])
+                closed = engine.bill_closed(quote.price, percent,
+                    quote.interface, payments)
+
+                self.assertEqual(todo, engine.quote(*quote))
+                self.assertEqual(in_progress['total'], todo['total'])
+                self.assertEqual(todo['to_pay'] + in_progress['to_pay'], todo['total'])
+                self.assertEqual(closed['total'], todo['total'])
+                self.assertEqual(closed['paypal'], todo['paypal'])
+
+    def test_quotes_add_up(self):
+        """
+        Ensure the parts of every quote add up to its total for every interface.
+        """
+        engine = QuoteEngine()
+        quotes = self.make_quotes(300, interfaces=tuple(INTERFACES))
+
+        for quote, bill in zip(quotes, engine.quote_many(quotes)):
+            with self.subTest(quote=quote):
+                self.assertEqual(bill['asilinks'] + bill['sponsor'],
+                    engine.quantize(quote.price * engine.total_fee))
+                self.assertEqual(bill['total'], bill['partner'] + bill['asilinks']
+                    + bill['sponsor'] + bill['paypal'])
+                self.assertLess(bill['to_pay'], bill['total'])
+
+    def test_quote_rates(self):
+        """
+        Ensure a quote applies the rates of the partner and sponsor levels.
+        """
+        bill = QuoteEngine().quote(Decimal('100'), Partner.LEVEL_GOLD,
+            Account.LEVEL_C, 'bypass')
+
+        self.assertEqual(bill, {
+            'partner': Decimal('100'),
+            'asilinks': Decimal('11.50'),
+            'sponsor': Decimal('3.50'),
+            'sponsor_percent': Decimal('0.035'),
+            'paypal': Decimal('24.00'),
+            'total': Decimal('139.00'),
+            'to_pay': Decimal('81.40'),
+        })
+
+    @unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'benchmarks disabled')
+    def test_benchmark_batch_quotes(self):
+        """
+        Ensure the batch engine is faster than one calculate_bill per offer.
+        """
+        quotes = self.make_quotes(1000)
+
+        batch = min(timeit.repeat(lambda: QuoteEngine().quote_many(quotes),
+            number=5, repeat=3)) / 5
+        single = min(timeit.repeat(lambda: [self.calculate_bill(quote) for quote in quotes],
+            number=5, repeat=3)) / 5
+
+        logger.info('%d quotes: batch %.1fms, calculate_bill %.1fms',
+            len(quotes), batch * 1e3, single * 1e3)
+
+        self.assertLess(batch, single)
+
+
+class LedgerBalanceTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client_account = Account.objects.get(email='user1@asilinks.com')
+        self.sponsor = self.client_account.sponsor
+
+        # Parte de balances alineados con las transacciones existentes.
+        LedgerBalance.rebuild(before=dt.datetime.max)
+        self.before = {
+            'owner': LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+                self.client_account),
+            'sponsor': LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, ),
+                self.sponsor),
+            'platform': LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, )),
+        }
+        self.transactions = [
+            Transaction.make_transaction(Decimal('10.10'), Transaction.OP_ASILINKS_FEE,
+                self.client_account, interface='paypal'),
+            Transaction.make_transaction(Decimal('0.20'), Transaction.OP_ASILINKS_FEE,
+                self.client_account, interface='paypal'),
+            Transaction(owner=self.client_account, receiver=self.sponsor,
+                date=dt.datetime.now(), amount=Decimal('3.35'), interface='paypal',
+                operation=Transaction.OP_SPONSOR_FEE, type=Transaction.TYPE_CREDIT).save(),
+        ]
+        LedgerBalance.record(self.transactions[-1])
+
+    def tearDown(self):
+        for transaction in self.transactions:
+            transaction.delete()
+        LedgerBalance.rebuild(before=dt.datetime.max)
+        super().tearDown()
+
+    def test_balances_follow_transactions(self):
+        """
+        Ensure the balances are exact and match a rebuild from transactions.
+        """
+        def deltas():
+            return {
+                'owner': LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+                    self.client_account) - self.before['owner'],
+                'sponsor': LedgerBalance.balance((Transaction.OP_SPONSOR_FEE, ),
+                    self.sponsor) - self.before['sponsor'],
+                'platform': LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ))
+                    - self.before['platform'],
+            }
+
+        expected = {'owner': Decimal('10.30'), 'sponsor': Decimal('3.35'),
+            'platform': Decimal('10.30')}
+
+        self.assertEqual(deltas(), expected)
+        self.assertGreaterEqual(LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+            self.client_account, since=dt.datetime.now()), Decimal('10.30'))
+
+        LedgerBalance.rebuild(before=dt.datetime.max)
+        self.assertEqual(deltas(), expected)
+
+    def test_record_once(self):
+        """
+        Ensure a transaction is added once, and the ones left out by a
+        failure are added by the pending sweep.
+        """
+        before = LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ), self.client_account)
+
+        LedgerBalance.record(self.transactions[0])
+        self.assertEqual(LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+            self.client_account), before)
+
+        # El proceso cae entre el guardado y el registro.
+        lost = Transaction(owner=self.client_account, date=dt.datetime.now()
+            - dt.timedelta(minutes=5), amount=Decimal('1.25'), interface='paypal',
+            operation=Transaction.OP_ASILINKS_FEE, type=Transaction.TYPE_CREDIT).save()
+        self.transactions.append(lost)
+
+        LedgerBalance.record_pending()
+        LedgerBalance.record_pending()
+        self.assertEqual(LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+            self.client_account), before + Decimal('1.25'))
+
+    def test_record_unmarked_transactions(self):
+        """
+        Ensure the transactions of the current month stored before the
+        ledger mark existed are added by the pending sweep.
+        """
+        before = LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ), self.client_account)
+
+        unmarked = Transaction(owner=self.client_account, date=dt.datetime.now()
+            - dt.timedelta(minutes=5), amount=Decimal('2.50'), interface='paypal',
+            operation=Transaction.OP_ASILINKS_FEE, type=Transaction.TYPE_CREDIT).save()
+        self.transactions.append(unmarked)
+        Transaction._get_collection().update_one({'_id': unmarked.id},
+            {'$unset': {'ledger_recorded': ''}})
+
+        self.assertEqual(LedgerBalance.record_pending(), 1)
+        LedgerBalance.record_pending()
+        self.assertEqual(LedgerBalance.balance((Transaction.OP_ASILINKS_FEE, ),
+            self.client_account), before + Decimal('2.50'))
+
+
+class FakePaypalHandler(BaseHTTPRequestHandler):
+    """
+    Minimal PayPal REST API: oauth token, payouts batches creation, with
+    sender_batch_id deduplication, and batch status lookup by id.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status_code, data):
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path.startswith('/v1/oauth2/token'):
+            return self.send_json(200, {'access_token': 'fake',
+                'token_type': 'Bearer', 'expires_in': 3600})
+
+        data = json.loads(body.decode())
+        sender_batch_id = data['sender_batch_header']['sender_batch_id']
+
+        if self.server.reject:
+            return self.send_json(400, {'name': 'INSUFFICIENT_FUNDS',
+                'message': 'Sender does not have sufficient funds.'})
+
+        if sender_batch_id in self.server.batches:
+            return self.send_json(400, {'name': 'USER_BUSINESS_ERROR',
+                'message': 'User business error.', 'debug_id': 'fake',
+                'details': [{'field': 'SENDER_BATCH_ID',
+                    'issue': 'Batch with given sender_batch_id already exists'}]})
+
+        payout_batch_id = 'FAKE{}'.format(len(self.server.batches) + 1)
+        self.server.batches[sender_batch_id] = (payout_batch_id, data['items'])
+
+        self.send_json(201, {'batch_header': {'payout_batch_id': payout_batch_id,
+            'batch_status': 'PENDING', 'sender_batch_header': data['sender_batch_header']}})
+
+    def do_GET(self):
+        payout_batch_id = self.path.partition('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+        for batch_id, items in self.server.batches.values():
+            if batch_id == payout_batch_id:
+                return self.send_json(200, {
+                    'batch_header': {'payout_batch_id': batch_id, 'batch_status': 'SUCCESS'},
+                    'items': [{'payout_batch_id': batch_id,
+                        'transaction_status': 'FAILED' if item['receiver'] in
+                            self.server.failing else 'SUCCESS',
+                        'payout_item': item} for item in items],
+                })
+
+        self.send_json(404, {'name': 'RESOURCE_NOT_FOUND'})
+
+
+class PayoutQueueTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), FakePaypalHandler)
+        self.server.batches = dict()
+        self.server.failing = set()
+        self.server.reject = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.partners = [Account.objects.get(email='user2@asilinks.com'),
+            Account.objects.get(email='user4@asilinks.com')]
+        self.server.failing.add(self.partners[1].paypal_email)
+
+        self.transactions = [Transaction.make_transaction(Decimal(amount),
+                Transaction.OP_PARTNER_SETTLEMENT, partner, interface='paypal',
+                defer_payout=True)
+            for amount, partner in (('100', self.partners[0]),
+                ('50', self.partners[1]), ('25.50', self.partners[0]))]
+
+        self.settings = override_settings(PAYPAL_API_OPTIONS={
+            'mode': 'sandbox', 'client_id': 'id', 'client_secret': 'secret',
+            'endpoint': 'http://127.0.0.1:{}'.format(self.server.server_port)})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+        for transaction in self.transactions:
+            transaction.delete()
+        LedgerBalance.rebuild(before=dt.datetime.max)
+        super().tearDown()
+
+    def statuses(self):
+        return [Transaction.objects.get(id=transaction.id).payout_status
+            for transaction in self.transactions]
+
+    def test_batched_payouts(self):
+        """
+        Ensure pending payouts go in one batch and are reconciled by item.
+        """
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_PENDING] * 3)
+
+        self.assertEqual(send_pending_payouts(), 3)
+        self.assertEqual(len(self.server.batches), 1)
+
+        sender_batch_id, (payout_batch_id, items) = list(self.server.batches.items())[0]
+        self.assertEqual([item['sender_item_id'] for item in items],
+            [str(transaction.id) for transaction in self.transactions])
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_SENT] * 3)
+
+        reconcile_payouts()
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_DONE,
+            Transaction.PAYOUT_FAILED, Transaction.PAYOUT_DONE])
+
+    def abandon_batch(self):
+        # Se pierde la respuesta de paypal y el lote queda abandonado.
+        Transaction.objects(id__in=[t.id for t in self.transactions]).update(
+            set__payout_status=Transaction.PAYOUT_SENDING,
+            unset__external_reference=True,
+            set__date_payout=dt.datetime.now() - dt.timedelta(days=1))
+
+    def test_resent_batch_is_not_a_failure(self):
+        """
+        Ensure a batch that paypal already accepted is left unconfirmed when
+        it is resent, without counting a failed attempt or queueing it again.
+        """
+        self.assertEqual(send_batch('paypal'), 3)
+        sender_batch_id = list(self.server.batches)[0]
+        self.abandon_batch()
+
+        with override_settings(PAYOUT_MAX_ATTEMPTS=1):
+            self.assertEqual(send_batch('paypal'), 3)
+
+        self.assertEqual(len(self.server.batches), 1)
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_UNCONFIRMED] * 3)
+
+        for transaction in self.transactions:
+            transaction.reload()
+            self.assertEqual(transaction.payout_batch, sender_batch_id)
+            self.assertEqual(transaction.payout_attempts, 0)
+
+        self.assertEqual(Transaction.requeue_payouts(self.partners[0]), 0)
+
+    def test_rejected_resent_batch_is_not_requeued(self):
+        """
+        Ensure a resent batch that runs out of attempts is not marked as
+        failed, since paypal may have accepted a previous send.
+        """
+        self.assertEqual(send_batch('paypal'), 3)
+        self.abandon_batch()
+        self.server.reject = True
+
+        with override_settings(PAYOUT_MAX_ATTEMPTS=1), self.assertRaises(PayoutError):
+            send_batch('paypal')
+
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_UNCONFIRMED] * 3)
+        self.assertEqual(Transaction.requeue_payouts(self.partners[0]), 0)
+
+    def test_failed_batch_counts_attempts(self):
+        """
+        Ensure a batch rejected by paypal counts an attempt and is kept to
+        be resent.
+        """
+        self.server.reject = True
+
+        with self.assertRaises(PayoutError):
+            send_batch('paypal')
+
+        self.assertEqual(self.server.batches, dict())
+        self.assertEqual(self.statuses(), [Transaction.PAYOUT_SENDING] * 3)
+        self.assertEqual(Transaction.objects.get(
+            id=self.transactions[0].id).payout_attempts, 1)
+
+    def test_missing_paypal_email(self):
+        """
+        Ensure a payout without paypal email fails with a notification, is
+        left out of the earned money and is queued again with the email.
+        """
+        partner = self.partners[1]
+        paypal_email = partner.paypal_email
+        unpaid = Transaction.unpaid_payouts(partner)
+        Account.objects(id=partner.id).update(unset__paypal_email=True)
+
+        try:
+            with mock.patch.object(Account, 'send_message') as send_message:
+                self.assertEqual(send_batch('paypal'), 2)
+
+            self.assertEqual(send_message.call_count, 1)
+            self.assertEqual(self.statuses()[1], Transaction.PAYOUT_FAILED)
+            self.assertEqual(Transaction.unpaid_payouts(partner), unpaid)
+        finally:
+            Account.objects(id=partner.id).update(set__paypal_email=paypal_email)
+
+        self.assertEqual(Transaction.requeue_payouts(partner), 1)
+        self.assertEqual(self.statuses()[1], Transaction.PAYOUT_PENDING)
+        self.assertEqual(Transaction.objects.get(
+            id=self.transactions[1].id).payout_batch, None)
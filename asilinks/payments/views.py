@@ -5,12 +5,14 @@ from django.conf import settings
 
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import ValidationError
-from rest_framework_mongoengine import viewsets
+from rest_framework_mongoengine import viewsets, generics
 from rest_framework.response import Response
 from mongoengine.queryset.visitor import Q
 
 from .documents import Transaction
-from .serializers import TransactionSerializer
+from .interfaces import ContextInterfaceError
+from .quotes import Quote, QuoteEngine
+from .serializers import TransactionSerializer, PaymentQuotesSerializer
 
 class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Transaction.objects.all()
@@ -75,3 +77,29 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
                 'date_end': self.filter_kwargs.get('date__lt', dt.datetime.now())
             })
         return Response(serializer.data)
+
+
+class PaymentQuotesView(generics.GenericAPIView):
+    """
+    Quotes the bills of several offers at once. The sponsor level defaults
+    to the one of the sponsor charged to the authenticated account.
+    """
+    permission_classes = (IsAuthenticated,)
+    serializer_class = PaymentQuotesSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        sponsor_level = request.user.get_sponsor().sponsor_level
+
+        quotes = [Quote(item['price'], item['partner_level'],
+                item.get('sponsor_level', sponsor_level), item['interface'])
+            for item in serializer.validated_data['quotes']]
+
+        try:
+            bills = QuoteEngine().quote_many(quotes)
+        except ContextInterfaceError as err:
+            raise ValidationError({'interface': err.error})
+
+        return Response({'quotes': bills})
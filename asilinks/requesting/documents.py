@@ -1,12 +1,14 @@
-import os
 import datetime as dt
 from decimal import Decimal, ROUND_HALF_UP
 
+from bson.objectid import ObjectId
 from django.conf import settings
-from django.core.files.base import ContentFile
 from django.utils.translation import ugettext as _
 from mongoengine import fields, document, CASCADE, NULLIFY, DENY, PULL
+from mongoengine.queryset.visitor import Q
+from pymongo import ReturnDocument
 
+from asilinks.bulk import BulkUpdate
 from asilinks.fields import TimeDeltaField, LocalStorageFileField
 from asilinks.storage_backends import PrivateMediaStorage
 
@@ -15,6 +17,13 @@ from admin.documents import DeliverableStore
 from admin.notification import PARTNER_MESSAGES
 from payments.documents import Transaction, Bill
 from payments.interfaces import get_interface
+from payments.quotes import QuoteEngine
+
+
+class TransitionError(Exception):
+    """
+    The request is no longer in a status the transition can start from.
+    """
 
 
 class Review(document.EmbeddedDocument):
@@ -22,6 +31,26 @@ class Review(document.EmbeddedDocument):
     comments = fields.StringField()
 
 
+class BillSnapshot(document.EmbeddedDocument):
+    """
+    Stored result of Request.calculate_bill, valid while its key matches.
+    """
+    AMOUNTS = ('partner', 'asilinks', 'sponsor', 'sponsor_percent',
+        'paypal', 'total', 'to_pay')
+
+    key = fields.StringField()
+    partner = fields.DecimalField(precision=2)
+    asilinks = fields.DecimalField(precision=2)
+    sponsor = fields.DecimalField(precision=2)
+    sponsor_percent = fields.DecimalField(precision=3)
+    paypal = fields.DecimalField(precision=2)
+    total = fields.DecimalField(precision=2)
+    to_pay = fields.DecimalField(precision=2)
+
+    def to_bill(self):
+        return {key: getattr(self, key) for key in self.AMOUNTS}
+
+
 class Request(document.Document):
 
     STATUS_TODO = 1
@@ -42,6 +71,40 @@ class Request(document.Document):
         (STATUS_UNSATISFIED, _('insatisfecho')),
     )
 
+    MATCHING_PENDING = 'pending'
+    MATCHING_RUNNING = 'running'
+    MATCHING_DONE = 'done'
+
+    MATCHING_CHOICES = (
+        (MATCHING_PENDING, _('pendiente')),
+        (MATCHING_RUNNING, _('en curso')),
+        (MATCHING_DONE, _('finalizado')),
+    )
+
+    # Tiempo tras el cual una seleccion en curso se considera abandonada.
+    MATCHING_TIMEOUT = dt.timedelta(minutes=10)
+    # Tiempo tras el cual una liquidacion pendiente se reintenta.
+    SETTLEMENT_TIMEOUT = dt.timedelta(minutes=10)
+
+    # Estados de cada lista de requerimientos de los perfiles.
+    STATUS_GROUPS = {
+        'todo': (STATUS_TODO,),
+        'in_progress': (STATUS_IN_PROGRESS, STATUS_DELIVERED,
+            STATUS_PENDING, STATUS_UNSATISFIED),
+        'done': (STATUS_DONE,),
+        'canceled': (STATUS_CANCELED,),
+    }
+
+    # Estados de origen permitidos para llegar a cada estado.
+    TRANSITIONS = {
+        STATUS_IN_PROGRESS: (STATUS_TODO,),
+        STATUS_DELIVERED: (STATUS_IN_PROGRESS,),
+        STATUS_PENDING: (STATUS_DELIVERED,),
+        STATUS_UNSATISFIED: (STATUS_PENDING,),
+        STATUS_DONE: (STATUS_PENDING, STATUS_UNSATISFIED),
+        STATUS_CANCELED: (STATUS_TODO, STATUS_IN_PROGRESS, STATUS_UNSATISFIED),
+    }
+
     name = fields.StringField(max_length=100)
     know_fields = fields.ListField(fields.ReferenceField('KnowField', reverse_delete_rule=DENY))
     description = fields.StringField(max_length=4000)
@@ -49,8 +112,10 @@ class Request(document.Document):
     country_alpha2 = fields.StringField(max_length=2, default=None)
     client = fields.ReferenceField('Client', reverse_delete_rule=CASCADE)
     last_read_client = fields.DateTimeField(default=dt.datetime.now)
+    unread_client = fields.IntField(default=0)
     partner = fields.ReferenceField('Partner', reverse_delete_rule=CASCADE)
     last_read_partner = fields.DateTimeField(default=dt.datetime.now)
+    unread_partner = fields.IntField(default=0)
     price = fields.DecimalField(min_value=0,
         precision=2, rounding=ROUND_HALF_UP)
     sponsor_percent = fields.DecimalField(precision=3)
@@ -59,6 +124,16 @@ class Request(document.Document):
     partner_review = fields.EmbeddedDocumentField('Review')
     status = fields.IntField(choices=STATUS_CHOICES, default=STATUS_TODO)
     round_partners = fields.EmbeddedDocumentListField('RoundPartner')
+    matching_status = fields.StringField(choices=MATCHING_CHOICES, default=MATCHING_DONE)
+    # Se incrementa en cada cambio visible del requerimiento.
+    version = fields.IntField(default=0)
+    date_matching = fields.DateTimeField()
+    # Lote del emparejamiento por lotes que reclamo el requerimiento.
+    matching_claim = fields.ObjectIdField(null=True)
+    # Cierre o cancelacion cuyos pagos o reembolsos aun no terminan.
+    settlement_pending = fields.BooleanField(default=False)
+    date_settlement = fields.DateTimeField()
+    date_matched = fields.DateTimeField()
     date_created = fields.DateTimeField()
     date_started = fields.DateTimeField()
     date_delivered = fields.DateTimeField()
@@ -67,15 +142,35 @@ class Request(document.Document):
     date_promise = fields.DateTimeField()
     date_unsatisfied = fields.DateTimeField()
 
-    com_channel = fields.EmbeddedDocumentListField('Message')
-    questions = fields.EmbeddedDocumentListField('Message')
     transactions = fields.ListField(
         fields.ReferenceField('Transaction'), reverse_delete_rule=PULL)
     time_extensions = fields.EmbeddedDocumentListField('TimeExtension')
+    bill = fields.EmbeddedDocumentField('BillSnapshot')
+
+    # Los requerimientos sin migrar aun conservan el chat embebido.
+    meta = {
+        'strict': False,
+        'indexes': [
+            ('status', 'date_created'),
+            ('client', 'status', 'date_created'),
+            ('partner', 'status', 'date_created'),
+            ('round_partners.partner', 'status', 'date_created'),
+        ],
+    }
 
     def __str__(self):
         return '{} > {}'.format(self.name, self.know_fields)
 
+    def save(self, *args, **kwargs):
+        if not self._created:
+            self.version = (self.version or 0) + 1
+
+        return super().save(*args, **kwargs)
+
+    def modify(self, query=None, **update):
+        update.setdefault('inc__version', 1)
+        return super().modify(query, **update)
+
     @classmethod
     def create_from_draft(cls, draft, client):
         attachment = getattr(draft, 'attachment', None)
@@ -83,6 +178,7 @@ class Request(document.Document):
         data = {
             'client': client,
             'date_created': dt.datetime.now(),
+            'matching_status': cls.MATCHING_PENDING,
             **{key: getattr(draft, key, None) 
                 for key in ('name', 'know_fields', 'description',
                     'extra_description', 'country_alpha2',)}
@@ -90,205 +186,339 @@ class Request(document.Document):
         instance = cls.objects.create(**data)
 
         if attachment:
-            filename = os.path.split(attachment.file.name)[-1]
-            content = ContentFile(attachment.file.read())
-
             message = Message(ts=dt.datetime.now(), owner=client.account,
                 type=Message.TYPE_DOC)
-            message.attachment.save(filename, content, save=False)
-            attachment.file.close()
+            message.attachment.copy_from(attachment, move=True)
 
-            instance.modify(push__questions=message)
+            instance.push_message(message, Message.CHANNEL_QUESTIONS)
 
         instance.client.modify(push__requests_todo=instance, last_activity=dt.datetime.now())
-        from .tasks import select_round_partners
-        select_round_partners(str(instance.id))
-        # result = select_round_partners.delay(str(instance.id))
 
-        draft.attachment.delete()
         client.modify(pull__requests_draft__date=draft.date)
+        instance.schedule_deadlines()
+
+        from .tasks import select_round_partners
+        select_round_partners.delay(str(instance.id))
         return instance
 
-    @property
-    def penalty_discount(self):
-        discount = settings.PENALTY_DISCOUNT
+    @classmethod
+    def client_filter(cls, client, groups):
+        """
+        Query of the requests of the client in the given status groups.
+        """
+        statuses = [status for group in groups
+            for status in cls.STATUS_GROUPS.get(group, ())]
+
+        return Q(client=client, status__in=statuses)
+
+    @classmethod
+    def partner_filter(cls, partner, groups):
+        """
+        Query of the requests of the partner in the given status groups,
+        either as selected partner or as round partner.
+        """
+        statuses = [status for group in groups if group != 'todo'
+            for status in cls.STATUS_GROUPS.get(group, ())]
+        query = Q(partner=partner, status__in=statuses)
+
+        def round_partner(rejected):
+            return Q(__raw__={'round_partners': {'$elemMatch': {
+                'partner': partner.pk, 'rejected': True if rejected else {'$ne': True}}}})
+
+        if 'todo' in groups:
+            query |= Q(status=cls.STATUS_TODO) & round_partner(False)
+
+        if 'rejected' in groups:
+            # Rechazados por el socio o por el cliente al aceptar otra oferta.
+            query |= round_partner(True)
+            query |= Q(partner__exists=True, partner__ne=partner) & round_partner(False)
+
+        if 'canceled' in groups:
+            query |= Q(status=cls.STATUS_CANCELED, partner__exists=False) & \
+                round_partner(False)
+
+        return query
+
+    @classmethod
+    def profile_list(cls, status):
+        """
+        Name of the Client/Partner list that holds the requests in the given status.
+        """
+        for group, statuses in cls.STATUS_GROUPS.items():
+            if status in statuses:
+                return 'requests_{}'.format(group)
+
+    def transition(self, status, bulk=None, activity=False, **update):
+        """
+        Moves the request to the given status with a single conditional
+        find_one_and_update over the allowed origin statuses, so concurrent
+        transitions can not apply twice. When a `bulk` is given, the moves
+        between the profiles lists are queued on it.
+        Returns the previous status or raises TransitionError.
+        """
+        previous = self.status
+
+        if not self.modify({'status__in': self.TRANSITIONS[status]},
+                status=status, **update):
+            raise TransitionError(
+                _('El requerimiento ya no se encuentra en un estado válido para esta acción.'))
+
+        if bulk is not None:
+            self.queue_list_moves(bulk, previous, activity=activity)
+
+        return previous
+
+    def queue_list_moves(self, bulk, previous, activity=False):
+        """
+        Queues on `bulk` the move of the request from the lists of the
+        previous status to the current ones, on the client and, once it was
+        selected, on the partner. The round partners are left to the caller.
+        """
+        source, target = self.profile_list(previous), self.profile_list(self.status)
+
+        if source == target:
+            return
+
+        moves = {'pull__{}'.format(source): self, 'push__{}'.format(target): self}
+        if activity:
+            bulk.update(self.client, set__last_activity=dt.datetime.now(), **moves)
+        else:
+            bulk.update(self.client, **moves)
+
+        if previous != self.STATUS_TODO and self.partner is not None:
+            bulk.update(self.partner, **moves)
+
+    def cancel(self, activity=False):
+        """
+        Cancels the request and, when it was already paid, refunds the
+        client and makes the bill. Returns the previous status.
+        """
+        now = dt.datetime.now()
+
+        with BulkUpdate() as bulk:
+            previous = self.transition(self.STATUS_CANCELED, bulk=bulk,
+                activity=activity, date_canceled=now,
+                settlement_pending=True, date_settlement=now)
+
+        self.settle()
+        return previous
 
+    def settle(self):
+        """
+        Runs the payments of the terminal status of the request: the
+        settlement once done, or the refund once canceled after being paid.
+        The steps stored by a previous attempt are skipped, and the pending
+        mark is cleared at the end.
+        """
+        if self.status == self.STATUS_DONE:
+            self.make_settlement()
+
+        elif self.status == self.STATUS_CANCELED and any(
+                t.operation == Transaction.OP_REQUEST_PAYMENT for t in self.transactions):
+            self.make_refund()
+
+            if not Bill.objects(item=self).count():
+                Bill.make_bill(self)
+
+        Request.objects(id=self.id).update_one(set__settlement_pending=False)
+        self.settlement_pending = False
+
+    @classmethod
+    def claim_settlement(cls, instance_id, now=None):
+        """
+        Takes a settlement left pending longer than SETTLEMENT_TIMEOUT and
+        returns the request, or None when another worker took it.
+        """
+        now = now or dt.datetime.now()
+
+        return cls.objects(id=instance_id, settlement_pending=True,
+            date_settlement__lt=now - cls.SETTLEMENT_TIMEOUT).modify(
+            date_settlement=now, new=True)
+
+    @classmethod
+    def claim_matching(cls, instance_id, round_partners=(), now=None):
+        """
+        Stores the round partners of a pending request and marks it as
+        matched in a single conditional write. Returns the request, or None
+        when another worker already matched it or is matching it right now.
+        """
+        now = now or dt.datetime.now()
+
+        return cls.objects(Q(id=instance_id) & Q(round_partners=[]) & (
+            Q(matching_status=cls.MATCHING_PENDING) |
+            Q(matching_status=cls.MATCHING_RUNNING,
+                date_matching__lt=now - cls.MATCHING_TIMEOUT))
+        ).modify(round_partners=list(round_partners),
+            matching_status=cls.MATCHING_DONE, date_matched=now,
+            unset__matching_claim=True, new=True)
+
+    @property
+    def penalty_day(self):
         if not self.date_promise:
-            return 0
+            return None
+
         diference = (self.date_delivered or dt.datetime.now()) - self.date_promise
-        return discount[max(0, min(diference.days, len(discount)-1))]
+        return max(0, min(diference.days, len(settings.PENALTY_DISCOUNT)-1))
 
-    def calculate_bill(self, round_partner=None, interface=None):
-        request_fees = settings.PAYMENT_CONSTANTS['request_fees']
-        first_client_payment = settings.PAYMENT_CONSTANTS['first_client_payment']
+    @property
+    def penalty_discount(self):
+        if self.penalty_day is None:
+            return 0
+        return settings.PENALTY_DISCOUNT[self.penalty_day]
 
-        if interface is None:
-            interface = self.transactions[0].interface
-        payment_interface = get_interface(interface)
+    @property
+    def bill_key(self):
+        # Solo cambia con el precio, el estado, el dia de penalizacion o
+        # las transacciones, sin desreferenciar ninguna de ellas.
+        transactions = self._data.get('transactions') or []
 
-        if self.partner is not None:
-            price = ((1 - self.penalty_discount) * self.price).quantize(
-                Decimal('.01'), rounding=ROUND_HALF_UP)
-            asilinks_percent = request_fees['total_fee'] - self.sponsor_percent
-        else:
-            sponsor = self.client.account.sponsor
-            rate_partner = {'gold': 2, 'silver': 1, 'bronze': 0}
-            rate_sponsor = {'a': 0, 'b': 1, 'c': 2}
+        return '{}:{}:{}:{}'.format(self.status, self.price,
+            self.penalty_day, len(transactions))
 
-            partner = round_partner.partner
-            price = round_partner.price
-            asilinks_percent = (request_fees['max_asilinks_fee']
-                - rate_partner[partner.level] * request_fees['asilinks_fee_rate']
-                + rate_sponsor[sponsor.sponsor_level] * request_fees['sponsor_fee_rate'])
+    def get_bill(self):
+        """
+        Returns the bill of the request with a selected partner from the
+        stored snapshot, computing and storing it only when its key changed.
+        """
+        if self._data.get('partner') is None:
+            return self.calculate_bill()
 
-        payout_fee = (payment_interface.calculate_payout_fee(price)
-            + payment_interface.calculate_payout_fee(price * (request_fees['total_fee']
-            - asilinks_percent)))
+        key = self.bill_key
+        snapshot = self.bill
 
-        asilinks_pay = (price * asilinks_percent).quantize(
-            Decimal('.01'), rounding=ROUND_HALF_UP)
+        if snapshot is None or snapshot.key != key:
+            snapshot = BillSnapshot(key=key, **self.calculate_bill())
 
-        fee_amount = (price * request_fees['total_fee']).quantize(
-            Decimal('.01'), rounding=ROUND_HALF_UP)
+            # Es un dato derivado, no cambia la version del requerimiento.
+            Request.objects(id=self.id).update_one(set__bill=snapshot)
+            self._data['bill'] = snapshot
 
-        sponsor_pay = fee_amount - asilinks_pay
+        return snapshot.to_bill()
 
-        result = {
-            'partner': price,
-            'asilinks': asilinks_pay,
-            'sponsor': sponsor_pay,
-            'sponsor_percent': request_fees['total_fee'] - asilinks_percent
-        }
+    def calculate_bill(self, round_partner=None, interface=None):
+        # Los montos de la factura en cada estado son los del motor de
+        # cotizaciones, asi una cotizacion coincide con el cobro real.
+        engine = QuoteEngine()
+
+        if interface is None:
+            interface = self.transactions[0].interface
+
+        if self.partner is not None:
+            price = engine.quantize((1 - self.penalty_discount) * self.price)
+            asilinks_percent = engine.total_fee - self.sponsor_percent
+        else:
+            price = round_partner.price
+            asilinks_percent = engine.asilinks_percents[(round_partner.partner.level,
+                self.client.account.get_sponsor().sponsor_level)]
 
         if self.status == Request.STATUS_TODO:
-            first_payment = ((price + fee_amount + payout_fee) * first_client_payment).quantize(
-                Decimal('.01'), rounding=ROUND_HALF_UP)
-            second_payment = price + fee_amount + payout_fee - first_payment
-            to_pay = payment_interface.calculate_payment_fee(first_payment) + first_payment
-            paypal_pay = payment_interface.calculate_payment_fee(first_payment) + \
-                payment_interface.calculate_payment_fee(second_payment) + payout_fee
-
-            result.update({
-                'paypal': paypal_pay,
-                'total': price + fee_amount + paypal_pay,
-                'to_pay': to_pay,
-            })
+            return engine.bill(price, asilinks_percent, interface)
 
         elif self.status in (Request.STATUS_DELIVERED, Request.STATUS_IN_PROGRESS):
-            first_payment, first_paypal_fee = self.transactions[0].payment_plus_fee
+            return engine.bill_in_progress(price, asilinks_percent, interface,
+                *self.transactions[0].payment_plus_fee)
 
-            second_payment = price + fee_amount + payout_fee - first_payment
-            paypal_pay = first_paypal_fee + payout_fee + \
-                payment_interface.calculate_payment_fee(second_payment)
-            to_pay = payment_interface.calculate_payment_fee(second_payment) + second_payment
+        return engine.bill_closed(price, asilinks_percent, interface,
+            [t.payment_plus_fee for t in self.transactions])
 
-            result.update({
-                'paypal': paypal_pay,
-                'total': price + fee_amount + paypal_pay,
-                'to_pay': to_pay,
-            })
+    def close(self):
+        # El cambio de estado se reclama antes de los pagos para no liquidar
+        # dos veces si una tarea y el cliente cierran a la vez; si los pagos
+        # fallan, la liquidacion queda pendiente y se reintenta.
+        now = dt.datetime.now()
 
-        else:
-            amounts, paypal_fees = zip(
-                *[t.payment_plus_fee for t in self.transactions])
+        with BulkUpdate() as bulk:
+            self.transition(self.STATUS_DONE, bulk=bulk, activity=True,
+                date_closed=now, settlement_pending=True, date_settlement=now)
 
-            result.update({
-                'paypal': sum(paypal_fees) + payout_fee,
-                'total': sum(amounts) + sum(paypal_fees),
-                'to_pay': Decimal('0'),
-            })
+        self.settle()
 
-        return result
+        # Send message to partner, request was satisfied
+        self.partner.account.send_message(context={'request': self},
+            data={'request_id': str(self.id), 'profile': 'partner'},
+            **PARTNER_MESSAGES['client_satisfied'])
 
-    def close(self):
-        bill = self.calculate_bill()
+    def make_settlement(self):
+        bill = self.get_bill()
+        # Los pagos al socio y al referente se envian luego por lotes.
         common = {
             'item': self,
             'interface': self.transactions[0].interface,
+            'defer_payout': True,
         }
-
-        transactions = [
-            Transaction.make_transaction(
-                    amount=bill['partner'],
-                    operation=Transaction.OP_PARTNER_SETTLEMENT,
-                    owner=self.partner.account,
-                    **common
-                ),
-            Transaction.make_transaction(
-                    amount=bill['sponsor'],
-                    operation=Transaction.OP_SPONSOR_FEE,
-                    owner=self.client.account,
-                    **common
-                ),
-            Transaction.make_transaction(
-                    amount=bill['asilinks'],
-                    operation=Transaction.OP_ASILINKS_FEE,
-                    owner=self.client.account,
-                    **common
-                ),
-            Transaction.make_transaction(
-                    amount=bill['paypal'],
-                    operation=Transaction.OP_PAYPAL_FEE,
-                    owner=self.client.account,
-                    **common
-                ),
+        operations = [
+            (bill['partner'], Transaction.OP_PARTNER_SETTLEMENT, self.partner.account),
+            (bill['sponsor'], Transaction.OP_SPONSOR_FEE, self.client.account),
+            (bill['asilinks'], Transaction.OP_ASILINKS_FEE, self.client.account),
+            (bill['paypal'], Transaction.OP_PAYPAL_FEE, self.client.account),
         ]
 
-        self.client.modify(
-            pull__requests_in_progress=self,
-            push__requests_done=self,
-            last_activity=dt.datetime.now())
-        self.partner.modify(
-            pull__requests_in_progress=self,
-            push__requests_done=self)
-        self.modify(push_all__transactions=transactions,
-            status=self.STATUS_DONE, date_closed=dt.datetime.now())
+        stored = {t.operation: t for t in Transaction.objects(item=self,
+            operation__in=[operation for _, operation, _ in operations])}
 
-        Bill.make_bill(self)
-        DeliverableStore.store_request(self)
+        transactions = [stored.get(operation) or Transaction.make_transaction(
+                amount=amount, operation=operation, owner=owner, **common)
+            for amount, operation, owner in operations]
 
-        # Send message to partner, request was satisfied
-        self.partner.account.send_message(context={'request': self},
-            data={'request_id': str(self.id), 'profile': 'partner'},
-            **PARTNER_MESSAGES['client_satisfied'])
+        self.modify(add_to_set__transactions=transactions)
+
+        if not Bill.objects(item=self).count():
+            Bill.make_bill(self)
+        if not DeliverableStore.objects(container=self).count():
+            DeliverableStore.store_request(self)
+
+        from payments.tasks import send_pending_payouts
+        send_pending_payouts.delay()
 
-    def refund(self):
-        if self.status in (self.STATUS_TODO, self.STATUS_DONE, self.STATUS_CANCELED):
+    def refund(self, status=None):
+        # `status` permite reembolsar tras la transicion a cancelado.
+        if (status or self.status) in (self.STATUS_TODO, self.STATUS_DONE, self.STATUS_CANCELED):
             raise ValueError('No se puede dinero en el estado actual que se encuentra el requerimiento.')
 
+        return self.make_refund()
+
+    def make_refund(self):
         max_asilinks_fee = settings.PAYMENT_CONSTANTS['request_fees']['max_asilinks_fee']
         flat_paypal_fee = settings.PAYMENT_CONSTANTS['paypal_fees']['flat']
         interface = self.transactions[0].interface
         payment_interface = get_interface(interface)
-        refund_transactions = []
+        payments = [t for t in self.transactions
+            if t.operation == Transaction.OP_REQUEST_PAYMENT]
+
+        # Las transacciones de un intento anterior no se repiten.
+        stored = list(Transaction.objects(item=self, operation__in=(
+            Transaction.OP_ASILINKS_FEE, Transaction.OP_PAYPAL_FEE,
+            Transaction.OP_REFUND)).order_by('date'))
+
+        def stored_of(operation):
+            return [t for t in stored if t.operation == operation]
 
         asilinks_pay = (self.price * max_asilinks_fee).quantize(
             Decimal('.01'), rounding=ROUND_HALF_UP)
-        refund_transactions.append(
+        refund_transactions = stored_of(Transaction.OP_ASILINKS_FEE)[:1] or [
             Transaction.make_transaction(asilinks_pay, owner=self.client.account,
                 operation=Transaction.OP_ASILINKS_FEE, interface=interface, item=self)
-        )
+        ]
 
         paypal_pay = payment_interface.calculate_payment_fee(asilinks_pay)
-        count_payments = sum([r.operation == Transaction.OP_REQUEST_PAYMENT for r in self.transactions])
-        paypal_pay += (Decimal('0'), flat_paypal_fee)[count_payments > 1]
+        paypal_pay += (Decimal('0'), flat_paypal_fee)[len(payments) > 1]
 
-        refund_transactions.append(
+        refund_transactions += stored_of(Transaction.OP_PAYPAL_FEE)[:1] or [
             Transaction.make_transaction(paypal_pay, owner=self.client.account,
                 operation=Transaction.OP_PAYPAL_FEE, interface=interface, item=self)
-        )
+        ]
 
-        commission_charged = False
-        for t in self.transactions:
-            if not commission_charged:
-                refund = t.refund(t.amount - (asilinks_pay + paypal_pay))
-                commission_charged = True
+        # La comision se descuenta del primer pago.
+        refunds = stored_of(Transaction.OP_REFUND)
+        for index, t in enumerate(payments[len(refunds):], len(refunds)):
+            if index == 0:
+                refunds.append(t.refund(t.amount - (asilinks_pay + paypal_pay)))
             else:
-                refund = t.refund()
-            refund_transactions.append(refund)
+                refunds.append(t.refund())
+        refund_transactions += refunds
 
         total_fee = asilinks_pay + paypal_pay
-        self.modify(push_all__transactions=refund_transactions)
+        self.modify(add_to_set__transactions=refund_transactions)
 
         return {
             'asilinks': asilinks_pay,
@@ -312,18 +542,51 @@ class Request(document.Document):
         self.client.save()
 
     def update_last_read(self, account):
+        # Las marcas de lectura no cambian la version del requerimiento.
         if self.client == account.client_profile:
-            self.modify(last_read_client=dt.datetime.now())
+            Request.objects(id=self.id).update_one(
+                set__last_read_client=dt.datetime.now(), set__unread_client=0)
 
         elif self.status != Request.STATUS_TODO:
             if self.partner == account.partner_profile:
-                self.modify(last_read_partner=dt.datetime.now())
+                Request.objects(id=self.id).update_one(
+                    set__last_read_partner=dt.datetime.now(), set__unread_partner=0)
 
         else:
             round_partner = self.round_partners.get(
                 partner=account.partner_profile)
             round_partner.last_read = dt.datetime.now()
-            self.save()
+            round_partner.unread = 0
+
+            self.update_round_partners([account.partner_profile], version=False,
+                last_read=round_partner.last_read, unread=0)
+
+    def update_round_partners(self, partners, query=None, match=None,
+            version=True, **values):
+        """
+        Sets the given fields of the round partners of the given partners
+        with a single arrayFilters update, instead of saving the whole
+        document. The extra raw `query` conditions the request and `match`
+        the round partners. Returns True when the request matched.
+        """
+        update = {'$set': dict()}
+
+        for name, value in values.items():
+            field = RoundPartner._fields[name]
+            update['$set']['round_partners.$[rp].{}'.format(field.db_field)] = \
+                None if value is None else field.to_mongo(value)
+
+        if version:
+            update['$inc'] = {'version': 1}
+
+        array_filter = {'rp.{}'.format(key): value for key, value in (match or {}).items()}
+        array_filter['rp.partner'] = {'$in': [getattr(partner, 'pk', partner)
+            for partner in partners]}
+
+        result = Request._get_collection().update_one(dict(query or {}, _id=self.id),
+            update, array_filters=[array_filter])
+
+        return result.matched_count > 0
 
     def get_last_read(self,account):
 
@@ -340,16 +603,112 @@ class Request(document.Document):
 
         raise ValueError("This account don't belong to this request")
 
+    def get_channel(self):
+        if self.status == self.STATUS_TODO:
+            return Message.CHANNEL_QUESTIONS
+
+        return Message.CHANNEL_COM
+
+    def messages(self, channel=None):
+        return Message.objects(request=self, channel=channel or self.get_channel())
+
+    def message_window(self, channel=None, before=None, limit=None):
+        """
+        Returns, in chronological order, the last `limit` messages of the
+        channel sent before the given datetime that are not responses,
+        followed by the responses to them wherever they were sent.
+        """
+        queryset = self.messages(channel).filter(reference_ts=None)
+
+        if before is not None:
+            queryset = queryset.filter(ts__lt=before)
+
+        window = list(queryset.order_by('-ts').limit(limit or Message.WINDOW_SIZE))
+        window.reverse()
+
+        if window:
+            window.extend(self.messages(channel).filter(
+                reference_ts__in=[message.ts for message in window]).order_by('ts'))
+        return window
+
+    def push_message(self, message, channel=None):
+        message.request = self
+        message.channel = channel or self.get_channel()
+        message.save(force_insert=True)
+
+        # Incrementa los mensajes sin leer de los participantes del canal,
+        # salvo el que lo envia y los socios que rechazaron la ronda.
+        raw = self.to_mongo()
+        owner = message.owner.to_mongo() if message.owner is not None else dict()
+        sender_partner = owner.get('partner_profile')
+        unread, array_filters = dict(), None
+
+        if owner.get('client_profile') is None or owner['client_profile'] != raw.get('client'):
+            unread['unread_client'] = 1
+
+        if message.channel == Message.CHANNEL_QUESTIONS:
+            unread['round_partners.$[rp].unread'] = 1
+            round_partner = {'rp.rejected': {'$ne': True}}
+            if sender_partner is not None:
+                round_partner['rp.partner'] = {'$ne': sender_partner}
+            array_filters = [round_partner]
+
+        elif sender_partner is None or sender_partner != raw.get('partner'):
+            unread['unread_partner'] = 1
+
+        Request._get_collection().update_one({'_id': self.id},
+            {'$inc': dict(unread, version=1)}, array_filters=array_filters)
+
+        from .events import publish_message
+        publish_message(message)
+        return message
+
+    def count_unread(self):
+        """
+        Computes the unread counters of every participant from the last
+        read dates, leaving out the messages each one sent. Returns the raw
+        `$set` update.
+        """
+        raw = self.to_mongo()
+        messages = self.messages()
+        partners = [raw.get('partner'), *[item.get('partner')
+            for item in raw.get('round_partners', [])]]
+        accounts = {item['_id']: item.get('account') for item in Partner.objects(
+            id__in=[key for key in partners if key]).only('account').as_pymongo()}
+        client = Client.objects(id=raw.get('client')).only('account').as_pymongo().first()
+
+        def count(last_read, account):
+            queryset = messages.filter(ts__gt=last_read)
+            if account is not None:
+                queryset = queryset.filter(owner__ne=account)
+            return queryset.count()
+
+        unread = {
+            'unread_client': count(self.last_read_client, (client or {}).get('account')),
+            'unread_partner': count(self.last_read_partner, accounts.get(raw.get('partner')))
+                if self.partner else 0,
+        }
+
+        for i, round_partner in enumerate(raw.get('round_partners', [])):
+            unread['round_partners.{}.unread'.format(i)] = count(
+                round_partner.get('last_read'), accounts.get(round_partner.get('partner'))) \
+                if self.status == self.STATUS_TODO and not round_partner.get('rejected') else 0
+
+        return unread
+
     def new_messages(self, account):
-        last_read = self.get_last_read(account)
+        if account.client_profile == self.client:
+            return self.unread_client
 
-        if self.status == self.STATUS_TODO:
-            channel = self.questions
+        if account.has_partner_profile():
+            if account.partner_profile == self.partner:
+                return self.unread_partner
 
-        else:
-            channel = self.com_channel
+            else:
+                return self.round_partners.get(
+                    partner=account.partner_profile).unread
 
-        return sum([last_read < message.ts for message in channel])
+        raise ValueError("This account don't belong to this request")
 
     def new_offers(self):
         if self.status == self.STATUS_TODO:
@@ -359,6 +718,9 @@ class Request(document.Document):
 
         return 0
 
+    def schedule_deadlines(self):
+        Deadline.schedule_for_status(self)
+
     def can_be_canceled(self) -> bool:
         now = dt.datetime.now()
 
@@ -386,6 +748,7 @@ class RoundPartner(document.EmbeddedDocument):
     partner = fields.ReferenceField('Partner')
     date_notification = fields.DateTimeField()
     last_read = fields.DateTimeField(default=dt.datetime.now)
+    unread = fields.IntField(default=0)
     date_response = fields.DateTimeField()
     rejected = fields.BooleanField(default=False)
     price = fields.DecimalField(min_value=0, 
@@ -399,7 +762,19 @@ class RoundPartner(document.EmbeddedDocument):
         return self.partner.account.email
 
 
-class Message(document.EmbeddedDocument):
+class Message(document.Document):
+
+    CHANNEL_QUESTIONS = 'questions'
+    CHANNEL_COM = 'com_channel'
+
+    CHANNEL_CHOICES = (
+        (CHANNEL_QUESTIONS, _('preguntas')),
+        (CHANNEL_COM, _('comunicacion')),
+    )
+
+    # Cantidad de mensajes por ventana del chat.
+    WINDOW_SIZE = 50
+    WINDOW_MAX_SIZE = 200
 
     TYPE_VOICE = 'voice'
     TYPE_IMAGE = 'image'
@@ -434,6 +809,8 @@ class Message(document.EmbeddedDocument):
         ),
     }
 
+    request = fields.ReferenceField('Request', reverse_delete_rule=CASCADE)
+    channel = fields.StringField(choices=CHANNEL_CHOICES)
     owner = fields.ReferenceField('Account')
     type = fields.StringField(choices=TYPE_CHOICES, default=TYPE_TEXT)
     content = fields.StringField(max_length=200)
@@ -443,6 +820,11 @@ class Message(document.EmbeddedDocument):
     reference_ts = fields.DateTimeField()
     last_delivery = fields.BooleanField(default=False)
 
+    meta = {'indexes': [
+        ('request', 'channel', 'ts'),
+        ('request', 'channel', 'reference_ts', 'ts'),
+    ]}
+
 
 class TimeExtension(document.EmbeddedDocument):
     duration = TimeDeltaField()
@@ -450,3 +832,192 @@ class TimeExtension(document.EmbeddedDocument):
     date_created = fields.DateTimeField()
     date_closed = fields.DateTimeField()
     approve = fields.BooleanField(default=None)
+
+
+class RequestEvent(document.Document):
+    """
+    Message and offer events of a request, read by the events long-poll in
+    the order of their numbers. Stored in a capped collection, so old events
+    are discarded.
+    """
+
+    KIND_MESSAGE = 'message'
+    KIND_OFFER = 'offer'
+
+    KIND_CHOICES = (
+        (KIND_MESSAGE, _('mensaje')),
+        (KIND_OFFER, _('oferta')),
+    )
+
+    # Numero del evento, tomado de un contador en el servidor.
+    seq = fields.SequenceField()
+    request = fields.ObjectIdField(required=True)
+    kind = fields.StringField(choices=KIND_CHOICES)
+    data = fields.DictField()
+    date = fields.DateTimeField(default=dt.datetime.now)
+
+    meta = {
+        'max_documents': 100000,
+        'max_size': 64 * 2 ** 20,
+        'indexes': [
+            'seq',
+            ('request', 'seq'),
+        ],
+    }
+
+
+class Deadline(document.Document):
+    """
+    Timed action over a request, written when the request changes state
+    and fired by the dispatch_deadlines task once due_at is reached.
+    """
+
+    ACTION_NOTIFY = 'notify'
+    ACTION_REFRESH = 'refresh'
+    ACTION_CANCEL_TODO = 'cancel_todo'
+    ACTION_CANCEL_UNSATISFIED = 'cancel_unsatisfied'
+    ACTION_FAIL = 'fail'
+    ACTION_CLOSE = 'close'
+
+    ACTION_CHOICES = (
+        (ACTION_NOTIFY, _('notificar socios')),
+        (ACTION_REFRESH, _('refrescar socios')),
+        (ACTION_CANCEL_TODO, _('cancelar iniciado')),
+        (ACTION_CANCEL_UNSATISFIED, _('cancelar insatisfecho')),
+        (ACTION_FAIL, _('cancelar por incumplimiento')),
+        (ACTION_CLOSE, _('cerrar pagado')),
+    )
+
+    TODO_ACTIONS = (ACTION_NOTIFY, ACTION_REFRESH, ACTION_CANCEL_TODO)
+
+    # Ciclos de un requerimiento iniciado y frecuencia de sus acciones.
+    TODO_CYCLE = dt.timedelta(hours=36)
+    TODO_REPEAT = dt.timedelta(hours=6)
+    NOTIFY_CYCLES = 1
+    REFRESH_CYCLES = 2
+    CANCEL_CYCLES = 6
+
+    UNSATISFIED_TIMEOUT = dt.timedelta(hours=48)
+    FAILURE_TIMEOUT = dt.timedelta(days=7, hours=48)
+    CLOSE_TIMEOUT = dt.timedelta(hours=48)
+
+    # Tiempo que un despachador retiene un vencimiento antes de liberarlo.
+    LEASE_TIMEOUT = dt.timedelta(minutes=10)
+
+    request = fields.ReferenceField('Request', reverse_delete_rule=CASCADE)
+    action = fields.StringField(choices=ACTION_CHOICES)
+    due_at = fields.DateTimeField()
+    attempts = fields.IntField(default=0)
+    lease = fields.ObjectIdField(null=True)
+
+    meta = {'indexes': [
+        'due_at',
+        {'fields': ['request', 'action'], 'unique': True},
+    ]}
+
+    @classmethod
+    def schedule(cls, request, action, due_at, attempts=0):
+        cls.objects(request=request, action=action).update_one(
+            set__due_at=due_at, set__attempts=attempts, unset__lease=True, upsert=True)
+
+    @classmethod
+    def discard(cls, request, *actions):
+        queryset = cls.objects(request=request)
+
+        if actions:
+            queryset = queryset.filter(action__in=actions)
+        queryset.delete()
+
+    @classmethod
+    def next_todo_action(cls, date_created, now):
+        """
+        Returns the (action, due_at) that follows for a todo request
+        created at the given date.
+        """
+        notify_at = date_created + cls.TODO_CYCLE * cls.NOTIFY_CYCLES
+        refresh_at = date_created + cls.TODO_CYCLE * cls.REFRESH_CYCLES
+        cancel_at = date_created + cls.TODO_CYCLE * cls.CANCEL_CYCLES
+
+        if now < notify_at:
+            return cls.ACTION_NOTIFY, notify_at
+        elif now < refresh_at:
+            if now + cls.TODO_REPEAT < refresh_at:
+                return cls.ACTION_NOTIFY, now + cls.TODO_REPEAT
+            return cls.ACTION_REFRESH, refresh_at
+        elif now < cancel_at:
+            if now + cls.TODO_REPEAT < cancel_at:
+                return cls.ACTION_REFRESH, now + cls.TODO_REPEAT
+            return cls.ACTION_CANCEL_TODO, cancel_at
+        return cls.ACTION_CANCEL_TODO, now
+
+    @classmethod
+    def schedule_todo(cls, request, now=None):
+        action, due_at = cls.next_todo_action(request.date_created,
+            now or dt.datetime.now())
+
+        cls.discard(request, *[item for item in cls.TODO_ACTIONS if item != action])
+        cls.schedule(request, action, due_at)
+
+    @classmethod
+    def due_for_status(cls, request):
+        """
+        Returns the (action, due_at) of a request in progress, unsatisfied
+        or pending, or None for any other status.
+        """
+        action, date, timeout = {
+            Request.STATUS_IN_PROGRESS: (cls.ACTION_FAIL,
+                request.date_promise, cls.FAILURE_TIMEOUT),
+            Request.STATUS_UNSATISFIED: (cls.ACTION_CANCEL_UNSATISFIED,
+                request.date_unsatisfied, cls.UNSATISFIED_TIMEOUT),
+            Request.STATUS_PENDING: (cls.ACTION_CLOSE,
+                request.date_delivered, cls.CLOSE_TIMEOUT),
+        }.get(request.status, (None, None, None))
+
+        if action is None or date is None:
+            return None
+        return action, date + timeout
+
+    @classmethod
+    def schedule_for_status(cls, request, now=None):
+        """
+        Schedules the deadline that corresponds to the current status of
+        the request, discarding the ones of previous states.
+        """
+        if request.status == Request.STATUS_TODO:
+            return cls.schedule_todo(request, now=now)
+
+        due = cls.due_for_status(request)
+
+        if due is None:
+            return cls.discard(request)
+
+        action, due_at = due
+        cls.discard(request, *[item for item, label in cls.ACTION_CHOICES if item != action])
+        cls.schedule(request, action, due_at)
+
+    @classmethod
+    def claim_due(cls, now=None, limit=500):
+        """
+        Yields the due deadlines, leasing each one atomically so that it is
+        fired only once even with several dispatchers. A leased deadline
+        that is not released becomes due again once the lease expires.
+        """
+        now = now or dt.datetime.now()
+        collection = cls._get_collection()
+
+        for attempt in range(limit):
+            raw = collection.find_one_and_update({'due_at': {'$lte': now}},
+                {'$set': {'due_at': now + cls.LEASE_TIMEOUT, 'lease': ObjectId()},
+                    '$inc': {'attempts': 1}},
+                sort=[('due_at', 1)], return_document=ReturnDocument.AFTER)
+
+            if raw is None:
+                break
+            yield cls._from_son(raw)
+
+    @classmethod
+    def release(cls, deadline):
+        """
+        Removes a fired deadline, unless it was scheduled again meanwhile.
+        """
+        cls._get_collection().delete_one({'_id': deadline.id, 'lease': deadline.lease})
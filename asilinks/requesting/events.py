@@ -0,0 +1,170 @@
+import time
+import threading
+import datetime as dt
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class MongoEventBroker(object):
+    """
+    Stores the events in the capped RequestEvent collection, numbered by a
+    counter incremented in the server. Listeners poll it with the number of
+    the last event they read as cursor. A number is taken before its event
+    is inserted, so a gap in the numbers is only skipped once the events
+    after it are older than `gap_timeout`.
+    """
+
+    def __init__(self, interval=1, gap_timeout=dt.timedelta(seconds=5), limit=1000):
+        self.interval = interval
+        self.gap_timeout = gap_timeout
+        self.limit = limit
+
+    def publish(self, request_id, kind, data):
+        from .documents import RequestEvent
+        event = RequestEvent(request=request_id, kind=kind, data=data).save()
+        return to_representation(event.to_mongo())
+
+    def last(self):
+        from .documents import RequestEvent
+        raw = RequestEvent._get_collection().find_one({}, ('seq', ), sort=[('seq', -1)])
+        return raw['seq'] if raw else 0
+
+    def fetch(self, request_ids, after):
+        from .documents import RequestEvent
+        collection = RequestEvent._get_collection()
+        settled = dt.datetime.now() - self.gap_timeout
+
+        # Avanza el cursor sobre los numeros consecutivos de todos los eventos.
+        head = after
+        for raw in collection.find({'seq': {'$gt': after}}, ('seq', 'date')).sort(
+                'seq', 1).limit(self.limit):
+            if raw['seq'] != head + 1 and raw['date'] > settled:
+                break
+            head = raw['seq']
+
+        if head == after:
+            return after, []
+
+        return head, [to_representation(raw) for raw in collection.find(
+            {'request': {'$in': request_ids}, 'seq': {'$gt': after, '$lte': head}}
+            ).sort('seq', 1)]
+
+    def listen(self, request_ids, after, timeout):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            cursor, events = self.fetch(request_ids, after)
+
+            if events or time.monotonic() >= deadline:
+                return cursor, events
+
+            after = cursor
+            time.sleep(self.interval)
+
+
+class LocalEventBroker(object):
+    """
+    In-process broker, for tests and single process deployments.
+    """
+
+    def __init__(self):
+        self.events = list()
+        self.condition = threading.Condition()
+
+    def publish(self, request_id, kind, data):
+        with self.condition:
+            raw = {'_id': ObjectId(), 'seq': len(self.events) + 1, 'request': request_id,
+                'kind': kind, 'data': data, 'date': dt.datetime.now()}
+            self.events.append(raw)
+            self.condition.notify_all()
+
+        return to_representation(raw)
+
+    def last(self):
+        return len(self.events)
+
+    def fetch(self, request_ids, after):
+        request_ids = set(request_ids)
+        return len(self.events), [to_representation(raw) for raw in self.events[after:]
+            if raw['request'] in request_ids]
+
+    def listen(self, request_ids, after, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fetch(request_ids, after)[1], timeout)
+            return self.fetch(request_ids, after)
+
+
+_brokers = dict()
+_listeners = threading.BoundedSemaphore(settings.REQUEST_EVENTS_MAX_LISTENERS)
+
+
+def get_broker():
+    path = settings.REQUEST_EVENTS_BROKER
+
+    if path not in _brokers:
+        _brokers[path] = import_string(path)()
+
+    return _brokers[path]
+
+
+def to_representation(raw):
+    return {
+        'id': str(raw['_id']),
+        'seq': raw['seq'],
+        'request': str(raw['request']),
+        'kind': raw['kind'],
+        'date': raw['date'].strftime('%s.%f'),
+        'data': raw.get('data', {}),
+    }
+
+
+def publish_message(message):
+    from .documents import RequestEvent
+
+    # La entrega no se expone hasta que el requerimiento sea pagado.
+    return get_broker().publish(message.request.id, RequestEvent.KIND_MESSAGE, {
+        'channel': message.channel,
+        'type': message.type,
+        'owner': str(message.owner.id) if message.owner else None,
+        'content': None if message.last_delivery else message.content,
+        'ts': message.ts.strftime('%s.%f'),
+        'reference_ts': message.reference_ts and message.reference_ts.strftime('%s.%f'),
+    })
+
+
+def publish_offer(request, round_partner):
+    from .documents import RequestEvent
+
+    return get_broker().publish(request.id, RequestEvent.KIND_OFFER, {
+        'partner': str(round_partner.partner.id),
+        'price': str(round_partner.price),
+        'duration': round_partner.duration // dt.timedelta(hours=1),
+        'date_response': round_partner.date_response.strftime('%s.%f'),
+    })
+
+
+def listen(request_ids, after=None, timeout=None):
+    """
+    Waits up to `timeout` seconds for the events of the given requests
+    published after the `after` cursor. Only REQUEST_EVENTS_MAX_LISTENERS
+    requests of the process wait at once, the others return right away.
+    Returns (cursor, events).
+    """
+    broker = get_broker()
+    after = int(after) if after else broker.last()
+    timeout = settings.REQUEST_EVENTS_TIMEOUT if timeout is None else timeout
+
+    if after < 0:
+        raise ValueError('El cursor no puede ser negativo.')
+
+    waiting = _listeners.acquire(blocking=False)
+    try:
+        cursor, events = broker.listen(list(request_ids), after,
+            timeout if waiting else 0)
+    finally:
+        if waiting:
+            _listeners.release()
+
+    return str(cursor), events
@@ -0,0 +1,211 @@
+import datetime as dt
+from collections import defaultdict
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from asilinks.bulk import BulkUpdate
+from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
+from authentication.documents import Account
+from fcm.documents import FCMDevice
+from main.documents import Client, Partner, CandidateIndex
+from main.sampling import get_random_state
+from main.scoring import partner_scores
+
+from .documents import Request, RoundPartner
+
+
+class BatchMatcher(object):
+    """
+    Assigns round partners to a batch of requests loading the clients,
+    the candidates and the partners scores once, and persists the whole
+    batch with a bulk write per collection. The requests are claimed under
+    a batch id first, so concurrent matchings skip them.
+    """
+
+    def __init__(self, samples=4, random_state=None):
+        self.samples = samples
+        self.random_state = get_random_state(random_state)
+
+    def claim(self, queryset):
+        """
+        Marks as running the unmatched requests of the queryset that no
+        other worker is matching, under a new batch id.
+        """
+        now = dt.datetime.now()
+        self.claim_id = ObjectId()
+
+        Request._get_collection().update_many(
+            {'_id': {'$in': list(queryset.scalar('id'))},
+                'status': Request.STATUS_TODO, 'round_partners': [],
+                '$or': [{'matching_status': {'$ne': Request.MATCHING_RUNNING}},
+                    {'date_matching': {'$lt': now - Request.MATCHING_TIMEOUT}}]},
+            {'$set': {'matching_status': Request.MATCHING_RUNNING,
+                'date_matching': now, 'matching_claim': self.claim_id}})
+
+        return Request.objects(matching_claim=self.claim_id)
+
+    def load(self, queryset):
+        self.requests = list(self.claim(queryset).no_dereference().only(
+            'id', 'name', 'client', 'know_fields', 'country_alpha2'))
+        raw_requests = [instance.to_mongo() for instance in self.requests]
+
+        clients = {raw['_id']: raw for raw in Client.objects(
+            id__in=list({raw['client'] for raw in raw_requests}))
+            .only('account', 'favorite_partners').as_pymongo()}
+
+        profiles = {raw['_id']: raw.get('partner_profile') for raw in Account.objects(
+            id__in=[client.get('account') for client in clients.values()])
+            .only('partner_profile').as_pymongo()}
+
+        know_fields = {know_field for raw in raw_requests
+            for know_field in raw.get('know_fields', [])}
+
+        self.by_field, self.by_country = defaultdict(set), defaultdict(set)
+        for entry in CandidateIndex.objects(
+                know_field__in=list(know_fields)).as_pymongo():
+            partners = set(entry.get('partners', []))
+            self.by_field[entry['know_field']] |= partners
+            self.by_country[(entry['know_field'], entry.get('alpha2'))] |= partners
+
+        self.raw_requests = raw_requests
+        self.clients = clients
+        self.profiles = profiles
+
+    def candidates(self, raw):
+        know_fields = raw.get('know_fields', [])
+        alpha2 = raw.get('country_alpha2')
+
+        if alpha2:
+            return set().union(*[self.by_country.get((know_field, alpha2), ())
+                for know_field in know_fields])
+
+        return set().union(*[self.by_field.get(know_field, ())
+            for know_field in know_fields])
+
+    def assign(self):
+        """
+        Computes in memory the round partners of every loaded request.
+        Returns a list of (request, favorites ids, selected ids).
+        """
+        plan = list()
+        pools = list()
+
+        for instance, raw in zip(self.requests, self.raw_requests):
+            client = self.clients.get(raw['client'], {})
+            know_fields = set(raw.get('know_fields', []))
+
+            # Filtra socios favoritos por area de conocimiento.
+            favorites = list({fp['partner'] for fp in client.get('favorite_partners', [])
+                if fp.get('partner') and fp.get('know_field') in know_fields})
+
+            excluded = set(favorites)
+            profile = self.profiles.get(client.get('account'))
+            if profile:
+                excluded.add(profile)
+
+            pools.append(self.candidates(raw) - excluded)
+            plan.append((instance, favorites))
+
+        candidates = list(set().union(*pools))
+        partner_scores.ensure([str(key) for key in candidates])
+
+        # Las oportunidades asignadas en el lote se suman a la carga de cada
+        # socio, repartiendo los requerimientos entre el pool.
+        loads = {str(raw['_id']): raw.get('open_opportunities', 0)
+            for raw in Partner.objects(id__in=candidates)
+                .only('open_opportunities').as_pymongo()}
+
+        assignments = list()
+        for (instance, favorites), pool in zip(plan, pools):
+            if not pool:
+                assignments.append((instance, [], []))
+                continue
+
+            selected = partner_scores.select(pool, samples=self.samples,
+                random_state=self.random_state, loads=loads)
+            for key in selected:
+                loads[key] = loads.get(key, 0) + 1
+
+            assignments.append((instance, favorites,
+                [ObjectId(key) for key in selected]))
+
+        return assignments
+
+    def persist(self, assignments):
+        """
+        Writes the round partners of the claimed requests and pushes the
+        opportunities of the requests actually written, which are returned.
+        """
+        now = dt.datetime.now()
+        request_ops = list()
+
+        for instance, favorites, selected in assignments:
+            update = {'$set': {'matching_status': Request.MATCHING_DONE,
+                'date_matched': now}, '$unset': {'matching_claim': ''}}
+
+            partners = [*favorites, *selected]
+            if partners:
+                update['$set']['round_partners'] = [RoundPartner(partner=partner_id,
+                    date_notification=now).to_mongo() for partner_id in partners]
+                update['$inc'] = {'version': 1}
+
+            # Solo escribe si el requerimiento sigue reclamado por este lote.
+            request_ops.append(UpdateOne({'_id': instance.id, 'round_partners': [],
+                'status': Request.STATUS_TODO, 'matching_claim': self.claim_id}, update))
+
+        collection = Request._get_collection()
+        result = collection.bulk_write(request_ops, ordered=False)
+
+        # Los que no se escribieron cambiaron de estado durante el lote.
+        skipped = set()
+        if result.modified_count < len(request_ops):
+            skipped = set(Request.objects(matching_claim=self.claim_id).scalar('id'))
+            collection.update_many({'matching_claim': self.claim_id},
+                {'$set': {'matching_status': Request.MATCHING_DONE},
+                    '$unset': {'matching_claim': ''}})
+
+        written = [assignment for assignment in assignments
+            if assignment[0].id not in skipped]
+
+        with BulkUpdate() as bulk:
+            for instance, favorites, selected in written:
+                for partner_id in (*favorites, *selected):
+                    Partner.push_opportunity(bulk, partner_id, instance.id)
+
+        return written
+
+    def notify(self, assignments):
+        """
+        Sends one multicast per request to the devices of its round partners,
+        reading the partners accounts once for the whole batch.
+        """
+        partners = {partner_id for _, favorites, selected in assignments
+            for partner_id in (*favorites, *selected)}
+        accounts = {raw['_id']: raw.get('account') for raw in Partner.objects(
+            id__in=list(partners)).only('account').as_pymongo()}
+
+        for instance, favorites, selected in assignments:
+            owners = [accounts[partner_id] for partner_id in (*favorites, *selected)
+                if accounts.get(partner_id)]
+
+            if owners:
+                FCMDevice.objects(owner__in=owners).send_message(
+                    data={'request_id': str(instance.id), 'profile': 'partner'},
+                    **PARTNER_MESSAGES['have_an_opportunity'])
+            else:
+                client = self.clients.get(instance.to_mongo()['client'], {})
+                FCMDevice.objects(owner=client.get('account')).send_message(
+                    context={'request': instance},
+                    data={'request_id': str(instance.id), 'profile': 'client'},
+                    **CLIENT_MESSAGES['partner_not_found'])
+
+    def run(self, queryset):
+        self.load(queryset)
+
+        if not self.requests:
+            return []
+
+        assignments = self.persist(self.assign())
+        self.notify(assignments)
+        return assignments
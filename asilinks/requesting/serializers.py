@@ -12,14 +12,15 @@ from rest_framework import serializers, fields
 from rest_framework_mongoengine.serializers import (
     DocumentSerializer, EmbeddedDocumentSerializer)
 
+from asilinks.bulk import BulkUpdate
 from asilinks.validators import file_max_size, FileMimetypeValidator
 from .documents import (Request, RoundPartner, Message,
-    TimeExtension, Review)
+    TimeExtension, Review, TransitionError)
 from .tasks import select_round_partners
 from authentication.documents import Account
 from main.documents import Client, Partner
 from main.serializers import ExtraDescriptionSerializer
-from payments.documents import Transaction, Bill
+from payments.documents import Transaction
 from payments.interfaces import get_interface, ContextInterfaceError
 
 from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
@@ -36,25 +37,35 @@ __all__ = [
 ]
 
 
+def thread_messages(messages):
+    """
+    Pairs each message of the channel with its response, if any. The
+    responses are indexed by the ts they reference in a single pass.
+    """
+    responses = dict()
+
+    for message in messages:
+        if message.reference_ts is not None:
+            responses.setdefault(message.reference_ts, message)
+
+    return [(message, responses.get(message.ts)) for message in messages
+        if message.reference_ts is None]
+
+
 class MessageListSerializer(serializers.ListSerializer):
     def to_representation(self, data):
         merged_data = []
 
-        for item in data.filter(reference_ts=None):
+        for item, response in thread_messages(list(data)):
             rep = self.child.to_representation(item)
-
-            try:
-                rep['response'] = self.child.to_representation(
-                    data.get(reference_ts=item.ts))
-            except:
-                rep['response'] = None
+            rep['response'] = response and self.child.to_representation(response)
 
             merged_data.append(rep)
 
         return merged_data
 
 
-class MessageSerializer(EmbeddedDocumentSerializer):
+class MessageSerializer(DocumentSerializer):
     type = fields.ChoiceField(choices=Message.TYPE_CHOICES,
         default=Message.TYPE_TEXT, write_only=True, required=False)
     attachment = fields.FileField(max_length=None, use_url=True,
@@ -85,7 +96,7 @@ class MessageSerializer(EmbeddedDocumentSerializer):
         return obj.owner == self.context['request'].user
 
     def get_is_client(self, obj):
-        return obj.owner == self.parent.parent.instance.client.account
+        return obj.owner == self.context.get('client_account')
 
     def validate(self, data):
 
@@ -109,6 +120,40 @@ class MessageSerializer(EmbeddedDocumentSerializer):
         return data
 
 
+class MessageWindowMixin(object):
+    """
+    Serializes the request channels as a window of their last messages.
+    Older messages are paginated with the `messages_before` (timestamp)
+    and `messages_limit` query params.
+    """
+
+    def get_questions(self, obj):
+        return self.get_message_window(obj, Message.CHANNEL_QUESTIONS)
+
+    def get_com_channel(self, obj):
+        return self.get_message_window(obj, Message.CHANNEL_COM)
+
+    def get_window_params(self):
+        params = self.context['request'].query_params
+
+        try:
+            before = params.get('messages_before')
+            before = before and dt.datetime.fromtimestamp(float(before))
+            limit = min(int(params.get('messages_limit', Message.WINDOW_SIZE)),
+                Message.WINDOW_MAX_SIZE)
+        except ValueError:
+            raise ValidationError(_('Los parametros de la ventana de mensajes no son validos.'))
+
+        return before or None, max(limit, 1)
+
+    def get_message_window(self, obj, channel):
+        before, limit = self.get_window_params()
+        messages = obj.message_window(channel, before=before, limit=limit)
+
+        context = dict(self.context, client_account=obj.client.account)
+        return MessageSerializer(messages, many=True, context=context).data
+
+
 class ClientSerializer(DocumentSerializer):
     full_name = fields.ReadOnlyField(source='account.get_full_name')
 
@@ -165,7 +210,7 @@ class OfferPartnerSerializer(EmbeddedDocumentSerializer):
         fields = '__all__'
 
 
-class MakeRequestSerializer(DocumentSerializer):
+class MakeRequestSerializer(MessageWindowMixin, DocumentSerializer):
     english_level = fields.CharField(write_only=True, required=False)
     estimated_duration = fields.CharField(write_only=True, required=False)
     advance_notion = fields.CharField(write_only=True, required=False)
@@ -178,8 +223,8 @@ class MakeRequestSerializer(DocumentSerializer):
     round_partners = RoundPartnerSerializer(many=True, read_only=True)
     partner = PartnerSerializer(read_only=True)
 
-    questions = MessageSerializer(many=True, read_only=True)
-    com_channel = MessageSerializer(many=True, read_only=True)
+    questions = serializers.SerializerMethodField()
+    com_channel = serializers.SerializerMethodField()
     status_display = serializers.SerializerMethodField()
     new_messages = serializers.SerializerMethodField()
     last_read = serializers.SerializerMethodField()
@@ -191,9 +236,10 @@ class MakeRequestSerializer(DocumentSerializer):
             'questions', 'com_channel', 'country_alpha2', 'penalty_discount', 'round_partners',
             'partner', 'partner_review', 'client_review', 'status_display', 'status', 'skills',
             'english_level', 'estimated_duration', 'advance_notion', 'attachment', 'date_promise',
-            'new_messages', 'last_read', 'new_offers', )
+            'new_messages', 'last_read', 'new_offers', 'matching_status', 'date_matched', )
         read_only_fields = ('id', 'date_created', 'extra_description','penalty_discount',
-            'partner_review', 'client_review', 'status', 'date_promise', )
+            'partner_review', 'client_review', 'status', 'date_promise',
+            'matching_status', 'date_matched', )
         extra_kwargs = {
             'name': {'required': True},
             'description': {'required': True},
@@ -232,6 +278,7 @@ class MakeRequestSerializer(DocumentSerializer):
         [validated_data.pop(key, None) for key in ('estimated_duration',
             'english_level', 'advance_notion', 'skills')]
 
+        validated_data['matching_status'] = Request.MATCHING_PENDING
         instance = super().create(validated_data)
         update = {
             'extra_description':extra.save()
@@ -245,12 +292,12 @@ class MakeRequestSerializer(DocumentSerializer):
 
             message.attachment.save(message.attachment.name, 
                 message.attachment, save=False)
-            update['push__questions'] = message
+            instance.push_message(message, Message.CHANNEL_QUESTIONS)
 
         instance.modify(**update)
         instance.client.modify(push__requests_todo=instance, last_activity=dt.datetime.now())
-        select_round_partners(str(instance.id))
-        # select_round_partners.delay(str(instance.id))
+        instance.schedule_deadlines()
+        select_round_partners.delay(str(instance.id))
 
         return instance
 
@@ -273,14 +320,14 @@ class MakeRequestSerializer(DocumentSerializer):
         return instance
 
 
-class DetailRequestSerializer(DocumentSerializer):
+class DetailRequestSerializer(MessageWindowMixin, DocumentSerializer):
     round_partners = RoundPartnerSerializer(many=True)
     partner = PartnerSerializer()
     client = ClientSerializer()
 
     know_fields = serializers.StringRelatedField(many=True)
-    questions = MessageSerializer(many=True)
-    com_channel = MessageSerializer(many=True)
+    questions = serializers.SerializerMethodField()
+    com_channel = serializers.SerializerMethodField()
 
     status_display = serializers.SerializerMethodField()
     your_offer = serializers.SerializerMethodField()
@@ -296,19 +343,26 @@ class DetailRequestSerializer(DocumentSerializer):
             'client', 'partner', 'round_partners', 'status_display', 'status',
             'date_created', 'date_promise', 'penalty_discount', 'your_offer',
             'partner_review', 'client_review', 'extra_description', 'country_alpha2',
-            'new_messages', 'last_read', 'new_offers', 'can_cancel', 'pending_extension', )
+            'new_messages', 'last_read', 'new_offers', 'can_cancel', 'pending_extension',
+            'matching_status', 'date_matched', )
+
+    def get_com_channel(self, obj):
+        if obj.status >= Request.STATUS_PENDING:
+            return super().get_com_channel(obj)
 
-    def __init__(self, instance, *args, **kwargs):
-        if instance.status < Request.STATUS_PENDING:
+        # Oculta la entrega hasta que el requerimiento sea pagado.
+        before, limit = self.get_window_params()
+        messages = obj.message_window(Message.CHANNEL_COM, before=before, limit=limit)
+        last_delivery = [item for item in messages if item.last_delivery]
 
-            last_delivery = instance.com_channel.filter(last_delivery=True)
-            last_delivery.update(content='', attachment=None)
+        for item in last_delivery:
+            item.content = ''
+            item.attachment = None
 
-            instance.com_channel = instance.com_channel.exclude(
-                last_delivery=True)
-            [instance.com_channel.append(item) for item in last_delivery]
+        messages = [item for item in messages if not item.last_delivery] + last_delivery
 
-        super().__init__(instance, *args, **kwargs)
+        context = dict(self.context, client_account=obj.client.account)
+        return MessageSerializer(messages, many=True, context=context).data
 
     def get_field_names(self, declared_fields, info):
         fields = super().get_field_names(declared_fields, info)
@@ -339,6 +393,71 @@ class DetailRequestSerializer(DocumentSerializer):
     def get_status_display(self, obj):
         return obj.get_status_display()
 
+    # Datos de otros documentos o que cambian con el tiempo, que no siguen
+    # la version del requerimiento.
+    live_fields = ('client', 'partner', 'round_partners', 'can_cancel',
+        'new_offers', 'penalty_discount')
+    # Datos que dependen de la marca de lectura del usuario.
+    read_fields = ('new_messages', 'last_read')
+
+    def live_representation(self, obj):
+        """
+        Fields that do not follow the request version, which are left out
+        of the cached representation.
+        """
+        return self.partial_representation(obj, self.live_fields)
+
+    def cached_representation(self, obj):
+        """
+        Representation without the live and read fields, which can be
+        cached by request version.
+        """
+        excluded = set(self.live_fields) | set(self.read_fields)
+        return self.partial_representation(obj, [field.field_name
+            for field in self._readable_fields if field.field_name not in excluded])
+
+    def partial_representation(self, obj, names):
+        data = dict()
+
+        for field in self._readable_fields:
+            if field.field_name not in names:
+                continue
+
+            try:
+                attribute = field.get_attribute(obj)
+            except fields.SkipField:
+                continue
+
+            data[field.field_name] = None if attribute is None \
+                else field.to_representation(attribute)
+
+        return data
+
+    def read_representation(self, obj):
+        """
+        Fields that depend on the read marker of the user, which are left
+        out of the cached representation.
+        """
+        return {
+            'new_messages': self.get_new_messages(obj),
+            'last_read': self.get_last_read(obj),
+        }
+
+    def etag_representation(self, obj):
+        """
+        Cheap state of the fields that do not follow the version, read
+        from the request document alone, so a not modified response does
+        not serialize the participants.
+        """
+        raw = obj.to_mongo()
+
+        return dict(self.read_representation(obj),
+            new_offers=obj.new_offers(),
+            penalty_discount=obj.penalty_discount,
+            can_cancel=obj.can_be_canceled(),
+            participants=[raw.get('client'), raw.get('partner'),
+                *[item.get('partner') for item in raw.get('round_partners', [])]])
+
     def get_new_messages(self, obj):
         account = self.context['request'].user
         return obj.new_messages(account)
@@ -368,7 +487,13 @@ class ListRequestSerializer(DocumentSerializer):
         model = Request
         fields = ('id', 'name', 'know_fields', 'client', 'partner',
             'status', 'status_display', 'offers_count', 'your_offer', 
-            'date_promise', 'date_created', 'new_messages', 'new_offers', )
+            'date_promise', 'date_created', 'new_messages', 'new_offers',
+            'matching_status', )
+
+    # Campos consultados al listar, incluidos los que usan los metodos.
+    projection = ('id', 'name', 'know_fields', 'client', 'partner', 'status',
+        'round_partners', 'date_promise', 'date_created', 'matching_status',
+        'last_read_client', 'unread_client', 'unread_partner')
 
     def get_field_names(self, declared_fields, info):
         fields = super().get_field_names(declared_fields, info)
@@ -507,6 +632,7 @@ class TimeExtensionSerializer(EmbeddedDocumentSerializer):
                 *[item.duration for item in instance.time_extensions]
             ])
             instance.modify(date_promise=promise)
+            instance.schedule_deadlines()
 
             # Send notification telling that the extension was aproved
             self.instance.partner.account.send_message(
@@ -521,7 +647,7 @@ class TimeExtensionSerializer(EmbeddedDocumentSerializer):
         return extension
 
 
-class SendMessageSerializer(DocumentSerializer):
+class SendMessageSerializer(MessageWindowMixin, DocumentSerializer):
     content = fields.CharField(max_length=5000, write_only=True)
     type = fields.ChoiceField(choices=Message.TYPE_CHOICES, 
         default=Message.TYPE_TEXT, write_only=True, required=False)
@@ -532,8 +658,8 @@ class SendMessageSerializer(DocumentSerializer):
 
     client = fields.CharField(read_only=True, source='client.account.get_full_name')
     know_fields = serializers.StringRelatedField(read_only=True, many=True)
-    questions = MessageSerializer(read_only=True, many=True)
-    com_channel = MessageSerializer(read_only=True, many=True)
+    questions = serializers.SerializerMethodField()
+    com_channel = serializers.SerializerMethodField()
     status_display = serializers.SerializerMethodField()
 
     class Meta:
@@ -559,12 +685,13 @@ class SendMessageSerializer(DocumentSerializer):
             except:
                 raise ValidationError(_('Debe pasar reference_ts en el formato timestamp.'))
 
-            if not self.instance.questions.filter(ts=reference_ts) and \
-                    not self.instance.com_channel.filter(ts=reference_ts):
+            messages = Message.objects(request=self.instance, channel__in=(
+                Message.CHANNEL_QUESTIONS, Message.CHANNEL_COM))
+
+            if not messages.filter(ts=reference_ts).count():
                 raise ValidationError(_('No existe un mensaje con ese reference_ts.'))
 
-            if self.instance.questions.filter(reference_ts=reference_ts) or \
-                    self.instance.com_channel.filter(reference_ts=reference_ts):
+            if messages.filter(reference_ts=reference_ts).count():
                 raise ValidationError(_('Este mensaje ya ha sido respondido.'))
 
             data['reference_ts'] = reference_ts
@@ -596,14 +723,16 @@ class SendMessageSerializer(DocumentSerializer):
             message.attachment.save(message.attachment.name, 
                 message.attachment, save=False)
 
+        instance.push_message(message)
+
         if instance.status == Request.STATUS_TODO:
-            instance.modify(push__questions=message)
             # Get round partner info if exists
             is_round_partner, round_partner = self.get_round_partner(instance)
             # Update last activity if it is round partner
             if is_round_partner:
                 round_partner.last_activity = dt.datetime.now()
-                round_partner.save()
+                instance.update_round_partners([round_partner.partner],
+                    version=False, last_activity=round_partner.last_activity)
             # Send notifications to all round partner but the sender
             notify_round_partners = [rp for rp in instance.round_partners if rp is not round_partner]
             # Send message to each partner
@@ -612,7 +741,6 @@ class SendMessageSerializer(DocumentSerializer):
                     data={'request_id': str(instance.id), 'profile': 'partner'},
                     **PARTNER_MESSAGES['have_new_message'])
         else:
-            instance.modify(push__com_channel=message)
             # Send message to partner
             instance.partner.account.send_message(context={'request': instance},
                 data={'request_id': str(instance.id), 'profile': 'partner'},
@@ -701,14 +829,18 @@ class RejectRequestSerializer(DocumentSerializer):
 
     def save(self, **kwargs):
         partner = self.context['request'].user.partner_profile
+        date_response = dt.datetime.now()
+
         self.instance.round_partners.filter(partner=partner) \
-            .update(rejected=True, date_response=dt.datetime.now())
+            .update(rejected=True, date_response=date_response)
+        self.instance.update_round_partners([partner],
+            rejected=True, date_response=date_response)
 
-        partner.modify(pull__requests_todo=self.instance, 
-            push__requests_rejected=self.instance)
+        with BulkUpdate() as bulk:
+            bulk.update(partner, push__requests_rejected=self.instance)
+            Partner.pull_opportunity(bulk, partner.pk, self.instance.pk)
 
         ## TODO: pendiente enviar request a otro round partner
-        self.instance.save()
         return self.instance
 
 class CancelRequestSerializer(DocumentSerializer):
@@ -724,15 +856,10 @@ class CancelRequestSerializer(DocumentSerializer):
         return obj.get_status_display()
 
     def save(self, **kwargs):
-        self.instance.refund()
-
-        self.instance.partner.modify(pull__requests_in_progress=self.instance,
-            push__requests_canceled=self.instance)
-        self.instance.client.modify(pull__requests_in_progress=self.instance,
-            push__requests_canceled=self.instance, last_activity=dt.datetime.now())
-        self.instance.modify(status=Request.STATUS_CANCELED, date_canceled=dt.datetime.now())
-
-        Bill.make_bill(self.instance)
+        try:
+            self.instance.cancel(activity=True)
+        except TransitionError as err:
+            raise ValidationError({'message': err.args[0]})
 
         # Send notification to the partner, client has canceled the request
         self.instance.partner.account.send_message(context={'request': self.instance},
@@ -778,7 +905,6 @@ class AcceptOfferSerializer(DocumentSerializer):
 
         now = dt.datetime.now()
         validated_data = {
-            'status': Request.STATUS_IN_PROGRESS, 
             'price': round_partner.price,
             'sponsor_percent': bill['sponsor_percent'],
             'partner': round_partner.partner, 
@@ -792,27 +918,39 @@ class AcceptOfferSerializer(DocumentSerializer):
     def update(self, instance, validated_data):
         transaction = validated_data.pop('transaction')
 
-        instance = super().update(instance, validated_data)
-        instance.modify(push__transactions=transaction)
-
-        instance.client.modify(pull__requests_todo=instance,
-            push__requests_in_progress=instance, last_activity=dt.datetime.now())
+        with BulkUpdate() as bulk:
+            try:
+                instance.transition(Request.STATUS_IN_PROGRESS, bulk=bulk,
+                    activity=True, push__transactions=transaction, **validated_data)
+            except TransitionError as err:
+                # Otra accion cambio el estado, se devuelve el pago ya cobrado.
+                transaction.refund()
+                raise ValidationError({'message': err.args[0]})
+
+            round_partners = instance.round_partners.filter(rejected=False)
+
+            for round_partner in round_partners:
+                if round_partner.partner == instance.partner:
+                    bulk.update(round_partner.partner,
+                        push__requests_in_progress=instance)
+                else:
+                    bulk.update(round_partner.partner,
+                        push__requests_rejected=instance)
+                Partner.pull_opportunity(bulk, round_partner.partner.pk, instance.pk)
+
+        instance.schedule_deadlines()
+
+        # Send notification to selected partner
+        instance.partner.account.send_message(context={'request': instance},
+            data={'request_id': str(instance.id), 'profile': 'partner'},
+            **PARTNER_MESSAGES['were_selected'])
 
-        for round_partner in instance.round_partners.filter(rejected=False):
-            if round_partner.partner == instance.partner:
-                round_partner.partner.modify(pull__requests_todo=instance,
-                    push__requests_in_progress=instance)
-                # Send notification to selected partner
-                instance.partner.account.send_message(context={'request': instance},
-                    data={'request_id': str(instance.id), 'profile': 'partner'},
-                    **PARTNER_MESSAGES['were_selected'])
-            else:
-                round_partner.partner.modify(pull__requests_todo=instance,
-                    push__requests_rejected=instance)
-                # Send notification to rejected partner
-                round_partner.partner.account.send_message(context={'request': instance},
-                    data={'request_id': str(instance.id), 'profile': 'partner'},
-                    **PARTNER_MESSAGES['were_rejected'])
+        # Send one notification to all rejected partners
+        Partner.send_multicast([round_partner.partner for round_partner in round_partners
+                if round_partner.partner != instance.partner],
+            context={'request': instance},
+            data={'request_id': str(instance.id), 'profile': 'partner'},
+            **PARTNER_MESSAGES['were_rejected'])
 
         # instance.save()
         return instance
@@ -840,7 +978,12 @@ class SubmitRequestSerializer(DocumentSerializer):
 
     def update(self, instance, validated_data):
         attachment = validated_data.pop('attachment', None)
-        extra = {}
+
+        try:
+            instance.transition(Request.STATUS_DELIVERED,
+                date_delivered=dt.datetime.now())
+        except TransitionError as err:
+            raise ValidationError({'message': err.args[0]})
 
         if attachment:
             _type = Message.TYPE_DOC if attachment.content_type in Message.CONTENT_TYPES[
@@ -851,10 +994,8 @@ class SubmitRequestSerializer(DocumentSerializer):
 
             message.attachment.save(message.attachment.name, 
                 message.attachment, save=False)
-            extra['push__com_channel'] = message
+            instance.push_message(message, Message.CHANNEL_COM)
 
-        instance.modify(status=Request.STATUS_DELIVERED, 
-            date_delivered=dt.datetime.now(), **extra)
         instance.client.account.send_message(context={'request': instance},
             data={'request_id': str(instance.id), 'profile': 'client'},
             **CLIENT_MESSAGES['request_delivered'])
@@ -878,7 +1019,7 @@ class ReceiveRequestSerializer(DocumentSerializer):
         return obj.get_status_display()
 
     def validate(self, data):
-        amount = self.instance.calculate_bill()['to_pay']
+        amount = self.instance.get_bill()['to_pay']
         ## TODO: Evaluar los descuentos por incumplimiento.
 
         # Compara en caso de que exista una penalizacion por el 40% restante
@@ -895,7 +1036,6 @@ class ReceiveRequestSerializer(DocumentSerializer):
             transaction = []
 
         validated_data = {
-            'status': Request.STATUS_PENDING,
             'transaction': transaction
         }
 
@@ -903,9 +1043,17 @@ class ReceiveRequestSerializer(DocumentSerializer):
 
     def update(self, instance, validated_data):
         transaction = validated_data.pop('transaction')
+        update = {'push__transactions': transaction} if transaction else {}
+
+        try:
+            instance.transition(Request.STATUS_PENDING, **update)
+        except TransitionError as err:
+            # Otra accion cambio el estado, se devuelve el pago ya cobrado.
+            if transaction:
+                transaction.refund()
+            raise ValidationError({'message': err.args[0]})
 
-        instance = super().update(instance, validated_data)
-        instance.modify(push__transactions=transaction)
+        instance.schedule_deadlines()
 
         return instance
 
@@ -937,12 +1085,17 @@ class UnsatisfiedRequestSerializer(DocumentSerializer):
         time_extension = instance.round_partners.get(
             partner=instance.partner).duration / 4
 
+        try:
+            instance.transition(Request.STATUS_UNSATISFIED,
+                date_unsatisfied=dt.datetime.now() + time_extension)
+        except TransitionError as err:
+            raise ValidationError({'message': err.args[0]})
+
         message = Message(ts=dt.datetime.now(),
             owner=self.context['request'].user, content=validated_data['cause'])
 
-        instance.modify(status=Request.STATUS_UNSATISFIED,
-            date_unsatisfied=dt.datetime.now() + time_extension,
-            push__com_channel=message)
+        instance.push_message(message, Message.CHANNEL_COM)
+        instance.schedule_deadlines()
 
         ## TODO: incluir un task que revise periodicamente los insatisfechos para realizar la devolucion
 
@@ -967,7 +1120,10 @@ class CloseRequestSerializer(DocumentSerializer):
         return obj.get_status_display()
 
     def save(self, **kwargs):
-        self.instance.close()
+        try:
+            self.instance.close()
+        except TransitionError as err:
+            raise ValidationError({'message': err.args[0]})
 
         ## TODO: Enviar correo con la factura de asilinks
         return self.instance
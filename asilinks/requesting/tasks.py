@@ -6,10 +6,12 @@ from mongoengine.queryset.visitor import Q
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
-from .documents import Request, RoundPartner
-from authentication.documents import Location
-from main.documents import Partner
-from payments.documents import Bill
+from asilinks.bulk import BulkUpdate
+
+from .documents import Request, RoundPartner, Message, Deadline, TransitionError
+from .matching import BatchMatcher
+from main.documents import Partner, CandidateIndex
+from payments.interfaces import PaymentError, RefundError, PayoutError
 from admin.notification import CLIENT_MESSAGES, PARTNER_MESSAGES
 
 logger = get_task_logger(__name__)
@@ -55,101 +57,148 @@ def calc_partners_weights(queryset):
     return df
 
 def select_partners(queryset, samples=4):
-    df = calc_partners_weights(queryset)
+    from main.scoring import partner_scores
 
-    # Selecciona la muestra aleatoria con pesos
-    # selected = df.sample(n=samples, weights='feat')
-    selected = []
-    for l in (Partner.LEVEL_BRONZE, Partner.LEVEL_SILVER, Partner.LEVEL_GOLD):
-        part = df[df.level == l]
-        n = min(part.shape[0], samples)
+    # Selecciona la muestra aleatoria con pesos por nivel desde la matriz
+    # precalculada, sin construir DataFrames.
+    loads = {str(key): value or 0
+        for key, value in queryset.scalar('id', 'open_opportunities')}
+    selected = partner_scores.select(list(loads), samples=samples, loads=loads)
+    return queryset.filter(id__in=selected)
 
-        # En condiciones iniciales cero, inicializa los pesos en 1.
-        if part['feat'].sum() == 0:
-            part['feat'] = 1
+@shared_task(name='select_round_partners', autoretry_for=(Exception,),
+    retry_backoff=True, max_retries=5)
+def select_round_partners(instance_id, *args, **kwargs):
+    now = dt.datetime.now()
+    instance = Request.objects.filter(id=instance_id,
+        matching_status__ne=Request.MATCHING_DONE).first()
 
-        # Si existe una muestra seleccionable para esa categoria los agrega.
-        if n > 0:
-            selected.append(part.sample(n=n, weights='feat'))
+    if instance is None:
+        logger.info('seleccion de socios omitida... {}'.format(instance_id))
+        return
 
-    return queryset.filter(id__in=pd.concat(selected).index)
+    # Solo lecturas: si fallan, el reintento no deja nada a medias.
+    partners = _select_round_partners(instance)
 
-@shared_task(name='select_round_partners')
-def select_round_partners(instance_id, *args, **kwargs):
-    now = dt.datetime.now()
-    instance = Request.objects.get(id=instance_id)
+    # Los socios se guardan en la misma escritura que reclama el requerimiento,
+    # antes de avisar a nadie.
+    instance = Request.claim_matching(instance_id, now=now, round_partners=[
+        RoundPartner(partner=partner, date_notification=now) for partner in partners])
+
+    # La seleccion ya fue realizada o esta en curso en otro worker.
+    if instance is None:
+        logger.info('seleccion de socios omitida... {}'.format(instance_id))
+        return
+
+    # Los avisos quedan fuera de los reintentos para no repetirse.
+    try:
+        _notify_round_partners(instance, partners)
+    except Exception:
+        logger.exception('fallo el aviso de socios de ronda {}'.format(instance_id))
 
+
+def _select_round_partners(instance):
     # Filtra socios favoritos por area de conocimiento.
     favorite_partners = list({fp.partner
         for fp in instance.client.favorite_partners
         if fp.know_field in instance.know_fields})
 
-    filters = {
-        'enabled': True,
-        'know_fields__in': instance.know_fields,
-        'id__nin': [fp.id for fp in favorite_partners],
-    }
-
-    if instance.country_alpha2:
-        filters['residence__in'] = Location.objects.filter(
-            alpha2_code=instance.country_alpha2)
+    excluded = {fp.id for fp in favorite_partners}
 
     if instance.client.account.has_partner_profile():
-        filters['id__nin'].append(instance.client.account.partner_profile.id)
+        excluded.add(instance.client.account.partner_profile.id)
+
+    candidates = CandidateIndex.lookup(instance.to_mongo().get('know_fields', []),
+        instance.country_alpha2) - excluded
+
+    if not candidates:
+        return []
 
-    round_partners = list()
-    queryset = Partner.objects.filter(**filters)
+    queryset = Partner.objects.filter(id__in=list(candidates))
 
-    if not queryset:
+    return [*favorite_partners, *select_partners(queryset)]
+
+
+def _notify_round_partners(instance, partners):
+    if not partners:
         instance.client.account.send_message(context={'request': instance},
             data={'request_id': str(instance.id), 'profile': 'client'},
             **CLIENT_MESSAGES['partner_not_found'])
         return
 
-    for partner in [*favorite_partners, *select_partners(queryset)]:
+    with BulkUpdate() as bulk:
+        for partner in partners:
+            Partner.push_opportunity(bulk, partner.pk, instance.pk)
 
-        round_partners.append(RoundPartner(
-            partner=partner, date_notification=now))
-        partner.modify(push__requests_todo=instance)
-        ## TODO: partners de diferentes niveles
-        partner.account.send_message(
-            data={'request_id': str(instance.id), 'profile': 'partner'},
-            **PARTNER_MESSAGES['have_an_opportunity'])
+    ## TODO: partners de diferentes niveles
+    Partner.send_multicast(partners,
+        data={'request_id': str(instance.id), 'profile': 'partner'},
+        **PARTNER_MESSAGES['have_an_opportunity'])
 
-    instance.modify(round_partners=round_partners)
-    # return round_partners
+
+def todo_requests_buckets(now, cycle=dt.timedelta(hours=36),
+        notification_limits=(1, 2), cancelable_lower_limit=6):
+    """
+    Aggregation pipeline that classifies the todo requests by elapsed
+    cycles since creation and returns only the id and bucket of each one.
+    """
+    notification_lower_limit, notification_upper_limit = notification_limits
+    cycles = {'$divide': [{'$subtract': [now, '$date_created']},
+        cycle.total_seconds() * 1000]}
+
+    return [
+        {'$match': {
+            'status': Request.STATUS_TODO,
+            'date_created': {'$lt': now - cycle * notification_lower_limit},
+        }},
+        {'$project': {'_id': 1, 'cycles': cycles}},
+        {'$project': {'bucket': {'$switch': {
+            'branches': [
+                {'case': {'$and': [
+                    {'$gt': ['$cycles', notification_lower_limit]},
+                    {'$lt': ['$cycles', notification_upper_limit]}]},
+                    'then': 'notify'},
+                {'case': {'$and': [
+                    {'$gt': ['$cycles', notification_upper_limit]},
+                    {'$lt': ['$cycles', cancelable_lower_limit]}]},
+                    'then': 'refresh'},
+                {'case': {'$gt': ['$cycles', cancelable_lower_limit]},
+                    'then': 'cancel'},
+            ],
+            'default': None,
+        }}}},
+        {'$match': {'bucket': {'$ne': None}}},
+    ]
 
 
 @shared_task(name='refresh_round_partners')
-def refresh_round_partners():
+def refresh_round_partners(chunk_size=500):
     """
     Refresh round partners
     """
-    # Constants
-    notification_lower_limit = 1
-    notification_upper_limit = 2
-    cancelable_lower_limit = 6
-    # Get only id and date created info from todo requests
-    all_todo_requests = Request.objects.filter(status=Request.STATUS_TODO,
-        date_created__lt=dt.datetime.now() - dt.timedelta(hours=36)).values_list('id', 'date_created')
-    # Convert list of tuples -> list of lists -> dataframe
-    all_todo_requests_dataframe = pd.DataFrame([list(elem) for elem in all_todo_requests], columns=['id', 'date'])
-    # Create timedelta serie
-    all_todo_requests_dataframe['cycles'] = all_todo_requests_dataframe['date'].apply(lambda x: (dt.datetime.now() - x).total_seconds() / dt.timedelta(hours=36).total_seconds())
-    # Get notificable, refreshable and cancelable request lists
-    notificable_requests = all_todo_requests_dataframe[
-        (notification_lower_limit < all_todo_requests_dataframe['cycles']) & (all_todo_requests_dataframe['cycles'] < notification_upper_limit)
-    ]
-    refreshable_requests = all_todo_requests_dataframe[
-        (notification_upper_limit < all_todo_requests_dataframe['cycles']) & (all_todo_requests_dataframe['cycles'] < cancelable_lower_limit)
-    ]
-    cancelable_requests = all_todo_requests_dataframe[
-        all_todo_requests_dataframe['cycles'] > cancelable_lower_limit
-    ]
-    # Start process
-    notify_todo_requests([str(id) for id in notificable_requests['id']])
-    refresh_todo_requests([str(id) for id in refreshable_requests['id']])
-    cancel_todo_requests([str(id) for id in cancelable_requests['id']])
+    handlers = {
+        'notify': notify_todo_requests,
+        'refresh': refresh_todo_requests,
+        'cancel': cancel_todo_requests,
+    }
+    pending = {bucket: [] for bucket in handlers}
+
+    # Recorre el cursor procesando los ids por lotes, sin cargar todos
+    # los requerimientos en memoria.
+    cursor = Request.objects.aggregate(*todo_requests_buckets(dt.datetime.now()),
+        allowDiskUse=True)
+
+    for item in cursor:
+        ids = pending[item['bucket']]
+        ids.append(str(item['_id']))
+
+        if len(ids) >= chunk_size:
+            handlers[item['bucket']](ids)
+            pending[item['bucket']] = []
+
+    for bucket, ids in pending.items():
+        if ids:
+            handlers[bucket](ids)
 
 
 @shared_task(name='notify_todo_requests')
@@ -167,11 +216,10 @@ def notify_todo_requests(ids):
         request = Request.objects.get(id=request_id)
         # Get round partners
         round_partners = request.round_partners
-        # loop over round partners
-        for round_partner in round_partners:
-            round_partner.partner.account.send_message(
-                data={'request_id': str(request.id), 'profile': 'client'},
-                **PARTNER_MESSAGES['have_pending_requirement'])
+        # Notify all round partners at once
+        Partner.send_multicast([rp.to_mongo()['partner'] for rp in round_partners],
+            data={'request_id': str(request.id), 'profile': 'client'},
+            **PARTNER_MESSAGES['have_pending_requirement'])
 
 
 @shared_task(name='refresh_todo_requests')
@@ -186,19 +234,9 @@ def refresh_todo_requests(ids):
         # Get request
         instance = Request.objects.get(id=instance_id)
 
-        # Prepare filters
-        filters = {
-            'enabled': True,
-            'know_fields__in': instance.know_fields
-        }
-
-        if instance.country_alpha2:
-            filters['residence__in'] = Location.objects.filter(
-                alpha2_code=instance.country_alpha2)
-
-        not_allowed_round_partners = list()
+        not_allowed_round_partners = set()
         if instance.client.account.has_partner_profile():
-            not_allowed_round_partners.append(instance.client.account.partner_profile.id)
+            not_allowed_round_partners.add(instance.client.account.partner_profile.id)
 
         # Get all round partners
         round_partners = instance.round_partners
@@ -210,32 +248,44 @@ def refresh_todo_requests(ids):
 
         # Reject round partners
         for rp in refreshable_round_partners:
-            rp.rejected=True
-            rp.save()
+            rp.rejected = True
+
+        # No rechaza a quienes ofertaron mientras tanto.
+        if refreshable_round_partners:
+            instance.update_round_partners(
+                [rp.partner for rp in refreshable_round_partners],
+                match={'date_response': None}, rejected=True)
 
-        # Append all round partners to filters
+        # Exclude all round partners from candidates
         for round_partner in round_partners:
-            not_allowed_round_partners.append(round_partner.partner.id)
-        filters['id__nin'] = not_allowed_round_partners
+            not_allowed_round_partners.add(round_partner.partner.id)
 
-        queryset = Partner.objects.filter(**filters)
+        candidates = CandidateIndex.lookup(instance.to_mongo().get('know_fields', []),
+            instance.country_alpha2) - not_allowed_round_partners
 
-        if not queryset:
+        if not candidates:
             instance.client.account.send_message(context={'request': instance},
                 data={'request_id': str(instance.id), 'profile': 'client'},
                 **CLIENT_MESSAGES['partner_not_found'])
 
-        for partner in select_partners(queryset):
+        queryset = Partner.objects.filter(id__in=list(candidates))
 
-            round_partners.append(RoundPartner(
-                partner=partner, date_notification=now))
-            partner.modify(push__requests_todo=instance)
-            ## TODO: partners de diferentes niveles
-            partner.account.send_message(
-                data={'request_id': str(instance.id), 'profile': 'client'},
-                **PARTNER_MESSAGES['have_an_opportunity'])
+        partners = list(select_partners(queryset))
+
+        # Agrega los nuevos socios sin reescribir las ofertas existentes.
+        with BulkUpdate() as bulk:
+            for partner in partners:
+                bulk.update(instance, push__round_partners=RoundPartner(
+                    partner=partner, date_notification=now))
+                Partner.push_opportunity(bulk, partner.pk, instance.pk)
 
-        instance.modify(round_partners=round_partners)
+            if partners:
+                bulk.update(instance, inc__version=1)
+
+        ## TODO: partners de diferentes niveles
+        Partner.send_multicast(partners,
+            data={'request_id': str(instance.id), 'profile': 'client'},
+            **PARTNER_MESSAGES['have_an_opportunity'])
 
 
 @shared_task(name='cancel_todo_requests')
@@ -247,66 +297,72 @@ def cancel_todo_requests(ids):
     for instance_id in ids:
         # Get request
         request = Request.objects.get(id=instance_id)
-
-        request.client.modify(pull__requests_todo=request,
-            push__requests_canceled=request)
-        for rp in request.round_partners:
-            if not rp.rejected:
-                rp.partner.modify(pull__requests_todo=request,
-                    push__requests_canceled=request)
-                rp.partner.account.send_message(context={'request': request},
-                    data={'request_id': str(request.id), 'profile': 'partner'},
-                    **PARTNER_MESSAGES['request_was_canceled'])
+        round_partners = [rp for rp in request.round_partners if not rp.rejected]
+
+        with BulkUpdate() as bulk:
+            try:
+                request.transition(Request.STATUS_CANCELED, bulk=bulk,
+                    date_canceled=dt.datetime.now())
+            except TransitionError:
+                # El cliente acepto una oferta mientras tanto.
+                logger.info('cancelacion omitida... {}'.format(instance_id))
+                continue
+
+            for rp in round_partners:
+                bulk.update(rp.partner, push__requests_canceled=request)
+                Partner.pull_opportunity(bulk, rp.partner.pk, request.pk)
+
+        Partner.send_multicast([rp.partner for rp in round_partners],
+            context={'request': request},
+            data={'request_id': str(request.id), 'profile': 'partner'},
+            **PARTNER_MESSAGES['request_was_canceled'])
 
         request.client.account.send_message(context={'request': request},
             data={'request_id': str(request.id), 'profile': 'client'},
             **CLIENT_MESSAGES['partner_not_chosen'])
-        request.modify(status=Request.STATUS_CANCELED, date_canceled=dt.datetime.now())
 
 
 @shared_task(name='unsatisfied_requests')
 def cancel_unsatisfied_requests():
     requests = Request.objects.filter(status=Request.STATUS_UNSATISFIED,
-        date_unsatisfied__lt=dt.datetime.now()-dt.timedelta(hours=48))
+        date_unsatisfied__lt=dt.datetime.now() - Deadline.UNSATISFIED_TIMEOUT)
 
     for instance in requests:
-        instance.refund()
+        try:
+            cancel_unsatisfied_request(instance)
+        except TransitionError:
+            logger.info('cancelacion omitida... {}'.format(instance.id))
 
-        instance.partner.modify(pull__requests_in_progress=instance,
-            push__requests_canceled=instance)
-        instance.client.modify(pull__requests_in_progress=instance,
-            push__requests_canceled=instance)
-        instance.modify(status=Request.STATUS_CANCELED, date_canceled=dt.datetime.now())
 
-        Bill.make_bill(instance)
+def cancel_unsatisfied_request(instance):
+    instance.cancel()
 
-        instance.partner.account.send_message(context={'request': instance},
-            data={'request_id': str(instance.id), 'profile': 'partner'},
-            **PARTNER_MESSAGES['client_cancel_request'])
+    instance.partner.account.send_message(context={'request': instance},
+        data={'request_id': str(instance.id), 'profile': 'partner'},
+        **PARTNER_MESSAGES['client_cancel_request'])
 
 
 @shared_task(name='failure_deadline_requests')
 def failure_deadline_requests():
     requests = Request.objects.filter(status=Request.STATUS_IN_PROGRESS,
-        date_promise__lt=dt.datetime.now() - dt.timedelta(days=7, hours=48))
+        date_promise__lt=dt.datetime.now() - Deadline.FAILURE_TIMEOUT)
 
     for instance in requests:
-        instance.refund()
+        try:
+            fail_deadline_request(instance)
+        except TransitionError:
+            logger.info('cancelacion omitida... {}'.format(instance.id))
 
-        instance.partner.modify(pull__requests_in_progress=instance,
-            push__requests_canceled=instance)
-        instance.client.modify(pull__requests_in_progress=instance,
-            push__requests_canceled=instance)
-        instance.modify(status=Request.STATUS_CANCELED, date_canceled=dt.datetime.now())
 
-        Bill.make_bill(instance)
+def fail_deadline_request(instance):
+    instance.cancel()
 
-        instance.partner.account.send_message(context={'request': instance},
-            data={'request_id': str(instance.id), 'profile': 'partner'},
-            **PARTNER_MESSAGES['requests_canceled'])
-        instance.client.account.send_message(context={'request': instance},
-            data={'request_id': str(instance.id), 'profile': 'client'},
-            **CLIENT_MESSAGES['requests_canceled'])
+    instance.partner.account.send_message(context={'request': instance},
+        data={'request_id': str(instance.id), 'profile': 'partner'},
+        **PARTNER_MESSAGES['requests_canceled'])
+    instance.client.account.send_message(context={'request': instance},
+        data={'request_id': str(instance.id), 'profile': 'client'},
+        **CLIENT_MESSAGES['requests_canceled'])
 
 
 # @shared_task(name='inactive_round_partners')
@@ -331,10 +387,37 @@ def close_pending_requests():
     Close pending requests
     """
     requests = Request.objects.filter(status=Request.STATUS_PENDING, 
-        date_delivered__lt=dt.datetime.now() - dt.timedelta(hours=48))
+        date_delivered__lt=dt.datetime.now() - Deadline.CLOSE_TIMEOUT)
 
     for instance in requests:
-        instance.close()
+        try:
+            instance.close()
+        except TransitionError:
+            logger.info('cierre omitido... {}'.format(instance.id))
+
+
+@shared_task(name='settle_pending_requests')
+def settle_pending_requests():
+    """
+    Retries the settlements and refunds of the closed or canceled requests
+    whose payments failed.
+    """
+    now = dt.datetime.now()
+
+    for instance_id in Request.objects(settlement_pending=True,
+            date_settlement__lt=now - Request.SETTLEMENT_TIMEOUT).scalar('id'):
+        instance = Request.claim_settlement(instance_id, now)
+
+        if instance is None:
+            continue
+
+        try:
+            instance.settle()
+        except (PaymentError, RefundError, PayoutError) as error:
+            logger.error('pago de liquidacion rechazado... {}: {}'.format(
+                instance_id, error))
+        except Exception:
+            logger.exception('liquidacion pendiente fallida... {}'.format(instance_id))
 
 
 @shared_task(name='clean_requests')
@@ -342,17 +425,172 @@ def clean_closed_requests():
     """
     Clean closed Requests
     """
-    # Import Q function
-    from mongoengine.queryset.visitor import Q
     # Search for done requests that have some amount of time closed
-    Request.objects \
-        .filter(
-            Q(status=Request.STATUS_DONE,
-              date_closed__lt=dt.datetime.now() - dt.timedelta(days=30)) & \
-            (Q(questions__not__size=0) | Q(com_channel__not__size=0))) \
-        .modify(com_channel=[],questions=[])
+    closed = Request.objects.filter(status=Request.STATUS_DONE,
+        date_closed__lt=dt.datetime.now() - dt.timedelta(days=30)).scalar('id')
+
+    Message.objects.filter(request__in=list(closed)).delete()
+
+
+@shared_task(name='migrate_request_messages')
+def migrate_request_messages():
+    """
+    Moves the chat embedded in the requests (questions and com_channel
+    arrays) to the messages collection. Safe to run more than once.
+    """
+    from pymongo import ReplaceOne
+
+    channels = (Message.CHANNEL_QUESTIONS, Message.CHANNEL_COM)
+    collection = Request._get_collection()
+    cursor = collection.find(
+        {'$or': [{channel: {'$exists': True}} for channel in channels]},
+        {channel: True for channel in channels})
+
+    for raw in cursor:
+        operations = [ReplaceOne(
+            {'request': raw['_id'], 'channel': channel,
+                'ts': message.get('ts'), 'owner': message.get('owner')},
+            dict(message, request=raw['_id'], channel=channel), upsert=True)
+            for channel in channels for message in raw.get(channel) or []]
+
+        if operations:
+            Message._get_collection().bulk_write(operations, ordered=False)
+
+        collection.update_one({'_id': raw['_id']},
+            {'$unset': {channel: '' for channel in channels}})
 
 @shared_task(name='requests_without_partners')
 def requests_without_partners():
-    for req in Request.objects.filter(round_partners=[]):
-        select_round_partners(str(req.id))
+    """
+    Assigns round partners to every unmatched request in a single pass.
+    """
+    BatchMatcher().run(Request.objects.filter(status=Request.STATUS_TODO,
+        round_partners=[]))
+
+
+def _run_deadline(deadline, now):
+    """
+    Fires the action of a claimed deadline if the request is still in the
+    state that originated it, and schedules the one that follows.
+    """
+    instance = Request.objects.filter(id=deadline.to_mongo()['request']).first()
+
+    if instance is None:
+        return
+
+    if deadline.action in Deadline.TODO_ACTIONS:
+        if instance.status != Request.STATUS_TODO:
+            return
+
+        handlers = {
+            Deadline.ACTION_NOTIFY: notify_todo_requests,
+            Deadline.ACTION_REFRESH: refresh_todo_requests,
+            Deadline.ACTION_CANCEL_TODO: cancel_todo_requests,
+        }
+        handlers[deadline.action]([str(instance.id)])
+
+        if deadline.action != Deadline.ACTION_CANCEL_TODO:
+            Deadline.schedule_todo(instance, now=now)
+        return
+
+    due = Deadline.due_for_status(instance)
+
+    if due is None or due[0] != deadline.action:
+        return
+
+    # Si la fecha de referencia cambio (p. ej. una prorroga), reprograma.
+    if due[1] > now:
+        Deadline.schedule(instance, *due)
+        return
+
+    handlers = {
+        Deadline.ACTION_FAIL: fail_deadline_request,
+        Deadline.ACTION_CANCEL_UNSATISFIED: cancel_unsatisfied_request,
+        Deadline.ACTION_CLOSE: Request.close,
+    }
+
+    try:
+        handlers[deadline.action](instance)
+    except TransitionError:
+        # Una accion del usuario cambio el estado antes del vencimiento.
+        logger.info('vencimiento omitido... {}'.format(instance.id))
+
+
+@shared_task(name='dispatch_deadlines')
+def dispatch_deadlines(retry_delay=dt.timedelta(minutes=5), max_attempts=5):
+    """
+    Fires the due request deadlines.
+    """
+    now = dt.datetime.now()
+
+    for deadline in Deadline.claim_due(now):
+        # Un despachador que cae deja el vencimiento reclamado, que se
+        # reintenta al expirar su lease hasta agotar los intentos.
+        if deadline.attempts > max_attempts:
+            logger.error('vencimiento {} de {} descartado tras {} intentos'.format(
+                deadline.action, deadline.to_mongo()['request'], max_attempts))
+            Deadline.release(deadline)
+            continue
+
+        try:
+            _run_deadline(deadline, now)
+        except Exception:
+            logger.exception('fallo el vencimiento {} de {}'.format(
+                deadline.action, deadline.to_mongo()['request']))
+
+            if deadline.attempts < max_attempts:
+                Deadline.schedule(deadline.to_mongo()['request'], deadline.action,
+                    now + retry_delay, attempts=deadline.attempts)
+                continue
+
+        Deadline.release(deadline)
+
+
+@shared_task(name='backfill_deadlines')
+def backfill_deadlines():
+    """
+    Schedules the deadlines of the requests in a timed state that have
+    none, for requests created before the deadlines were written on each
+    transition. Runs once when the workers start; the requests without
+    deadline are found on the server and streamed.
+    """
+    now = dt.datetime.now()
+    statuses = (Request.STATUS_TODO, Request.STATUS_IN_PROGRESS,
+        Request.STATUS_UNSATISFIED, Request.STATUS_PENDING)
+
+    cursor = Request.objects.aggregate(
+        {'$match': {'status': {'$in': statuses}}},
+        {'$lookup': {'from': Deadline._get_collection_name(), 'localField': '_id',
+            'foreignField': 'request', 'as': 'deadlines'}},
+        {'$match': {'deadlines': []}},
+        {'$project': {key: 1 for key in ('status', 'date_created',
+            'date_promise', 'date_unsatisfied', 'date_delivered')}},
+        allowDiskUse=True)
+
+    for item in cursor:
+        Deadline.schedule_for_status(Request._from_son(item), now=now)
+
+
+@shared_task(name='rebuild_unread_counters')
+def rebuild_unread_counters():
+    """
+    Recomputes the unread messages counters of the open requests from the
+    last read dates of each participant.
+    """
+    from pymongo import UpdateOne
+
+    statuses = (Request.STATUS_TODO, Request.STATUS_IN_PROGRESS,
+        Request.STATUS_DELIVERED, Request.STATUS_PENDING, Request.STATUS_UNSATISFIED)
+    operations = list()
+
+    for instance in Request.objects.filter(status__in=statuses).only('id', 'status',
+            'partner', 'last_read_client', 'last_read_partner', 'round_partners'):
+        operations.append(UpdateOne({'_id': instance.id},
+            {'$set': instance.count_unread()}))
+
+        if len(operations) >= 500:
+            Request._get_collection().bulk_write(operations, ordered=False)
+            operations = list()
+
+    if operations:
+        Request._get_collection().bulk_write(operations, ordered=False)
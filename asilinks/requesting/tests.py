@@ -1,12 +1,36 @@
+import os
+import logging
+import timeit
+import unittest
+from unittest import mock
+import threading
+import datetime as dt
+from decimal import Decimal
+from collections import namedtuple
 
+from django.test import override_settings
 from rest_framework.test import APISimpleTestCase, APIClient
 from rest_framework.reverse import reverse
 from rest_framework import status
 
-from .documents import Request
-from main.documents import Client, Partner
+from bson.objectid import ObjectId
+
+from asilinks.bulk import BulkUpdate
+from asilinks.celery import app
+from asilinks.prefetch import prefetch_references
+from asilinks.testing import QueryCountMixin
+from .documents import (Request, RoundPartner, Message, Deadline, TransitionError,
+    RequestEvent, Review)
+from .matching import BatchMatcher
+from .tasks import (migrate_request_messages, select_round_partners, settle_pending_requests,
+    backfill_deadlines, todo_requests_buckets, refresh_round_partners)
+from .serializers import thread_messages
+from .events import listen, get_broker, MongoEventBroker
+from main.documents import Client, Partner, KnowField
 from authentication.documents import Account
 
+logger = logging.getLogger(__name__)
+
 # Create your tests here.
 
 class RequestConsistencyTests(APISimpleTestCase):
@@ -32,6 +56,7 @@ class RequestConsistencyTests(APISimpleTestCase):
 class RequestWorkflowTests(APISimpleTestCase):
     def setUp(self):
         super().setUp()
+        app.conf.task_always_eager = True
 
         for item in ('user1', 'user2', 'user3', 'user4',):
             client = APIClient()
@@ -55,9 +80,15 @@ class RequestWorkflowTests(APISimpleTestCase):
 
         self.assertEqual(response.json()['status'], Request.STATUS_TODO,
             msg=response.json())
+        self.assertEqual(response.json()['matching_status'], Request.MATCHING_PENDING,
+            msg=response.json())
 
         req = Request.objects.get(id=response.json()['id'])
         self.assertIn(req, req.client.requests_todo, msg=req.id)
+        self.assertEqual(req.matching_status, Request.MATCHING_DONE, msg=req.id)
+
+        # La seleccion no se repite sobre un requerimiento ya procesado.
+        self.assertIsNone(Request.claim_matching(req.id))
 
         # Selected round_partners
         for r_partner in req.round_partners:
@@ -125,3 +156,799 @@ class RequestWorkflowTests(APISimpleTestCase):
         response = self.user3.get(url)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST,
             msg=response.json())
+
+
+class BatchMatcherTests(APISimpleTestCase):
+
+    def test_candidates_by_country(self):
+        """
+        Ensure candidates are read from the in memory index by country.
+        """
+        math, physics = ObjectId(), ObjectId()
+        ve, co, anywhere = ObjectId(), ObjectId(), ObjectId()
+
+        matcher = BatchMatcher()
+        matcher.by_country = {
+            (math, 'VE'): {ve}, (math, 'CO'): {co}, (physics, None): {anywhere}}
+        matcher.by_field = {math: {ve, co}, physics: {anywhere}}
+
+        self.assertEqual(matcher.candidates(
+            {'know_fields': [math], 'country_alpha2': 'VE'}), {ve})
+        self.assertEqual(matcher.candidates(
+            {'know_fields': [math, physics], 'country_alpha2': None}), {ve, co, anywhere})
+        self.assertEqual(matcher.candidates(
+            {'know_fields': [physics], 'country_alpha2': 'CO'}), set())
+
+    def test_persist_only_claimed_requests(self):
+        """
+        Ensure opportunities are pushed only for the requests the batch wrote.
+        """
+        client = Account.objects.get(email='user1@asilinks.com').client_profile
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        requests = [Request.objects.create(name='lote {}'.format(index), client=client,
+                matching_status=Request.MATCHING_PENDING) for index in range(2)]
+
+        try:
+            matcher = BatchMatcher()
+            claimed = list(matcher.claim(Request.objects(
+                id__in=[request.id for request in requests])))
+            self.assertEqual(len(claimed), 2)
+
+            # Otro proceso empareja el segundo mientras el lote calcula.
+            Request.objects(id=requests[1].id).update(
+                push__round_partners=RoundPartner(partner=partner))
+
+            written = matcher.persist([(request, [], [partner.id]) for request in claimed])
+
+            self.assertEqual([item[0].id for item in written], [requests[0].id])
+            todo = Partner.objects.get(id=partner.id).to_mongo().get('requests_todo', [])
+            self.assertIn(requests[0].id, todo)
+            self.assertNotIn(requests[1].id, todo)
+            self.assertEqual(Request.objects(id__in=[request.id for request in requests],
+                matching_status=Request.MATCHING_DONE).count(), 2)
+        finally:
+            with BulkUpdate() as bulk:
+                for request in requests:
+                    Partner.pull_opportunity(bulk, partner.id, request.id)
+                    request.delete()
+
+
+class TodoRequestsBucketsTests(APISimpleTestCase):
+
+    CYCLE = dt.timedelta(hours=36)
+
+    @staticmethod
+    def legacy_bucket(cycles):
+        # Clasificacion por requerimiento previa al pipeline.
+        if 1 < cycles < 2:
+            return 'notify'
+        elif 2 < cycles < 6:
+            return 'refresh'
+        elif cycles > 6:
+            return 'cancel'
+        return None
+
+    def create_requests(self, now, cycles):
+        return {Request.objects.create(name='ciclos {}'.format(value),
+            status=Request.STATUS_TODO, date_created=now - self.CYCLE * value).id: value
+            for value in cycles}
+
+    def test_buckets_match_legacy_classification(self):
+        """
+        Ensure the pipeline classifies each request as the per-request logic did.
+        """
+        now = dt.datetime(2019, 6, 1, 12)
+        requests = self.create_requests(now,
+            (0.5, 1, 1.25, 1.5, 2, 2.5, 4, 6, 6.5, 10))
+
+        try:
+            buckets = {item['_id']: item['bucket'] for item in
+                Request.objects.aggregate(*todo_requests_buckets(now))
+                if item['_id'] in requests}
+
+            for request_id, cycles in requests.items():
+                with self.subTest(cycles=cycles):
+                    self.assertEqual(buckets.get(request_id), self.legacy_bucket(cycles))
+        finally:
+            Request.objects(id__in=list(requests)).delete()
+
+    def test_refresh_dispatches_buckets_by_chunks(self):
+        """
+        Ensure every classified request reaches its handler in bounded chunks.
+        """
+        requests = self.create_requests(dt.datetime.now(), (1.5, 3, 7, 8, 9))
+        calls = {bucket: [] for bucket in ('notify', 'refresh', 'cancel')}
+
+        try:
+            with mock.patch('requesting.tasks.notify_todo_requests', calls['notify'].append), \
+                    mock.patch('requesting.tasks.refresh_todo_requests', calls['refresh'].append), \
+                    mock.patch('requesting.tasks.cancel_todo_requests', calls['cancel'].append):
+                refresh_round_partners(chunk_size=2)
+
+            for bucket, chunks in calls.items():
+                self.assertTrue(all(len(ids) <= 2 for ids in chunks))
+                dispatched = {ObjectId(item) for ids in chunks for item in ids}
+
+                self.assertEqual(dispatched & set(requests), {request_id
+                    for request_id, cycles in requests.items()
+                    if self.legacy_bucket(cycles) == bucket})
+        finally:
+            Request.objects(id__in=list(requests)).delete()
+
+
+class SelectRoundPartnersTests(APISimpleTestCase):
+
+    def test_selection_runs_once(self):
+        """
+        Ensure the round partners are stored before the fan-out and a second
+        run neither samples again nor notifies again.
+        """
+        client = Account.objects.get(email='user1@asilinks.com').client_profile
+        request = Request.objects.create(name='seleccion', client=client,
+            know_fields=['591c6dafe6e8da00d7b9ce82'],
+            matching_status=Request.MATCHING_PENDING)
+        partners = list()
+
+        try:
+            with mock.patch.object(Partner, 'send_multicast') as send_multicast:
+                select_round_partners(str(request.id))
+                request.reload()
+                partners = [rp.partner.id for rp in request.round_partners]
+
+                select_round_partners(str(request.id))
+                request.reload()
+
+            self.assertEqual(request.matching_status, Request.MATCHING_DONE)
+            self.assertEqual([rp.partner.id for rp in request.round_partners], partners)
+            self.assertLessEqual(send_multicast.call_count, 1)
+            self.assertIsNone(Request.claim_matching(request.id))
+        finally:
+            with BulkUpdate() as bulk:
+                for partner_id in partners:
+                    Partner.pull_opportunity(bulk, partner_id, request.id)
+            request.delete()
+
+
+class BulkUpdateTests(APISimpleTestCase):
+
+    def test_merge_reference_list_updates(self):
+        """
+        Ensure updates over the same document are merged in one operation.
+        """
+        first, second = Request(id=ObjectId()), Request(id=ObjectId())
+        partners = [Partner(id=ObjectId()) for _ in range(12)]
+
+        bulk = BulkUpdate()
+        for partner in partners:
+            bulk.update(partner, push__requests_todo=first)
+        bulk.update(partners[0], push__requests_todo=second,
+            pull__requests_rejected=first)
+
+        operations = bulk.operations()
+        self.assertEqual(list(operations), [Partner])
+        self.assertEqual(len(operations[Partner]), 12)
+        self.assertEqual(operations[Partner][0]._doc, {
+            '$push': {'requests_todo': {'$each': [first.id, second.id]}},
+            '$pull': {'requests_rejected': {'$in': [first.id]}},
+        })
+
+    def test_conflicting_updates(self):
+        """
+        Ensure a push and a pull over the same list are rejected.
+        """
+        request, partner = Request(id=ObjectId()), Partner(id=ObjectId())
+
+        bulk = BulkUpdate()
+        bulk.update(partner, push__requests_todo=request)
+        with self.assertRaises(ValueError):
+            bulk.update(partner, pull__requests_todo=request)
+
+
+class DeadlineTests(APISimpleTestCase):
+
+    def test_todo_actions_follow_cycles(self):
+        """
+        Ensure todo requests are notified, refreshed and canceled by cycle.
+        """
+        created = dt.datetime(2019, 1, 1)
+        cycle, repeat = Deadline.TODO_CYCLE, Deadline.TODO_REPEAT
+        cases = (
+            (created, (Deadline.ACTION_NOTIFY, created + cycle)),
+            (created + cycle, (Deadline.ACTION_NOTIFY, created + cycle + repeat)),
+            (created + cycle * 2 - repeat, (Deadline.ACTION_REFRESH, created + cycle * 2)),
+            (created + cycle * 2, (Deadline.ACTION_REFRESH, created + cycle * 2 + repeat)),
+            (created + cycle * 6 - repeat, (Deadline.ACTION_CANCEL_TODO, created + cycle * 6)),
+            (created + cycle * 7, (Deadline.ACTION_CANCEL_TODO, created + cycle * 7)),
+        )
+
+        for now, expected in cases:
+            with self.subTest(now=now):
+                self.assertEqual(Deadline.next_todo_action(created, now), expected)
+
+    def test_due_for_status(self):
+        """
+        Ensure timed states get their deadline from the reference date.
+        """
+        promise = dt.datetime(2019, 1, 10)
+        request = Request(status=Request.STATUS_IN_PROGRESS, date_promise=promise)
+
+        self.assertEqual(Deadline.due_for_status(request),
+            (Deadline.ACTION_FAIL, promise + Deadline.FAILURE_TIMEOUT))
+        self.assertIsNone(Deadline.due_for_status(Request(status=Request.STATUS_DONE)))
+
+    def test_claimed_deadline_is_leased(self):
+        """
+        Ensure a claimed deadline is kept until released and fires again
+        once its lease expires.
+        """
+        request = Request.objects.create(name='vencimiento', status=Request.STATUS_TODO)
+        now = dt.datetime(2000, 1, 2)
+
+        try:
+            Deadline.schedule(request, Deadline.ACTION_NOTIFY, dt.datetime(2000, 1, 1))
+
+            claimed = list(Deadline.claim_due(now))
+            self.assertEqual([item.action for item in claimed], [Deadline.ACTION_NOTIFY])
+            self.assertEqual(list(Deadline.claim_due(now)), [])
+
+            # Sin liberar, el vencimiento vuelve al expirar el lease.
+            retried = list(Deadline.claim_due(now + Deadline.LEASE_TIMEOUT))
+            self.assertEqual(len(retried), 1)
+            self.assertEqual(retried[0].attempts, 2)
+
+            # El lease anterior ya no puede liberarlo.
+            Deadline.release(claimed[0])
+            self.assertEqual(Deadline.objects(request=request).count(), 1)
+
+            Deadline.release(retried[0])
+            self.assertEqual(Deadline.objects(request=request).count(), 0)
+        finally:
+            request.delete()
+
+    def test_backfill_skips_scheduled_requests(self):
+        """
+        Ensure the backfill schedules only the requests without deadline.
+        """
+        created = dt.datetime.now().replace(microsecond=0)
+        missing = Request.objects.create(name='sin vencimiento',
+            status=Request.STATUS_TODO, date_created=created)
+        scheduled = Request.objects.create(name='con vencimiento',
+            status=Request.STATUS_TODO, date_created=created)
+
+        try:
+            Deadline.schedule(scheduled, Deadline.ACTION_REFRESH, created)
+            backfill_deadlines()
+
+            self.assertEqual(Deadline.objects.get(request=missing).due_at,
+                Deadline.next_todo_action(created, created)[1])
+            self.assertEqual(Deadline.objects.get(request=scheduled).action,
+                Deadline.ACTION_REFRESH)
+        finally:
+            Deadline.discard(missing)
+            Deadline.discard(scheduled)
+            missing.delete()
+            scheduled.delete()
+
+
+class MessageStoreTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.request = Request.objects.create(name='chat', status=Request.STATUS_TODO)
+
+    def tearDown(self):
+        self.request.delete()
+        super().tearDown()
+
+    def test_message_window(self):
+        """
+        Ensure the window returns the last messages in chronological order.
+        """
+        start = dt.datetime(2019, 1, 1)
+        Message.objects.insert([Message(request=self.request,
+            channel=Message.CHANNEL_QUESTIONS, content=str(i),
+            ts=start + dt.timedelta(minutes=i)) for i in range(120)])
+
+        window = self.request.message_window(limit=50)
+        self.assertEqual([m.content for m in window], [str(i) for i in range(70, 120)])
+
+        window = self.request.message_window(before=window[0].ts, limit=50)
+        self.assertEqual([m.content for m in window], [str(i) for i in range(20, 70)])
+        self.assertEqual(self.request.messages().count(), 120)
+
+    def test_window_keeps_late_responses(self):
+        """
+        Ensure a response sent after newer messages is shown with the
+        message it answers and does not count in the window limit.
+        """
+        start = dt.datetime(2019, 1, 1)
+        messages = [Message(request=self.request, channel=Message.CHANNEL_QUESTIONS,
+            content=str(i), ts=start + dt.timedelta(minutes=i)) for i in range(10)]
+        messages.append(Message(request=self.request, channel=Message.CHANNEL_QUESTIONS,
+            content='respuesta', ts=start + dt.timedelta(minutes=10),
+            reference_ts=messages[2].ts))
+        Message.objects.insert(messages)
+
+        newest = self.request.message_window(limit=5)
+        self.assertEqual([m.content for m in newest], [str(i) for i in range(5, 10)])
+
+        older = thread_messages(self.request.message_window(before=newest[0].ts, limit=5))
+        self.assertEqual([m.content for m, _ in older], [str(i) for i in range(5)])
+        self.assertEqual(older[2][1].content, 'respuesta')
+
+    def test_unread_counters(self):
+        """
+        Ensure pushed messages increment the counters of every participant
+        but the sender and the round partners that rejected the request.
+        """
+        sender = Account.objects.get(email='user2@asilinks.com')
+        self.request.modify(round_partners=[RoundPartner(partner=ObjectId()),
+            RoundPartner(partner=ObjectId()), RoundPartner(partner=ObjectId(), rejected=True),
+            RoundPartner(partner=sender.partner_profile.id)])
+
+        for i in range(3):
+            self.request.push_message(Message(content=str(i), ts=dt.datetime.now()))
+        self.request.push_message(Message(content='socio', owner=sender,
+            ts=dt.datetime.now()))
+
+        self.request.reload()
+        self.assertEqual(self.request.unread_client, 4)
+        self.assertEqual([rp.unread for rp in self.request.round_partners], [4, 4, 0, 3])
+        self.assertEqual(self.request.count_unread()['round_partners.1.unread'], 4)
+
+    def test_migrate_embedded_messages(self):
+        """
+        Ensure the embedded chat is moved once to the messages collection.
+        """
+        ts = dt.datetime(2019, 1, 1)
+        Request._get_collection().update_one({'_id': self.request.id}, {'$set': {
+            'questions': [{'type': 'text', 'content': 'pregunta', 'ts': ts}],
+            'com_channel': [{'type': 'text', 'content': 'hola', 'ts': ts}],
+        }})
+
+        migrate_request_messages()
+        migrate_request_messages()
+
+        self.assertEqual(self.request.messages(Message.CHANNEL_QUESTIONS).count(), 1)
+        self.assertEqual(self.request.messages(Message.CHANNEL_COM).count(), 1)
+        raw = Request._get_collection().find_one({'_id': self.request.id})
+        self.assertNotIn('questions', raw)
+
+
+class ThreadMessagesTests(APISimpleTestCase):
+
+    Item = namedtuple('Item', ('ts', 'reference_ts'))
+
+    def make_channel(self, size):
+        start = dt.datetime(2019, 1, 1)
+        messages = [self.Item(start + dt.timedelta(seconds=i), None)
+            for i in range(size)]
+
+        # Responde la mitad de los mensajes, al final del canal.
+        return messages + [self.Item(start + dt.timedelta(seconds=size + i),
+            messages[i].ts) for i in range(0, size, 2)]
+
+    def test_thread_messages(self):
+        """
+        Ensure each message is paired with its response only once.
+        """
+        messages = self.make_channel(4)
+        threads = thread_messages(messages)
+
+        self.assertEqual([message for message, _ in threads], messages[:4])
+        self.assertEqual([response for _, response in threads],
+            [messages[4], None, messages[5], None])
+
+    @unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'benchmarks disabled')
+    def test_benchmark_flat_cost_per_message(self):
+        """
+        Ensure the cost per message does not grow with the channel length.
+        """
+        costs = dict()
+
+        for size in (100, 1000):
+            messages = self.make_channel(size)
+            costs[size] = min(timeit.repeat(lambda: thread_messages(messages),
+                number=20, repeat=3)) / (20 * len(messages))
+
+            logger.info('%d messages: %.3fus per message', size, costs[size] * 1e6)
+
+        self.assertLess(costs[1000], costs[100] * 3)
+
+
+@override_settings(REQUEST_EVENTS_BROKER='requesting.events.LocalEventBroker')
+class RequestEventsTests(APISimpleTestCase):
+
+    def test_listen_waits_for_events(self):
+        """
+        Ensure listeners wake up on new events of their requests only.
+        """
+        request_id, other_id = ObjectId(), ObjectId()
+        cursor, events = listen([request_id], timeout=0)
+        self.assertEqual(events, [])
+
+        def publish():
+            get_broker().publish(other_id, 'offer', {})
+            get_broker().publish(request_id, 'message', {'content': 'hola'})
+
+        threading.Timer(0.1, publish).start()
+        cursor, events = listen([request_id], after=cursor, timeout=5)
+
+        self.assertEqual([event['data'] for event in events], [{'content': 'hola'}])
+        self.assertEqual(cursor, str(events[-1]['seq']))
+        self.assertEqual(listen([request_id], after=cursor, timeout=0)[1], [])
+
+    def test_push_message_publishes_event(self):
+        """
+        Ensure the messages pushed to a request are streamed.
+        """
+        request = Request.objects.create(name='eventos', status=Request.STATUS_TODO)
+        cursor, _ = listen([request.id], timeout=0)
+
+        try:
+            request.push_message(Message(content='hola', ts=dt.datetime.now()))
+            cursor, events = listen([request.id], after=cursor, timeout=0)
+        finally:
+            request.delete()
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['kind'], 'message')
+        self.assertEqual(events[0]['data']['channel'], Message.CHANNEL_QUESTIONS)
+
+
+class MongoEventBrokerTests(APISimpleTestCase):
+
+    def test_fetch_waits_for_gaps(self):
+        """
+        Ensure a number taken by an event not inserted yet stops the cursor
+        until the gap is older than the gap timeout.
+        """
+        request_id = ObjectId()
+        broker = MongoEventBroker(gap_timeout=dt.timedelta(minutes=1))
+        after = broker.last()
+
+        # Otro proceso toma un numero y aun no inserta su evento.
+        RequestEvent(request=ObjectId()).seq
+        broker.publish(request_id, 'message', {'content': 'hola'})
+
+        self.assertEqual(broker.fetch([request_id], after), (after, []))
+
+        broker.gap_timeout = dt.timedelta(0)
+        cursor, events = broker.fetch([request_id], after)
+
+        self.assertEqual(cursor, after + 2)
+        self.assertEqual([event['data'] for event in events], [{'content': 'hola'}])
+        self.assertEqual(broker.fetch([request_id], cursor), (cursor, []))
+
+
+class RequestListingTests(APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.partner = Partner(id=ObjectId())
+        other = ObjectId()
+
+        def request(name, status, partner=None, rejected=False):
+            return Request.objects.create(name=name, status=status, partner=partner,
+                round_partners=[RoundPartner(partner=self.partner.id, rejected=rejected),
+                    RoundPartner(partner=other)])
+
+        self.requests = [
+            request('todo', Request.STATUS_TODO),
+            request('rejected', Request.STATUS_TODO, rejected=True),
+            request('in_progress', Request.STATUS_DELIVERED, partner=self.partner.id),
+            request('not_selected', Request.STATUS_IN_PROGRESS, partner=other),
+            request('canceled', Request.STATUS_CANCELED),
+        ]
+
+    def tearDown(self):
+        for instance in self.requests:
+            instance.delete()
+        super().tearDown()
+
+    def test_partner_filter(self):
+        """
+        Ensure partner lists are built from the request fields.
+        """
+        cases = (
+            ({'todo'}, ['todo']),
+            ({'in_progress'}, ['in_progress']),
+            ({'rejected'}, ['rejected', 'not_selected']),
+            ({'canceled'}, ['canceled']),
+        )
+
+        for groups, expected in cases:
+            with self.subTest(groups=groups):
+                query = Request.partner_filter(self.partner, groups)
+                self.assertCountEqual(Request.objects.filter(query).scalar('name'), expected)
+
+
+class PrefetchTests(QueryCountMixin, APISimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.know_fields = [KnowField(category='prefetch', sub_category=str(i)).save()
+            for i in range(3)]
+        self.requests = [Request.objects.create(name=str(i),
+            know_fields=self.know_fields[:i % 3 + 1]) for i in range(30)]
+
+    def tearDown(self):
+        for instance in self.requests:
+            instance.delete()
+        for know_field in self.know_fields:
+            know_field.delete()
+        super().tearDown()
+
+    def test_one_query_per_collection(self):
+        """
+        Ensure the references of a page are resolved with a single query.
+        """
+        requests = list(Request.objects(id__in=[r.id for r in self.requests]))
+
+        with self.assertMaxQueries(1):
+            prefetch_references(requests, 'know_fields')
+            names = [str(know_field) for instance in requests
+                for know_field in instance.know_fields]
+
+        self.assertEqual(len(names), 60)
+
+    def test_list_queries(self):
+        """
+        Ensure the request list makes the same queries for any page size.
+        """
+        account = Account.objects.get(email='user1@asilinks.com')
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        Request.objects(id__in=[r.id for r in self.requests]).update(
+            set__client=account.client_profile, set__partner=partner,
+            set__status=Request.STATUS_IN_PROGRESS)
+
+        client = APIClient()
+        client.force_authenticate(account)
+        url = reverse('request-list', kwargs={'version': 'dev'})
+
+        with self.assertMaxQueries(10):
+            response = client.get(url, {'status': 'in_progress'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(len(response.data), 30)
+
+    def test_partner_detail_queries(self):
+        """
+        Ensure the partner profile resolves its references by collection.
+        """
+        account = Account.objects.get(email='user1@asilinks.com')
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        done = [r.id for r in self.requests]
+        Request.objects(id__in=done).update(set__client=account.client_profile,
+            set__partner_review=Review(score=8, comments='prefetch'))
+        Partner.objects(id=partner.id).update(push_all__requests_done=done)
+
+        client = APIClient()
+        client.force_authenticate(account)
+        url = reverse('partner-detail', kwargs={'version': 'dev', 'id': partner.id})
+
+        try:
+            with self.assertMaxQueries(10):
+                response = client.get(url)
+        finally:
+            Partner.objects(id=partner.id).update(pull_all__requests_done=done)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['reviews']), 3)
+
+
+class RequestVersionTests(APISimpleTestCase):
+
+    def test_mutations_bump_version(self):
+        """
+        Ensure state, message and offer changes bump the request version.
+        """
+        request = Request.objects.create(name='version', status=Request.STATUS_TODO)
+
+        try:
+            self.assertEqual(request.version, 0)
+            request.modify(status=Request.STATUS_IN_PROGRESS)
+            self.assertEqual(request.version, 1)
+
+            request.push_message(Message(content='hola', ts=dt.datetime.now()))
+            request.reload()
+            self.assertEqual(request.version, 2)
+
+            request.round_partners.append(RoundPartner(partner=ObjectId()))
+            request.save()
+            self.assertEqual(Request.objects.get(id=request.id).version, 3)
+        finally:
+            request.delete()
+
+    def test_update_round_partners(self):
+        """
+        Ensure only the given round partner is updated, when the query matches.
+        """
+        partners = [ObjectId(), ObjectId()]
+        request = Request.objects.create(name='ofertas', status=Request.STATUS_TODO,
+            round_partners=[RoundPartner(partner=partner) for partner in partners])
+
+        try:
+            self.assertTrue(request.update_round_partners([partners[0]],
+                query={'status': Request.STATUS_TODO}, price=Decimal('250'),
+                duration=dt.timedelta(hours=100)))
+            self.assertFalse(request.update_round_partners([partners[1]],
+                query={'status': Request.STATUS_DONE}, price=Decimal('300')))
+
+            request.reload()
+            self.assertEqual([rp.price for rp in request.round_partners], [Decimal('250'), None])
+            self.assertEqual(request.round_partners[0].duration, dt.timedelta(hours=100))
+            self.assertEqual(request.version, 1)
+        finally:
+            request.delete()
+
+
+class RequestDetailCacheTests(APISimpleTestCase):
+
+    def test_etag_follows_live_fields(self):
+        """
+        Ensure the ETag and the body change with can_cancel even when the
+        request version does not.
+        """
+        account = Account.objects.get(email='user1@asilinks.com')
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        request = Request.objects.create(name='detalle', client=account.client_profile,
+            partner=partner, status=Request.STATUS_IN_PROGRESS,
+            date_promise=dt.datetime.now() + dt.timedelta(days=1))
+
+        client = APIClient()
+        client.force_authenticate(account)
+        url = reverse('request-detail', kwargs={'version': 'dev', 'id': request.id})
+
+        try:
+            first = client.get(url)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            self.assertFalse(first.json()['can_cancel'])
+
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code,
+                status.HTTP_304_NOT_MODIFIED)
+
+            # Pasa el tiempo sin cambiar la version del requerimiento.
+            Request.objects(id=request.id).update_one(
+                set__date_promise=dt.datetime.now() - dt.timedelta(days=8))
+
+            second = client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(second.status_code, status.HTTP_200_OK)
+            self.assertTrue(second.json()['can_cancel'])
+            self.assertNotEqual(second['ETag'], first['ETag'])
+        finally:
+            request.delete()
+
+    def test_etag_follows_read_markers(self):
+        """
+        Ensure a read changes the ETag once and the polls that follow are
+        not modified.
+        """
+        account = Account.objects.get(email='user1@asilinks.com')
+        request = Request.objects.create(name='lectura', client=account.client_profile,
+            status=Request.STATUS_IN_PROGRESS, last_read_client=dt.datetime(2019, 1, 1),
+            date_promise=dt.datetime.now() + dt.timedelta(days=1))
+
+        client = APIClient()
+        client.force_authenticate(account)
+        url = reverse('request-detail', kwargs={'version': 'dev', 'id': request.id})
+
+        try:
+            first = client.get(url)
+            Request.objects(id=request.id).update_one(set__unread_client=2)
+
+            unread = client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(unread.status_code, status.HTTP_200_OK)
+            self.assertEqual(unread.json()['new_messages'], 2)
+
+            read = client.get(url, HTTP_IF_NONE_MATCH=unread['ETag'])
+            self.assertEqual(read.status_code, status.HTTP_200_OK)
+            self.assertEqual(read.json()['new_messages'], 0)
+            self.assertNotEqual(read.json()['last_read'], unread.json()['last_read'])
+
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=read['ETag']).status_code,
+                status.HTTP_304_NOT_MODIFIED)
+        finally:
+            request.delete()
+
+
+class RequestTransitionTests(APISimpleTestCase):
+
+    def test_conditional_transition(self):
+        """
+        Ensure a transition applies once and queues the profiles lists moves.
+        """
+        client = Account.objects.get(email='user1@asilinks.com').client_profile
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        request = Request.objects.create(name='transicion', client=client,
+            partner=partner, status=Request.STATUS_UNSATISFIED)
+        stale = Request.objects.get(id=request.id)
+
+        try:
+            bulk = BulkUpdate()
+            previous = request.transition(Request.STATUS_CANCELED, bulk=bulk,
+                date_canceled=dt.datetime.now())
+
+            self.assertEqual(previous, Request.STATUS_UNSATISFIED)
+            self.assertEqual(request.version, 1)
+
+            operations = bulk.operations()
+            self.assertEqual(operations[Client][0]._doc, {
+                '$pull': {'requests_in_progress': {'$in': [request.id]}},
+                '$push': {'requests_canceled': {'$each': [request.id]}},
+            })
+            self.assertEqual(len(operations[Partner]), 1)
+
+            # Una tarea con la copia previa no puede cerrar ni cancelar otra vez.
+            with self.assertRaises(TransitionError):
+                stale.transition(Request.STATUS_DONE)
+            with self.assertRaises(TransitionError):
+                stale.transition(Request.STATUS_CANCELED)
+
+            self.assertEqual(Request.objects.get(id=request.id).status,
+                Request.STATUS_CANCELED)
+        finally:
+            request.delete()
+
+
+    def test_failed_settlement_is_retried(self):
+        """
+        Ensure a close whose payments fail stays pending and is settled by
+        the retry task.
+        """
+        client = Account.objects.get(email='user1@asilinks.com').client_profile
+        partner = Account.objects.get(email='user2@asilinks.com').partner_profile
+        request = Request.objects.create(name='liquidacion', client=client,
+            partner=partner, status=Request.STATUS_PENDING)
+
+        try:
+            with mock.patch.object(Request, 'make_settlement',
+                    side_effect=RuntimeError) as make_settlement:
+                with self.assertRaises(RuntimeError):
+                    request.close()
+
+            stored = Request.objects.get(id=request.id)
+            self.assertEqual(stored.status, Request.STATUS_DONE)
+            self.assertTrue(stored.settlement_pending)
+
+            Request.objects(id=request.id).update(
+                set__date_settlement=dt.datetime.now() - Request.SETTLEMENT_TIMEOUT * 2)
+
+            with mock.patch.object(Request, 'make_settlement') as make_settlement:
+                settle_pending_requests()
+                settle_pending_requests()
+
+            self.assertEqual(make_settlement.call_count, 1)
+            self.assertFalse(Request.objects.get(id=request.id).settlement_pending)
+        finally:
+            request.delete()
+
+
+class BillSnapshotTests(APISimpleTestCase):
+
+    def test_bill_is_stored_until_key_changes(self):
+        """
+        Ensure the bill is computed once per key and read from the snapshot.
+        """
+        request = Request.objects.create(name='factura', partner=Partner(id=ObjectId()),
+            status=Request.STATUS_IN_PROGRESS, price=Decimal('250'))
+        amounts = {key: Decimal('10') for key in ('partner', 'asilinks', 'sponsor',
+            'paypal', 'total', 'to_pay')}
+        amounts['sponsor_percent'] = Decimal('.05')
+
+        try:
+            with mock.patch.object(Request, 'calculate_bill',
+                    return_value=amounts) as calculate:
+                self.assertEqual(request.get_bill(), amounts)
+                self.assertEqual(Request.objects.get(id=request.id).get_bill(), amounts)
+                self.assertEqual(calculate.call_count, 1)
+
+                request.modify(status=Request.STATUS_DELIVERED)
+                request.get_bill()
+                self.assertEqual(calculate.call_count, 2)
+
+            stored = Request.objects.get(id=request.id)
+            self.assertEqual(stored.bill.key, stored.bill_key)
+            self.assertEqual(stored.version, 1)
+        finally:
+            request.delete()
@@ -1,10 +1,14 @@
+import json
+import hashlib
 import datetime as dt
 import numpy as np
-from functools import reduce
 from bson.objectid import ObjectId
 from dateutil.relativedelta import relativedelta
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
+from django.utils.http import parse_etags
 from django.http import Http404
 
 from rest_framework import mixins, status
@@ -16,19 +20,31 @@ from rest_framework.response import Response
 from rest_framework_mongoengine.viewsets import GenericViewSet, ModelViewSet
 from mongoengine.queryset.visitor import Q
 
+from asilinks.bulk import BulkUpdate
 from asilinks.mixins import ActionSerializerMixin
+from asilinks.pagination import OptionalCursorPagination
+from asilinks.prefetch import PrefetchMixin
 
 from .documents import Request, RoundPartner
+from .events import listen, publish_offer
 from .serializers import *
 from .permissions import *
+from main.documents import Partner
 from main.permissions import HavePaypalEmail
 from admin.notification import CLIENT_MESSAGES
 
 
-class RequestViewSet(ActionSerializerMixin, ModelViewSet):
+class RequestViewSet(PrefetchMixin, ActionSerializerMixin, ModelViewSet):
     queryset = Request.objects.all()
     permission_classes = (IsAuthenticated,
         ClientPartnerRequestAccess, EditionRequestPermission)
+    pagination_class = OptionalCursorPagination
+    list_ordering_fields = ('date_created', 'name')
+
+    action_prefetch_related = {
+        ('list', 'monthly_list', ): ('know_fields', 'client__account',
+            'partner__account', 'round_partners__partner'),
+    }
 
     action_serializer_classes = {
         ('create', 'partial_update', 'update', ): MakeRequestSerializer,
@@ -59,19 +75,33 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
         status = self.request.query_params.getlist('status', ['todo', 'in_progress'])
 
         if profile_type == 'client':
-            profile = self.request.user.client_profile
+            status_set = set(status) & {'todo', 'in_progress', 'done', 'canceled'}
+            query = Request.client_filter(self.request.user.client_profile, status_set)
         elif profile_type == 'partner':
             if not self.request.user.has_partner_profile():
                 raise PermissionDenied(_('No posee perfil de socio.'))
-            profile = self.request.user.partner_profile
+            status_set = set(status) & {'todo', 'in_progress', 'rejected', 'done', 'canceled'}
+            query = Request.partner_filter(self.request.user.partner_profile, status_set)
         else:
             raise PermissionDenied(_('Este perfil no se encuentra disponible.'))
 
-        status_set = set(status) & {'todo', 'in_progress', 'rejected', 'done', 'canceled'}
-        return reduce(lambda x, y: x + getattr(profile, 'requests_' + y), status_set, list())
+        if not status_set:
+            return Request.objects.none()
+
+        return Request.objects.filter(query) \
+            .only(*ListRequestSerializer.projection) \
+            .order_by(self.get_list_ordering())
+
+    def get_list_ordering(self):
+        ordering = self.request.query_params.get('ordering', '-date_created')
+
+        if ordering.lstrip('-') not in self.list_ordering_fields:
+            raise ValidationError({'ordering': _('No se puede ordenar por este campo.')})
+
+        return ordering
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_list_queryset())
+        queryset = self.get_list_queryset()
 
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -82,11 +112,50 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
         return Response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
-        response = super().retrieve(request, *args, **kwargs)
-        self.get_object().update_last_read(request.user)
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        state = serializer.etag_representation(instance)
+        key = self.get_detail_key(instance)
+        etag = self.get_detail_etag(key, state)
+
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+
+        else:
+            cache_key = 'request-detail:{}'.format(hashlib.md5(key.encode()).hexdigest())
+            data = cache.get(cache_key)
+
+            if data is None:
+                data = serializer.cached_representation(instance)
+                cache.set(cache_key, data, settings.REQUEST_DETAIL_CACHE_TIMEOUT)
 
+            response = Response(dict(data, **serializer.live_representation(instance),
+                **serializer.read_representation(instance)))
+
+            # La marca de lectura solo avanza si habia algo sin leer, asi
+            # las consultas siguientes conservan el ETag.
+            if state['new_messages'] or state['new_offers']:
+                instance.update_last_read(request.user)
+
+        response['ETag'] = etag
         return response
 
+    def get_detail_key(self, instance):
+        """
+        The cached representation changes with the request version, the
+        user that reads it and the messages window params.
+        """
+        return '{}:{}:{}:{}'.format(instance.id, instance.version,
+            self.request.user.id, sorted(self.request.query_params.items()))
+
+    def get_detail_etag(self, key, state):
+        """
+        The ETag also covers the read markers and the fields that do not
+        follow the version.
+        """
+        content = '{}:{}'.format(key, json.dumps(state, sort_keys=True, default=str))
+        return '"{}"'.format(hashlib.md5(content.encode()).hexdigest())
+
     def perform_create(self, serializer):
         account = self.request.user
 
@@ -95,8 +164,9 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
 
     def perform_destroy(self, instance):
         instance.client.modify(pull__requests_todo=instance)
-        for rp in instance.round_partners:
-            rp.partner.modify(pull__requests_todo=instance)
+        with BulkUpdate() as bulk:
+            for rp in instance.round_partners:
+                Partner.pull_opportunity(bulk, rp.partner.pk, instance.pk)
 
         instance.delete()
 
@@ -130,7 +200,7 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
         queryset = self.get_queryset().filter( Q(**filters) &
             ((Q(date_created__gte=date_init) & Q(date_created__lte=date_end)) | 
             (Q(date_promise__gte=date_init) & Q(date_promise__lte=date_end)))
-        )
+        ).only(*ListRequestSerializer.projection)
 
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
@@ -179,8 +249,17 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
 
         serializer.is_valid(raise_exception=True)
 
-        serializer.save(date_response=dt.datetime.now(), last_activity=dt.datetime.now())
-        instance.save()
+        round_partner = serializer.save(date_response=dt.datetime.now(),
+            last_activity=dt.datetime.now())
+
+        # Solo se actualiza la oferta del socio mientras siga abierto.
+        if not instance.update_round_partners([request.user.partner_profile],
+                query={'status': Request.STATUS_TODO}, **{key: getattr(round_partner, key)
+                    for key in ('requisites', 'description', 'duration', 'price',
+                        'date_response', 'last_activity')}):
+            raise ValidationError({'message': _('El requerimiento ya no recibe ofertas.')})
+
+        publish_offer(instance, round_partner)
 
         instance.client.account.send_message(context={'request': instance},
             data={'request_id': str(instance.id), 'profile': 'client'},
@@ -188,6 +267,36 @@ class RequestViewSet(ActionSerializerMixin, ModelViewSet):
 
         return Response(serializer.data)
 
+    @action(methods=['get'], detail=True, permission_classes=[
+        IsAuthenticated, ClientPartnerRequestAccess])
+    def events(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return self.listen_events([instance.id])
+
+    @action(methods=['get'], detail=False, url_path='events',
+        url_name='account-events', permission_classes=[IsAuthenticated])
+    def account_events(self, request, *args, **kwargs):
+        account = request.user
+        profiles = [account.client_profile]
+
+        if account.has_partner_profile():
+            profiles.append(account.partner_profile)
+
+        requests = {request_id for profile in profiles
+            for key in ('requests_todo', 'requests_in_progress')
+            for request_id in profile.to_mongo().get(key, [])}
+
+        return self.listen_events(requests)
+
+    def listen_events(self, request_ids):
+        try:
+            cursor, events = listen(request_ids,
+                after=self.request.query_params.get('after'))
+        except (ValueError, TypeError):
+            raise ValidationError({'after': _('El cursor de eventos no es valido.')})
+
+        return Response({'cursor': cursor, 'events': events})
+
     @action(methods=['get', 'post'], detail=True, permission_classes=[
         IsAuthenticated, ClientRequestAccess, RequestReadytoPay])
     def payment_token(self, request, *args, **kwargs):